@@ -0,0 +1,259 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional
+
+import pandas as pd
+import requests
+
+log = logging.getLogger(__name__)
+
+# page requests of one source in flight at once
+PAGE_WORKERS = int(os.environ.get("STAGE_1_PAGE_WORKERS", 4))
+# page size for layers that do not report a maxRecordCount
+DEFAULT_PAGE_SIZE = 1000
+PAGE_RETRIES = 5
+# fingerprints only decide whether to download again, so they give up quickly when offline
+FINGERPRINT_RETRIES = 1
+REQUEST_TIMEOUT = 120
+PAGE_CHECKPOINT_DIR = ".pages"
+# fingerprints of the layers as of the last download, one file per source and filter attribute
+MANIFEST_DIR = ".manifests"
+
+
+def _get_json(url, params, retries=PAGE_RETRIES):
+    """
+    GET (or POST, for long parameter lists) an ArcGIS REST endpoint, retrying with backoff on
+    network errors and on error responses
+    """
+    for attempt in range(retries + 1):
+        try:
+            if sum(len(str(v)) for v in params.values()) > 1500:
+                response = requests.post(url, data=params, timeout=REQUEST_TIMEOUT)
+            else:
+                response = requests.get(url, params=params, timeout=REQUEST_TIMEOUT)
+            response.raise_for_status()
+            data = response.json()
+            if "error" in data:
+                raise Exception(data["error"])
+            return data
+        except Exception as err:
+            if attempt == retries:
+                raise
+            log.info(f"retrying {url} after: {err}")
+            time.sleep(2**attempt)
+
+
+def layer_info(layer_url, retries=PAGE_RETRIES) -> dict:
+    return _get_json(layer_url, {"f": "json"}, retries)
+
+
+def query_count(layer_url, where="1=1", retries=PAGE_RETRIES) -> int:
+    params = {"where": where, "returnCountOnly": "true", "f": "json"}
+    return _get_json(f"{layer_url}/query", params, retries)["count"]
+
+
+def query_object_ids(layer_url, where="1=1") -> List[int]:
+    data = _get_json(f"{layer_url}/query", {"where": where, "returnIdsOnly": "true", "f": "json"})
+    return sorted(data.get("objectIds") or [])
+
+
+def query_extent(layer_url, where="1=1", retries=PAGE_RETRIES) -> Optional[dict]:
+    params = {"where": where, "returnExtentOnly": "true", "f": "json"}
+    return _get_json(f"{layer_url}/query", params, retries).get("extent")
+
+
+def layer_fingerprint(layer_url, where="1=1", retries=FINGERPRINT_RETRIES) -> dict:
+    """
+    what a layer looks like for a where clause, from its metadata alone: the last edit date, the
+    feature count and the extent. equal fingerprints mean there is nothing new to download. raises
+    when the layer cannot be reached or refuses the count or extent query.
+    """
+    layer_url = layer_url.rstrip("/")
+    info = layer_info(layer_url, retries)
+    return {
+        "layer_url": layer_url,
+        "where": where,
+        "last_edit_date": (info.get("editingInfo") or {}).get("lastEditDate"),
+        "count": query_count(layer_url, where, retries),
+        "extent": query_extent(layer_url, where, retries),
+    }
+
+
+def read_manifest(path) -> Optional[dict]:
+    try:
+        return json.loads(Path(path).read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(path, fingerprint):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp_path.write_text(json.dumps(fingerprint, indent=2))
+    os.replace(tmp_path, path)
+
+
+def object_id_field(info) -> Optional[str]:
+    if info.get("objectIdField"):
+        return info["objectIdField"]
+    return next((f["name"] for f in info.get("fields") or [] if f.get("type") == "esriFieldTypeOID"), None)
+
+
+def sql_literal_value(code):
+    """
+    the value a literal of a where clause stands for: 'PH' -> PH, 907 -> 907
+    """
+    if isinstance(code, str) and len(code) >= 2 and code[0] == code[-1] == "'":
+        return code[1:-1].replace("''", "'")
+    return code
+
+
+def in_clause(label, codes) -> str:
+    """
+    where clause selecting every code at once; codes are where clause literals, as in the configs
+    """
+    if "*" in codes:
+        return "1=1"
+    return f"{label} IN ({', '.join(str(code) for code in codes)})"
+
+
+def features_with_code(features, label, code) -> list:
+    """
+    the features whose label property equals code exactly. numbers compare as numbers, so 903 matches
+    903.0. servers whose collation is looser, as SQL Server's ignoring case and trailing blanks, may
+    select more; see features_by_code.
+    """
+    if code == "*":
+        return list(features)
+
+    values = pd.Series([(f.get("properties") or {}).get(label) for f in features], dtype=object)
+    value = sql_literal_value(code)
+    if isinstance(value, str):
+        matches = values.map(lambda v: str(v) == value if v is not None else False)
+    else:
+        matches = pd.to_numeric(values, errors="coerce") == value
+    return [f for f, match in zip(features, matches.to_numpy()) if match]
+
+
+def features_by_code(layer_url, features, label, codes, page_dir=None) -> dict:
+    """
+    the features of an IN query over codes, split per code. each code's share is checked against the
+    server's count for label=code, and a code whose count differs, because the server compares values
+    differently than features_with_code, is queried on its own.
+    """
+    split = {}
+    for code in codes:
+        split[code] = features_with_code(features, label, code)
+        if code == "*":
+            continue
+
+        where = f"{label}={code}"
+        count = query_count(layer_url, where)
+        if count != len(split[code]):
+            log.info(f"{where} selects {count} features on the server, {len(split[code])} here; querying it alone")
+            code_page_dir = Path(page_dir) / hashlib.sha256(where.encode()).hexdigest()[:16] if page_dir else None
+            query = PagedQuery(layer_url, where=where, page_dir=code_page_dir)
+            split[code] = query.features()
+            query.done()
+    return split
+
+
+def _exceeded_transfer_limit(data) -> bool:
+    # geojson responses flag truncation under properties, esri json ones at the top level
+    return bool((data.get("properties") or {}).get("exceededTransferLimit") or data.get("exceededTransferLimit"))
+
+
+class PagedQuery:
+    """
+    All features of a layer matching a where clause, as GeoJSON, fetched in pages on a thread pool.
+    Pages are requested by offset, ordered by object id, or by ranges of object ids on layers without
+    pagination support. Every page is checkpointed to page_dir as it arrives, so an interrupted
+    download resumes with the missing pages only.
+    """
+
+    def __init__(self, layer_url, where="1=1", out_sr=4326, page_dir=None):
+        self.layer_url = layer_url.rstrip("/")
+        self.where = where
+        self.out_sr = out_sr
+        self.page_dir = Path(page_dir) if page_dir is not None else None
+
+    def _plan(self):
+        info = layer_info(self.layer_url)
+        page_size = info.get("maxRecordCount") or DEFAULT_PAGE_SIZE
+        oid_field = object_id_field(info)
+        supports_pagination = (info.get("advancedQueryCapabilities") or {}).get("supportsPagination", False)
+        if supports_pagination and oid_field:
+            count = query_count(self.layer_url, self.where)
+            pages = [{"resultOffset": offset, "resultRecordCount": page_size, "orderByFields": oid_field}
+                     for offset in range(0, count, page_size)]
+        else:
+            object_ids = query_object_ids(self.layer_url, self.where)
+            pages = [{"objectIds": ",".join(str(i) for i in object_ids[start:start + page_size])}
+                     for start in range(0, len(object_ids), page_size)]
+        return pages
+
+    def _fetch_page(self, page) -> list:
+        params = {"where": self.where, "outFields": "*", "returnGeometry": "true", "outSR": self.out_sr,
+                  "f": "geojson", **page}
+        data = _get_json(f"{self.layer_url}/query", params)
+        features = data.get("features") or []
+
+        # a server capping pages below maxRecordCount marks the page truncated; fetch the rest
+        expected = page.get("resultRecordCount")
+        while expected and _exceeded_transfer_limit(data) and 0 < len(features) < expected:
+            params = {**params, "resultOffset": page["resultOffset"] + len(features),
+                      "resultRecordCount": expected - len(features)}
+            data = _get_json(f"{self.layer_url}/query", params)
+            if not data.get("features"):
+                break
+            features += data["features"]
+        return features
+
+    def _page_file(self, checkpoint_dir, page_no) -> Path:
+        return checkpoint_dir / f"page-{page_no:06d}.json"
+
+    def _checkpoint_dir(self, pages) -> Optional[Path]:
+        if self.page_dir is None:
+            return
+        # pages are only reusable for the same query over the same result set
+        key = hashlib.sha256(json.dumps([self.layer_url, self.where, self.out_sr, pages]).encode()).hexdigest()
+        for stale in self.page_dir.glob("*"):
+            if stale.name != key[:16]:
+                shutil.rmtree(stale, ignore_errors=True)
+        checkpoint_dir = self.page_dir / key[:16]
+        checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        return checkpoint_dir
+
+    def _load_or_fetch_page(self, checkpoint_dir, page_no, page) -> list:
+        page_file = self._page_file(checkpoint_dir, page_no) if checkpoint_dir is not None else None
+        if page_file is not None and page_file.exists():
+            return json.loads(page_file.read_text())
+
+        features = self._fetch_page(page)
+        if page_file is not None:
+            tmp_file = page_file.with_suffix(f".{os.getpid()}.tmp")
+            tmp_file.write_text(json.dumps(features))
+            os.replace(tmp_file, page_file)
+        return features
+
+    def features(self, max_workers=PAGE_WORKERS) -> list:
+        pages = self._plan()
+        checkpoint_dir = self._checkpoint_dir(pages)
+        with ThreadPoolExecutor(max_workers) as executor:
+            page_features = list(executor.map(lambda p: self._load_or_fetch_page(checkpoint_dir, *p),
+                                              enumerate(pages)))
+        return [f for features in page_features for f in features]
+
+    def done(self):
+        """
+        drop the page checkpoints once the features are safely written elsewhere
+        """
+        if self.page_dir is not None:
+            shutil.rmtree(self.page_dir, ignore_errors=True)
@@ -3,7 +3,8 @@ from datetime import datetime
 import typer
 
 from land_grab_2.stl_dataset.step_1.constants import (STATE)
-from land_grab_2.stl_dataset.step_1.dataset_extraction import extract_and_clean_single_source_helper
+from land_grab_2.stl_dataset.step_1.dataset_extraction import extract_and_clean_single_source_helper, \
+    extract_and_clean_sources, print_source_timings
 from land_grab_2.stl_dataset.step_1.dataset_merge import merge_single_state_helper, merge_all_states_helper
 from land_grab_2.stl_dataset.step_1.state_trust_config import STATE_TRUST_CONFIGS
 from land_grab_2.stl_dataset.step_4.dataset_summary_stats import calculate_summary_statistics_helper
@@ -27,37 +28,45 @@ def extract_and_clean_single_source(source: str):
                                            cleaned_data_directory)
 
 
+def extract_and_clean_all_helper(cleaned_format='parquet', cleaned=None):
+    st = datetime.now()
+    sources = {
+        source: (config, _queried_data_directory(config[STATE]), _cleaned_data_directory(config[STATE]))
+        for source, config in STATE_TRUST_CONFIGS.items()
+    }
+    timings = extract_and_clean_sources(sources, cleaned_format=cleaned_format, cleaned=cleaned)
+    print_source_timings(timings)
+    print(f'extract_and_clean_all took: {datetime.now() - st}')
+
+
 @app.command()
 def extract_and_clean_all():
     '''
-    Extract and clean data for the entire dataset
+    Extract and clean data for the entire dataset, downloading and cleaning sources concurrently
     '''
-    st = datetime.now()
-    for state in STATE_TRUST_CONFIGS.keys():
-        extract_and_clean_single_source(state)
-    print(f'extract_and_clean_all took: {datetime.now() - st}')
+    extract_and_clean_all_helper()
 
 
 @app.command()
-def merge_single_state(state: str):
+def merge_single_state(state: str, geojson: bool = False):
     '''
     Merge all data for a single state
     '''
     cleaned_data_directory = _cleaned_data_directory(state)
     merged_data_directory = _merged_data_directory(state)
     merge_single_state_helper(state, cleaned_data_directory,
-                              merged_data_directory)
+                              merged_data_directory, geojson=geojson)
 
 
 @app.command()
-def merge_all_states():
+def merge_all_states(geojson: bool = False):
     '''
     Merge all data for the entire dataset
     '''
     # first, find all states for which we have cleaned data
     cleaned_data_directory = _cleaned_data_directory()
     merged_data_directory = _merged_data_directory()
-    merge_all_states_helper(cleaned_data_directory, merged_data_directory)
+    merge_all_states_helper(cleaned_data_directory, merged_data_directory, geojson=geojson)
 
 
 @app.command()
@@ -74,17 +83,25 @@ def calculate_summary_statistics():
 
 
 @app.command()
-def build_full_dataset():
+def build_full_dataset(fused: bool = False, spill: bool = False, geojson: bool = False):
     '''
-    Delete all old data files and build the entire dataset from scratch
+    Delete all old data files and build the entire dataset from scratch. With --fused, cleaned data
+    goes straight to the merge instead of through cleaned GeoParquet files; add --spill to hand it
+    over as those files rather than in memory. --geojson also exports the merged data as GeoJSON.
     '''
-    extract_and_clean_all()
-    merge_all_states()
+    if not fused:
+        extract_and_clean_all()
+        merge_all_states(geojson)
+        return
+
+    cleaned = {}
+    extract_and_clean_all_helper(cleaned_format='parquet' if spill else None, cleaned=cleaned)
+    merge_all_states_helper(_cleaned_data_directory(), _merged_data_directory(), cleaned, geojson)
 
 
-def run():
+def run(fused=False, spill=False, geojson=False):
     print('Running: build_stl_dataset')
-    build_full_dataset()
+    build_full_dataset(fused, spill, geojson)
 
 
 if __name__ == "__main__":
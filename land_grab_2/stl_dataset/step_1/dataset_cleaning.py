@@ -1,9 +1,12 @@
+import functools
 import os
 from pathlib import Path
 
 import geopandas as gpd
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 
 from land_grab_2.stl_dataset.step_1.constants import (
     ALBERS_EQUAL_AREA,
@@ -12,9 +15,6 @@ from land_grab_2.stl_dataset.step_1.constants import (
     TRUST_NAME,
     TOWNSHIP,
     RANGE,
-    SECTION,
-    MERIDIAN,
-    ALIQUOT,
     RIGHTS_TYPE,
     OK_HOLDING_DETAIL_ID,
     ACTIVITY,
@@ -24,10 +24,14 @@ from land_grab_2.stl_dataset.step_1.constants import (
     OK_TRUST_FUNDS_TO_HOLDING_DETAIL_FILE_SURF_2,
     OK_TRUST_FUNDS_TO_HOLDING_DETAIL_FILE_SURF_3,
 )
-from land_grab_2.utilities.utils import _get_filename
+from land_grab_2.stl_dataset.step_1.trs_parsing import assign_trs
+from land_grab_2.utilities.utils import _get_filename, write_geoparquet
 
 os.environ["RESTAPI_USE_ARCPY"] = "FALSE"
 
+# file formats cleaned data can be written in; None hands cleaned frames over in memory only
+CLEANED_FILE_EXTENSIONS = {"geojson": ".geojson", "parquet": ".parquet"}
+
 
 def _get_net_acres(gdf, source, config, alias):
     if NET_ACRES not in config:
@@ -47,8 +51,33 @@ def _get_net_acres(gdf, source, config, alias):
     return gdf
 
 
+def _write_cleaned_data(
+    gdf, source, label, alias, cleaned_data_directory, cleaned_format="parquet"
+):
+    """
+    Write cleaned data in cleaned_format, returning its path, or nothing if kept in memory
+    """
+    if cleaned_format is None:
+        return None
+
+    filename = _get_filename(
+        source, label, alias, CLEANED_FILE_EXTENSIONS[cleaned_format]
+    )
+    if cleaned_format == "parquet":
+        write_geoparquet(gdf, cleaned_data_directory + filename)
+    else:
+        gdf.to_file(cleaned_data_directory + filename, driver="GeoJSON")
+    return cleaned_data_directory + filename
+
+
 def _clean_queried_data(
-    source, config, label, alias, queried_data_directory, cleaned_data_directory
+    source,
+    config,
+    label,
+    alias,
+    queried_data_directory,
+    cleaned_data_directory,
+    cleaned_format="parquet",
 ):
     """
     Clean data queried from restapis
@@ -73,11 +102,11 @@ def _clean_queried_data(
         gdf = _filter_queried_oklahoma_data_subsurface(gdf, activity_source=source)
         gdf = _get_ok_surface_town_range(gdf)
     elif "AZ" in source:
-        gdf = _get_az_town_range_section(gdf)
+        gdf = assign_trs(gdf, "AZ", source)
     elif "MT" in source:
-        gdf = _get_mt_town_range_section(gdf)
+        gdf = assign_trs(gdf, "MT", source)
     elif "OR" in source:
-        gdf = _get_or_town_range_section(gdf)
+        gdf = assign_trs(gdf, "OR", source)
     elif "UT" in source:
         gdf = _get_ut_activity(gdf, source)
     elif "ND" in source:
@@ -88,28 +117,39 @@ def _clean_queried_data(
     gdf = _format_columns(gdf, config, alias)
 
     if not gdf.empty:
-        filename = _get_filename(source, label, alias, ".geojson")
-        gdf.to_file(cleaned_data_directory + filename, driver="GeoJSON")
+        _write_cleaned_data(
+            gdf, source, label, alias, cleaned_data_directory, cleaned_format
+        )
 
     return gdf
 
 
-def _get_ok_activity(filtered_gdf, source):
+def _ok_activity_name(source):
     """
-    extract activity value from directory name
+    activity name from an OK source or csv name, ex: OK-surface-agricultural-lease -> Agricultural Lease
     """
     surface = "OK-surface-"
     subsurface = "OK-subsurface-"
     prefix = (surface in source and surface) or (subsurface in source and subsurface)
     if not prefix:
-        return filtered_gdf
+        return None
 
     source = Path(source).resolve().stem
     activity_name = source[len(prefix) :].replace("-", " ").replace("and", "&")
+    if not activity_name:
+        return None
+
+    return activity_name.title()
+
+
+def _get_ok_activity(filtered_gdf, source):
+    """
+    extract activity value from directory name
+    """
+    activity_name = _ok_activity_name(source)
     if not activity_name:
         return filtered_gdf
 
-    activity_name = activity_name.title()
     if ACTIVITY in filtered_gdf.columns:
         filtered_gdf[ACTIVITY] = filtered_gdf[ACTIVITY].map(lambda v: activity_name)
     else:
@@ -155,7 +195,14 @@ def _get_nd_activity(filtered_gdf, source, config):
 
 
 def _filter_and_clean_shapefile_or_geojson(
-    gdf, config, source, label, code, alias, cleaned_data_directory
+    gdf,
+    config,
+    source,
+    label,
+    code,
+    alias,
+    cleaned_data_directory,
+    cleaned_format="parquet",
 ):
     # adding projection info for wisconsin
     if source == "WI":
@@ -176,14 +223,14 @@ def _filter_and_clean_shapefile_or_geojson(
 
     # custom cleaning
     if source == "NE":
-        filtered_gdf = _get_ne_town_range_section(filtered_gdf)
+        filtered_gdf = assign_trs(filtered_gdf, "NE", source)
     elif source == "WI":
-        filtered_gdf = _get_wi_town_range_section_aliquot(filtered_gdf)
+        filtered_gdf = assign_trs(filtered_gdf, "WI", source)
     elif "MT" in source:
-        filtered_gdf = _get_mt_town_range_section(filtered_gdf)
+        filtered_gdf = assign_trs(filtered_gdf, "MT", source)
         # filtered_gdf = _get_mt_activity(filtered_gdf, source)
     elif "SD" in source:
-        filtered_gdf = _get_sd_town_range_meridian(filtered_gdf)
+        filtered_gdf = assign_trs(filtered_gdf, "SD", source)
         # filtered_gdf = _get_sd_rights_type(filtered_gdf)
     elif "SD-surface" in source:
         filtered_gdf = _get_sd_surface_rights_type(filtered_gdf)
@@ -210,8 +257,9 @@ def _filter_and_clean_shapefile_or_geojson(
     # if 'NM' in source:
     #     filtered_gdf = _clean_nm_town_range(filtered_gdf)
 
-    filename = _get_filename(source, label, alias, ".geojson")
-    filtered_gdf.to_file(cleaned_data_directory + filename, driver="GeoJSON")
+    _write_cleaned_data(
+        filtered_gdf, source, label, alias, cleaned_data_directory, cleaned_format
+    )
 
     return filtered_gdf
 
@@ -257,36 +305,6 @@ def _format_columns(gdf, config, alias):
     return gdf.drop(columns_to_drop, axis=1)
 
 
-def _get_az_town_range_section(gdf):
-    # arizona data has a 'trs' column which is composed of township, range, and section
-    # split by ' - ' so we expand this into three columns
-    split = gdf["trs"].str.split(" - ", expand=True)
-    gdf[TOWNSHIP] = split[0]
-    gdf[RANGE] = split[1]
-    gdf[SECTION] = split[2]
-    return gdf
-
-
-def _get_mt_town_range_section(gdf):
-    # mt data has a 'STRID' column which is composed of township, range, and section
-    # split by ' ' so we expand this into three columns
-    split = gdf["STRID"].str.split(" ", expand=True)
-    gdf[TOWNSHIP] = split[0]
-    gdf[RANGE] = split[1]
-    gdf[SECTION] = split[2]
-    return gdf
-
-
-def _get_ne_town_range_section(gdf):
-    # ne data has a 'STR' column which is composed of township, range, and section
-    # split by ' ' so we expand this into three columns
-    split = gdf["STR"].str.split("-", expand=True)
-    gdf[SECTION] = split[0]
-    gdf[TOWNSHIP] = split[1]
-    gdf[RANGE] = split[2]
-    return gdf
-
-
 # def _clean_nm_town_range(gdf):
 #     # nm section and range data has extra leading and trailing zeros in a funny way
 #     # # for example Range 11E is formatted 0110E. So we remove the extra zeros here.
@@ -314,45 +332,6 @@ def _get_ok_surface_town_range(gdf):
     return gdf
 
 
-def _get_ok_subsurface_town_range(gdf):
-    """
-    OK subsurface data has section, township, range and meridian together in a certain format
-    ex: "STRM": "31-09N-25EIM"
-    """
-    split = gdf["STRM"].str.split("-", expand=True)
-    gdf[SECTION] = split[0]
-    gdf[TOWNSHIP] = split[1]
-    gdf[RANGE] = split[2].str.slice(stop=3)
-    gdf[MERIDIAN] = split[2].str.slice(start=3, stop=4)
-    return gdf
-
-
-def _get_or_town_range_section(gdf):
-    """
-    data has a 'TRS' column which is composed of township, range, and section
-    but the format is wacky
-    """
-    trs = pd.DataFrame(gdf["TRS"].apply(split_trs).tolist())
-    gdf[TOWNSHIP] = trs[0]
-    gdf[RANGE] = trs[1]
-    gdf[SECTION] = trs[2]
-    return gdf
-
-
-def split_trs(trs):
-    section, township, range = "", "", ""
-    if len(trs) == 7:
-        township = trs[:3]
-        range = trs[3:5]
-        section = trs[5:]
-    else:
-        township = trs[:3]
-        range = trs[3:6]
-        section = trs[6:]
-
-    return township, range, section
-
-
 # def _get_ut_town_range_section_county(gdf):
 #     '''
 #     data has a 'TRS_LABEL' column which is composed of township, range, sectionm meridian
@@ -374,36 +353,6 @@ def split_trs(trs):
 #     return gdf
 
 
-def _get_wi_town_range_section_aliquot(gdf):
-    """
-    WI subsurface data has section, township, range and maliquot together in a certain format
-    under the 'PARCEL_DES' label
-    """
-    split = gdf["PARCEL_DES"].str.split(" ", expand=True)
-
-    gdf[SECTION] = split[6]
-    gdf[TOWNSHIP] = split[0].str.slice(start=1)
-    gdf[RANGE] = split[2].str.slice(start=1)
-    gdf[ALIQUOT] = split[9]
-    return gdf
-
-
-def _get_sd_town_range_meridian(gdf):
-    """
-    SD data has meridian, township, range together in a certain format in the PLSSID field
-    ex: "SD051130N0810W0": where the meridian is 5, township is 113N, range is 81W
-    """
-    gdf[MERIDIAN] = gdf["PLSSID"].str.slice(start=3, stop=4)
-    gdf[TOWNSHIP] = gdf["PLSSID"].str.slice(start=4, stop=7).str.strip("0") + gdf[
-        "PLSSID"
-    ].str.slice(start=8, stop=9)
-    gdf[RANGE] = gdf["PLSSID"].str.slice(start=9, stop=12).str.strip("0") + gdf[
-        "PLSSID"
-    ].str.slice(start=13, stop=14)
-
-    return gdf
-
-
 def _get_sd_surface_rights_type(gdf):
     """
     get and clean SD rights types to be consistent with the rest of the dataset
@@ -435,28 +384,101 @@ def clean_holding_detail_id(item):
     return item
 
 
-def _filter_queried_oklahoma_data(
-    gdf, data_source, activity_source=None, debug_activity_source=None
-):
-    filter_df = pd.read_csv(data_source)
+def _clean_holding_detail_ids(ids):
+    # change id from dictionary to string, like clean_holding_detail_id on the whole column at once
+    try:
+        text = pa.array(ids, type=pa.string(), from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return ids.str.replace("}", "").str.replace("{", "").astype(str)
+    text = pc.replace_substring(pc.replace_substring(text, "}", ""), "{", "")
+    cleaned = pd.Series(text.to_numpy(zero_copy_only=False), index=ids.index)
+    missing = ids.isna()
+    cleaned[missing] = ids[missing].astype(str)
+    return cleaned
 
-    # change id from dictionary to string
-    gdf[OK_HOLDING_DETAIL_ID] = gdf[OK_HOLDING_DETAIL_ID].str.replace("}", "")
-    gdf[OK_HOLDING_DETAIL_ID] = gdf[OK_HOLDING_DETAIL_ID].str.replace("{", "")
-    gdf[OK_HOLDING_DETAIL_ID] = gdf[OK_HOLDING_DETAIL_ID].astype(str)
 
-    # filter dataframe by specific ids
-    gdf = gdf[gdf[OK_HOLDING_DETAIL_ID].isin(filter_df[OK_HOLDING_DETAIL_ID])]
+# activity name each csv's rows take, when its name gives one
+_OK_ACTIVITY_NAME_COL = "_ok_activity_name"
+_OK_CSV_RANK_COL = "_ok_csv_rank"
+
+
+def _ok_csv_version(data_source):
+    # the csv with its mtime, so the tables cached from it are rebuilt when it changes
+    return data_source, os.stat(data_source).st_mtime_ns
+
+
+@functools.lru_cache(maxsize=8)
+def _ok_holding_details(csv_version):
+    """
+    an OK trust funds csv with one row per HoldingDetailID, read once per process and version of the
+    csv. ids are kept as pandas reads them, so the parcels' cleaned ids match the same rows as in a merge
+    against the csv itself.
+    """
+    data_source, _ = csv_version
+    details = pd.read_csv(data_source)
+    details[OK_HOLDING_DETAIL_ID] = details[OK_HOLDING_DETAIL_ID].astype(object)
+    return details.drop_duplicates([OK_HOLDING_DETAIL_ID], ignore_index=True)
+
 
-    df = gdf.merge(filter_df, on=OK_HOLDING_DETAIL_ID, how="left")
-    ex, why = "_x", "_y"
-    df.drop([c for c in df.columns if c.endswith(why)], inplace=True, axis=1)
-    df.rename(
-        columns={c: c.rstrip(ex) for c in df.columns if c.endswith(ex)}, inplace=True
+@functools.lru_cache(maxsize=8)
+def _ok_holding_detail_lookup(csv_versions, activity_sources):
+    """
+    the rows of the OK trust funds csvs, each with the activity name its activity_sources entry or else
+    the csv's name gives, if any, and its position among the csvs. built once per process for every
+    combination of csvs and their versions.
+    """
+    lookups = []
+    for rank, (csv_version, activity_source) in enumerate(
+        zip(csv_versions, activity_sources)
+    ):
+        data_source, _ = csv_version
+        lookups.append(
+            _ok_holding_details(csv_version).assign(
+                **{
+                    _OK_ACTIVITY_NAME_COL: _ok_activity_name(
+                        activity_source or data_source
+                    ),
+                    _OK_CSV_RANK_COL: rank,
+                }
+            )
+        )
+
+    return pd.concat(lookups, ignore_index=True)
+
+
+def _filter_queried_oklahoma_data(gdf, data_sources, activity_sources=None):
+    """
+    join the parcels of gdf to the rows holding them in each of the OK trust funds csvs of data_sources,
+    in a single join. a parcel held in several csvs appears once per csv, csv by csv, with that csv's
+    columns where the parcel has none of the same name, and the activity the csv's name gives.
+    """
+    activity_sources = activity_sources or (None,) * len(data_sources)
+    lookup = _ok_holding_detail_lookup(
+        tuple(_ok_csv_version(data_source) for data_source in data_sources),
+        tuple(activity_sources),
     )
-    df.drop_duplicates([OK_HOLDING_DETAIL_ID], inplace=True, ignore_index=True)
 
-    df = _get_ok_activity(df, activity_source or data_source)
+    gdf[OK_HOLDING_DETAIL_ID] = _clean_holding_detail_ids(gdf[OK_HOLDING_DETAIL_ID])
+
+    # the first parcel of every id; the parcels' columns win over the csvs' of the same name
+    parcels = gdf.drop_duplicates([OK_HOLDING_DETAIL_ID])
+    details = lookup[
+        [OK_HOLDING_DETAIL_ID]
+        + [c for c in lookup.columns if c not in parcels.columns]
+    ]
+
+    df = parcels.merge(details, on=OK_HOLDING_DETAIL_ID, how="inner")
+    df = df.sort_values(_OK_CSV_RANK_COL, kind="stable", ignore_index=True)
+
+    # the activity named by a csv's name replaces the one its rows had
+    activity_names = df.pop(_OK_ACTIVITY_NAME_COL)
+    if activity_names.notna().any():
+        df[ACTIVITY] = (
+            activity_names.where(activity_names.notna(), df[ACTIVITY])
+            if ACTIVITY in df.columns
+            else activity_names.astype(object).where(activity_names.notna(), np.nan)
+        )
+    df = df.drop(columns=[_OK_CSV_RANK_COL])
 
     gdf_out = gpd.GeoDataFrame(df, geometry=df.geometry, crs=gdf.crs)
 
@@ -464,35 +486,22 @@ def _filter_queried_oklahoma_data(
 
 
 def _filter_queried_oklahoma_data_surface(gdf):
-    # OK_TRUST_FUNDS_TO_HOLDING_DETAIL_FILE_SUB
     # OK_TRUST_FUNDS_TO_HOLDING_DETAIL_FILE_OSU
 
-    # filter dataframe by specific ids
-    gdf1 = _filter_queried_oklahoma_data(
+    # filter dataframe by the ids of every surface lease csv at once
+    return _filter_queried_oklahoma_data(
         gdf,
-        OK_TRUST_FUNDS_TO_HOLDING_DETAIL_FILE_SURF_1,
-        debug_activity_source="agricultural_lease",
+        (
+            OK_TRUST_FUNDS_TO_HOLDING_DETAIL_FILE_SURF_1,
+            OK_TRUST_FUNDS_TO_HOLDING_DETAIL_FILE_SURF_2,
+            OK_TRUST_FUNDS_TO_HOLDING_DETAIL_FILE_SURF_3,
+        ),
     )
-    gdf2 = _filter_queried_oklahoma_data(
-        gdf,
-        OK_TRUST_FUNDS_TO_HOLDING_DETAIL_FILE_SURF_2,
-        debug_activity_source="longterm_commercial_lease",
-    )
-    gdf3 = _filter_queried_oklahoma_data(
-        gdf,
-        OK_TRUST_FUNDS_TO_HOLDING_DETAIL_FILE_SURF_3,
-        debug_activity_source="shortterm_commercial_lease",
-    )
-
-    df = pd.concat([gdf1, gdf2, gdf3])
-    gdf_out = gpd.GeoDataFrame(df, geometry=df.geometry, crs=gdf.crs)
-
-    return gdf_out
 
 
 def _filter_queried_oklahoma_data_subsurface(gdf, activity_source):
     # filter dataframe by specific ids
     gdf_out = _filter_queried_oklahoma_data(
-        gdf, OK_TRUST_FUNDS_TO_HOLDING_DETAIL_FILE_SUB, activity_source=activity_source
+        gdf, (OK_TRUST_FUNDS_TO_HOLDING_DETAIL_FILE_SUB,), (activity_source,)
     )
     return gdf_out
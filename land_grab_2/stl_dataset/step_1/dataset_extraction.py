@@ -1,10 +1,20 @@
+import json
+import multiprocessing
 import os
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
 from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
 
 import geopandas as gpd
-import restapi
 
 from land_grab_2.stl_dataset.step_1.constants import (
+    DATA_SOURCE,
     DOWNLOAD_TYPE,
     SHAPEFILE_DOWNLOAD_TYPE,
     LOCAL_DATA_SOURCE,
@@ -13,19 +23,31 @@ from land_grab_2.stl_dataset.step_1.constants import (
     ATTRIBUTE_CODE_TO_ALIAS_MAP,
     API_QUERY_DOWNLOAD_TYPE,
     GEOJSON_TYPE,
+    STATE,
+)
+from land_grab_2.stl_dataset.step_1.arcgis_query import (
+    MANIFEST_DIR,
+    PAGE_CHECKPOINT_DIR,
+    PagedQuery,
+    features_by_code,
+    in_clause,
+    layer_fingerprint,
+    read_manifest,
+    write_manifest,
 )
 from land_grab_2.stl_dataset.step_1.dataset_cleaning import (
+    CLEANED_FILE_EXTENSIONS,
     _clean_queried_data,
     _filter_and_clean_shapefile_or_geojson,
 )
 from land_grab_2.utilities.utils import _get_filename
 
-os.environ["RESTAPI_USE_ARCPY"] = "FALSE"
+# downloads wait on the network, cleaning on the cpu
+STAGE_1_IO_WORKERS = int(os.environ.get("STAGE_1_IO_WORKERS", 8))
+STAGE_1_CPU_WORKERS = int(os.environ.get("STAGE_1_CPU_WORKERS", os.cpu_count() or 1))
 
 
-def extract_and_clean_single_source_helper(
-    source: str, config: dict, queried_data_directory: str, cleaned_data_directory: str
-):
+def _make_source_directories(queried_data_directory: str, cleaned_data_directory: str):
     # create the correct data directories
     if not os.path.exists(queried_data_directory):
         Path(queried_data_directory).mkdir(exist_ok=True, parents=True)
@@ -33,6 +55,29 @@ def extract_and_clean_single_source_helper(
     if not os.path.exists(cleaned_data_directory):
         Path(cleaned_data_directory).mkdir(exist_ok=True, parents=True)
 
+
+def download_single_source(source: str, config: dict, queried_data_directory: str):
+    """
+    query every (label, code) of a source from its restapi. other sources are read from disk when cleaned.
+    """
+    if config[DOWNLOAD_TYPE] != API_QUERY_DOWNLOAD_TYPE:
+        return
+
+    _query_arcgis_source(config, source, queried_data_directory)
+
+
+def clean_single_source(
+    source: str,
+    config: dict,
+    queried_data_directory: str,
+    cleaned_data_directory: str,
+    cleaned_format: Optional[str] = "parquet",
+) -> Dict[str, Union[gpd.GeoDataFrame, str]]:
+    """
+    clean every (label, code) of a source, from its queried files or its shapefile / geojson. returns
+    the non-empty cleaned data by cleaned geojson filename: the path it was written to, or the frame
+    itself when cleaned_format is None.
+    """
     # if downloading shapefile
     if config[DOWNLOAD_TYPE] == SHAPEFILE_DOWNLOAD_TYPE:
         gdf = gpd.read_file(config[LOCAL_DATA_SOURCE], layer=config.get(LAYER))
@@ -40,62 +85,206 @@ def extract_and_clean_single_source_helper(
     if config[DOWNLOAD_TYPE] == GEOJSON_TYPE:
         gdf = gpd.read_file(config[LOCAL_DATA_SOURCE])
 
+    cleaned = {}
     for label in config[ATTRIBUTE_LABEL_TO_FILTER_BY]:
         for code, alias in config[ATTRIBUTE_CODE_TO_ALIAS_MAP].items():
+            cleaned_gdf = None
             # if querying from rest api
             if config[DOWNLOAD_TYPE] == API_QUERY_DOWNLOAD_TYPE:
-                _query_arcgis_restapi(
-                    config, source, label, code, alias, queried_data_directory
-                )
-                _clean_queried_data(
+                cleaned_gdf = _clean_queried_data(
                     source,
                     config,
                     label,
                     alias,
                     queried_data_directory,
                     cleaned_data_directory,
+                    cleaned_format,
                 )
             # if cleaning a shapefile
             elif config[DOWNLOAD_TYPE] in [SHAPEFILE_DOWNLOAD_TYPE, GEOJSON_TYPE]:
-                _filter_and_clean_shapefile_or_geojson(
-                    gdf, config, source, label, code, alias, cleaned_data_directory
+                cleaned_gdf = _filter_and_clean_shapefile_or_geojson(
+                    gdf,
+                    config,
+                    source,
+                    label,
+                    code,
+                    alias,
+                    cleaned_data_directory,
+                    cleaned_format,
                 )
 
+            if cleaned_gdf is None or cleaned_gdf.empty:
+                continue
+            filename = _get_filename(source, label, alias, ".geojson")
+            if cleaned_format is None:
+                cleaned[filename] = cleaned_gdf
+            else:
+                cleaned[filename] = cleaned_data_directory + _get_filename(
+                    source, label, alias, CLEANED_FILE_EXTENSIONS[cleaned_format]
+                )
+
+    return cleaned
+
+
+def extract_and_clean_single_source_helper(
+    source: str, config: dict, queried_data_directory: str, cleaned_data_directory: str
+):
+    _make_source_directories(queried_data_directory, cleaned_data_directory)
+    download_single_source(source, config, queried_data_directory)
+    clean_single_source(source, config, queried_data_directory, cleaned_data_directory)
+
+
+def _timed(a_callable, *args):
+    start = time.perf_counter()
+    result = a_callable(*args)
+    return time.perf_counter() - start, result
+
 
-def _query_arcgis_restapi(config, source, label, code, alias, directory, regen=False):
+def extract_and_clean_sources(
+    sources: Dict[str, Tuple[dict, str, str]],
+    io_workers: int = STAGE_1_IO_WORKERS,
+    cpu_workers: int = STAGE_1_CPU_WORKERS,
+    cleaned_format: Optional[str] = "parquet",
+    cleaned: Optional[Dict[str, dict]] = None,
+) -> List[dict]:
     """
-    Query available arcgis restapi's with relevant filters
+    extract and clean many sources at once. sources maps each source to its (config, queried data
+    directory, cleaned data directory). restapi downloads run on a pool of io_workers threads and
+    cleaning on a pool of cpu_workers processes, so one source's download overlaps with others'
+    cleaning. a failing source is reported and does not stop the others. returns the timings of
+    every source.
+
+    cleaned data is written in cleaned_format, or not written at all when it is None. if cleaned is
+    given, it is filled with each state's cleaned data (see clean_single_source) for the merge.
     """
-    # create desired attribute conditions to filter the query by
-    attribute_filter = f"{label}={code}"
-
-    # create a descriptive filename to store query info
-    filename = _get_filename(source, label, alias, ".geojson")
-    if (
-        not regen
-        and Path(directory + filename).exists()
-        or Path(directory + filename.replace("geojson", "json")).exists()
-    ):
-        print(f"Found existing file on disk  for {source} + {attribute_filter}")
-        return
+    timings = {
+        source: {
+            "source": source,
+            "state": config[STATE],
+            "download_type": config[DOWNLOAD_TYPE],
+            "status": "ok",
+            "download_seconds": 0.0,
+            "clean_seconds": 0.0,
+            "error": None,
+        }
+        for source, (config, _, _) in sources.items()
+    }
 
-    # data_source for specific Map Server
-    data_source = config["data_source"]
-    layer = restapi.MapServiceLayer(data_source)
-
-    try:
-        # then filter by specific attributes
-        if code == "*":
-            features = layer.query(outSR=4326, f="geojson", exceed_limit=True)
-        else:
-            features = layer.query(
-                where=attribute_filter, outSR=4326, f="geojson", exceed_limit=True
+    # spawned workers never inherit the download threads' locks mid-use
+    with ThreadPoolExecutor(io_workers) as io_pool, ProcessPoolExecutor(
+        cpu_workers, mp_context=multiprocessing.get_context("spawn")
+    ) as cpu_pool:
+
+        def submit_clean(source):
+            config, queried_data_directory, cleaned_data_directory = sources[source]
+            future = cpu_pool.submit(
+                _timed,
+                clean_single_source,
+                source,
+                config,
+                queried_data_directory,
+                cleaned_data_directory,
+                cleaned_format,
             )
+            running[future] = (source, "clean")
+
+        running = {}
+        for source, (config, queried_data_directory, cleaned_data_directory) in sources.items():
+            _make_source_directories(queried_data_directory, cleaned_data_directory)
+            if config[DOWNLOAD_TYPE] == API_QUERY_DOWNLOAD_TYPE:
+                future = io_pool.submit(
+                    _timed, download_single_source, source, config, queried_data_directory
+                )
+                running[future] = (source, "download")
+            else:
+                submit_clean(source)
+
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                source, step = running.pop(future)
+                try:
+                    timings[source][f"{step}_seconds"], result = future.result()
+                except Exception as err:
+                    print(f"{source} failed to {step}: {err}")
+                    timings[source].update(status=f"{step}_failed", error=str(err))
+                    continue
+
+                print(f"{source}: {step} took {timings[source][f'{step}_seconds']:.1f}s")
+                if step == "download":
+                    submit_clean(source)
+                elif cleaned is not None:
+                    cleaned.setdefault(timings[source]["state"], {}).update(result)
 
-        # count the number of features
+    return list(timings.values())
+
+
+def print_source_timings(timings: List[dict]):
+    for t in sorted(
+        timings, key=lambda t: t["download_seconds"] + t["clean_seconds"], reverse=True
+    ):
+        print(
+            f'{t["source"]:<45} {t["status"]:<16} download {t["download_seconds"]:>8.1f}s '
+            f'clean {t["clean_seconds"]:>8.1f}s'
+        )
+    failed = [t["source"] for t in timings if t["status"] != "ok"]
+    if failed:
+        print(f"{len(failed)} sources failed: {failed}")
+
+
+def _query_arcgis_source(config, source, directory, regen=False):
+    """
+    Query a source's arcgis restapi once per label for all of its codes, fetching the result pages in
+    parallel, and split the features into one file per (label, code). Files on disk are kept as long
+    as the layer's metadata matches the manifest of their download.
+    """
+    codes = config[ATTRIBUTE_CODE_TO_ALIAS_MAP]
+    for label in config[ATTRIBUTE_LABEL_TO_FILTER_BY]:
+        # create a descriptive filename per code to store query info
+        filenames = {
+            code: _get_filename(source, label, alias, ".json")
+            for code, alias in codes.items()
+        }
+        stem = _get_filename(source, label, None, "")
+
+        # create desired attribute conditions to filter the query by
+        attribute_filter = in_clause(label, list(codes))
+
+        # check the layer for changes before downloading it again
+        manifest_path = Path(directory) / MANIFEST_DIR / f"{stem}.json"
+        files_exist = all(
+            Path(directory + filename).exists() for filename in filenames.values()
+        )
+        try:
+            fingerprint = layer_fingerprint(config[DATA_SOURCE], attribute_filter)
+        except Exception as err:
+            # offline, or a layer refusing count / extent queries: whether it changed is unknown
+            print(f"could not fingerprint {config[DATA_SOURCE]} for {attribute_filter}:\n{err}")
+            fingerprint = None
+        if not regen and files_exist:
+            if fingerprint is None:
+                print(f"Found existing files on disk for {source} + {attribute_filter}")
+                continue
+            if read_manifest(manifest_path) == fingerprint:
+                print(f"Unchanged since last download: {source} + {attribute_filter}")
+                continue
+
+        page_dir = Path(directory) / PAGE_CHECKPOINT_DIR / stem
+        query = PagedQuery(config[DATA_SOURCE], where=attribute_filter, page_dir=page_dir)
+        features = query.features()
         print(f"Found {len(features)} features with {attribute_filter}")
 
-        # save geojson file, may save as json depending on the esri api version, needs 10.3 to save as geojson
-        features.dump(directory + filename, indent=2)  # indent allows for pretty view
-    except Exception as err:
-        print(f"encountered error while querying {data_source}:\n{err}")
+        split = features_by_code(config[DATA_SOURCE], features, label, list(filenames), page_dir)
+        for code, filename in filenames.items():
+            code_features = split[code]
+            print(f"Found {len(code_features)} features with {label}={code}")
+            tmp_file = Path(directory + filename + f".{os.getpid()}.tmp")
+            tmp_file.write_text(
+                json.dumps({"type": "FeatureCollection", "features": code_features})
+            )
+            os.replace(tmp_file, directory + filename)
+
+        # the fingerprint from before the download, so edits made during it are fetched next time
+        if fingerprint is not None:
+            write_manifest(manifest_path, fingerprint)
+        query.done()
@@ -2,6 +2,7 @@ import itertools
 import os
 from collections import Counter, defaultdict
 from pathlib import Path
+from typing import Dict, Optional
 
 import geopandas
 import geopandas as gpd
@@ -11,9 +12,11 @@ from land_grab_2.stl_dataset.step_1.constants import ALL_STATES, ACTIVITY, FINAL
     GIS_ACRES, \
     ALBERS_EQUAL_AREA, WGS_84, ACRES_TO_SQUARE_METERS, ACRES, OBJECT_ID, TRUST_NAME, ATTRIBUTE_LABEL_TO_FILTER_BY, \
     ATTRIBUTE_CODE_TO_ALIAS_MAP, PARCEL_COUNT, ACRES_AGG
+from land_grab_2.stl_dataset.step_1.dataset_cleaning import CLEANED_FILE_EXTENSIONS
 from land_grab_2.stl_dataset.step_1.state_trust_config import STATE_TRUST_CONFIGS
 from land_grab_2.utilities.overlap import combine_dfs, fix_geometries
-from land_grab_2.utilities.utils import state_specific_directory, combine_delim_list, _get_filename
+from land_grab_2.utilities.utils import state_specific_directory, combine_delim_list, _get_filename, \
+    write_geoparquet
 
 os.environ['RESTAPI_USE_ARCPY'] = 'FALSE'
 
@@ -42,25 +45,6 @@ def _merge_dataframes(df_list):
     return merged
 
 
-def capture_matches(gdf, matches):
-    contained_dups = False
-    rows_to_be_deleted = set()
-    for match_score, grist_idx, grist_row, cmp_row, contains, cmp_idx in matches:
-        if contains and grist_row[TRUST_NAME] == cmp_row[TRUST_NAME] and grist_idx != cmp_idx:
-            contained_dups = True
-            rows_to_be_deleted.add(cmp_idx)
-            if ACTIVITY in cmp_row:
-                new_activity = cmp_row[ACTIVITY] or ''
-                existing = gdf.loc[grist_idx, ACTIVITY] or ''
-                gdf.loc[grist_idx, ACTIVITY] = combine_delim_list(existing, new_activity, sep=',')
-
-    gdf_rows = [r for i, r in enumerate(gdf.to_dict(orient='records')) if i not in rows_to_be_deleted]
-    df = pd.DataFrame(gdf_rows)
-    gdf = geopandas.GeoDataFrame(df, geometry=df.geometry, crs=gdf.crs)
-
-    return gdf, contained_dups
-
-
 def condense_activities(row):
     for col in row.keys().tolist():
         if ACTIVITY in col:
@@ -110,17 +94,42 @@ def dedup_group(group):
     return [gdf]
 
 
-def hydrate_cleaned(path):
-    gdf = gpd.read_file(path)
+def hydrate_cleaned(cleaned):
+    """
+    cleaned data as handed over by the cleaning step: a geojson or geoparquet path, or the frame itself
+    """
+    if isinstance(cleaned, gpd.GeoDataFrame):
+        gdf = cleaned
+    elif str(cleaned).endswith('.parquet'):
+        gdf = gpd.read_parquet(cleaned)
+    else:
+        gdf = gpd.read_file(cleaned)
     gdf[GIS_ACRES] = (gdf.to_crs(ALBERS_EQUAL_AREA).area / ACRES_TO_SQUARE_METERS).round(2)
     return gdf
 
 
+def find_cleaned(cleaned_data_directory) -> Dict[str, str]:
+    """
+    the cleaned data files of a state by their geojson filename; the newest file wins when the same
+    data was written in several formats
+    """
+    files = [f for f in Path(cleaned_data_directory).iterdir() if f.suffix in CLEANED_FILE_EXTENSIONS.values()]
+    return {f.with_suffix('.geojson').name: str(f) for f in sorted(files, key=lambda f: f.stat().st_mtime)}
+
+
 def merge_single_state_helper(state: str, cleaned_data_directory,
-                              merged_data_directory):
+                              merged_data_directory, cleaned: Optional[dict] = None, geojson: bool = False):
+    """
+    merge the cleaned data of a state, read from cleaned_data_directory unless handed over in cleaned
+    by geojson filename (see clean_single_source). the merged state is written as GeoParquet and csv,
+    and also exported as GeoJSON if geojson is set.
+    """
     if not os.path.exists(merged_data_directory):
         os.makedirs(merged_data_directory)
 
+    if cleaned is None:
+        cleaned = find_cleaned(cleaned_data_directory)
+
     combine_data = defaultdict(list)
     skip_dedup = defaultdict(list)
     state_sources = [source for source in STATE_TRUST_CONFIGS.keys() if state in source]
@@ -129,45 +138,43 @@ def merge_single_state_helper(state: str, cleaned_data_directory,
         for label in config[ATTRIBUTE_LABEL_TO_FILTER_BY]:
             for code, alias in config[ATTRIBUTE_CODE_TO_ALIAS_MAP].items():
                 if 'COMBINE_KEY' in config:
-                    clean_file = cleaned_data_directory + _get_filename(source, label, alias, '.geojson')
+                    clean_file = _get_filename(source, label, alias, '.geojson')
                     combine_data[config['COMBINE_KEY']].append(clean_file)
 
                 if 'SKIP_DEDUP' in config:
-                    clean_file = cleaned_data_directory + _get_filename(source, label, alias, '.geojson')
+                    clean_file = _get_filename(source, label, alias, '.geojson')
                     skip_dedup['SKIP_DEDUP'].append(clean_file)
 
     pre_merged = list(itertools.chain.from_iterable([
-        dedup_group([hydrate_cleaned(f) for f in files])
+        dedup_group([hydrate_cleaned(cleaned[f]) for f in files if f in cleaned])
         for files in combine_data.values()
     ]))
 
     dedup_skipped = list(itertools.chain.from_iterable([
-        [hydrate_cleaned(f) for f in files]
+        [hydrate_cleaned(cleaned[f]) for f in files if f in cleaned]
         for files in skip_dedup.values()
     ]))
 
-    pre_combined_data_refs = [Path(f).name
+    pre_combined_data_refs = [f
                               for files in list(combine_data.values()) + list(skip_dedup.values())
                               for f in files]
     combined_rights_type_gdfs = {'surface': [], 'subsurface': [], 'other': []}
     # find all cleaned datasets for the state
-    for file in os.listdir(cleaned_data_directory):
-        if file.endswith('.geojson'):
-            if file in pre_combined_data_refs:
-                continue
-
-            print(cleaned_data_directory + file)
-            gdf = hydrate_cleaned(cleaned_data_directory + file)
-
-            if not gdf.empty:
-                gdf = fix_geometries(gdf)
-                file_p = Path(file).resolve()
-                if 'subsurface' in file_p.name:
-                    combined_rights_type_gdfs['subsurface'].append(gdf)
-                elif 'surface' not in file_p.name:
-                    combined_rights_type_gdfs['other'].append(gdf)
-                else:
-                    combined_rights_type_gdfs['surface'].append(gdf)
+    for file in sorted(cleaned):
+        if file in pre_combined_data_refs:
+            continue
+
+        print(cleaned_data_directory + file)
+        gdf = hydrate_cleaned(cleaned[file])
+
+        if not gdf.empty:
+            gdf = fix_geometries(gdf)
+            if 'subsurface' in file:
+                combined_rights_type_gdfs['subsurface'].append(gdf)
+            elif 'surface' not in file:
+                combined_rights_type_gdfs['other'].append(gdf)
+            else:
+                combined_rights_type_gdfs['surface'].append(gdf)
 
     gdfs = pre_merged + dedup_skipped + list(itertools.chain.from_iterable([
         dedup_group(g)
@@ -189,27 +196,39 @@ def merge_single_state_helper(state: str, cleaned_data_directory,
     gdf = fix_geometries(gdf)
     gdf = gdf[final_column_order]
 
-    # save to geojson and csv
-    gdf.to_file(merged_data_directory + _get_merged_dataset_filename(state), driver='GeoJSON')
+    # save to geoparquet and csv
+    write_geoparquet(gdf, merged_data_directory + _get_merged_dataset_filename(state, '.parquet'))
     gdf.to_csv(merged_data_directory + _get_merged_dataset_filename(state, '.csv'))
 
-    # Additionally, export a version of the dataset in WGS84 for visualization.
-    gdf_wgs84 = gdf.to_crs(WGS_84)
-    gdf_wgs84.to_file(merged_data_directory + _get_merged_dataset_filename(state, crs="wgs84"), driver='GeoJSON')
+    if geojson:
+        gdf.to_file(merged_data_directory + _get_merged_dataset_filename(state), driver='GeoJSON')
+
+        # Additionally, export a version of the dataset in WGS84 for visualization.
+        gdf_wgs84 = gdf.to_crs(WGS_84)
+        gdf_wgs84.to_file(merged_data_directory + _get_merged_dataset_filename(state, crs="wgs84"),
+                          driver='GeoJSON')
 
     return gdf
 
 
-def merge_all_states_helper(cleaned_data_directory, merged_data_directory):
+def merge_all_states_helper(cleaned_data_directory, merged_data_directory, cleaned: Optional[dict] = None,
+                            geojson: bool = False):
+    """
+    merge every state's cleaned data, read from the state directories under cleaned_data_directory
+    unless handed over in cleaned by state (see extract_and_clean_sources). written as GeoParquet and
+    csv, and also exported as GeoJSON if geojson is set.
+    """
     state_datasets_to_merge = []
 
     # grab data from each state directory
-    for state in os.listdir(cleaned_data_directory):
+    states = sorted(cleaned if cleaned is not None else os.listdir(cleaned_data_directory))
+    for state in states:
         print(state)
         state_cleaned_data_directory = state_specific_directory(cleaned_data_directory, state)
-        if not Path(state_cleaned_data_directory).is_dir():
+        if cleaned is None and not Path(state_cleaned_data_directory).is_dir():
             continue
-        merged_state = merge_single_state_helper(state, state_cleaned_data_directory, merged_data_directory)
+        merged_state = merge_single_state_helper(state, state_cleaned_data_directory, merged_data_directory,
+                                                 cleaned[state] if cleaned is not None else None, geojson)
         if merged_state is None:
             continue
         merged_state = merged_state.to_crs(ALBERS_EQUAL_AREA)
@@ -226,12 +245,15 @@ def merge_all_states_helper(cleaned_data_directory, merged_data_directory):
     merged = merged[final_column_order]
     merged = fix_geometries(merged)
 
-    # save to geojson and csv
-    merged.to_file(merged_data_directory + _get_merged_dataset_filename(), driver='GeoJSON')
+    # save to geoparquet and csv
+    write_geoparquet(merged, merged_data_directory + _get_merged_dataset_filename(file_extension='.parquet'))
     merged.to_csv(merged_data_directory + _get_merged_dataset_filename(file_extension='.csv'))
 
-    # Additionally, create a version of the dataset in WGS84 for visualization.
-    merged_wgs84 = merged.to_crs(WGS_84)
-    merged_wgs84.to_file(merged_data_directory + _get_merged_dataset_filename(crs="wgs84"), driver='GeoJSON')
+    if geojson:
+        merged.to_file(merged_data_directory + _get_merged_dataset_filename(), driver='GeoJSON')
+
+        # Additionally, create a version of the dataset in WGS84 for visualization.
+        merged_wgs84 = merged.to_crs(WGS_84)
+        merged_wgs84.to_file(merged_data_directory + _get_merged_dataset_filename(crs="wgs84"), driver='GeoJSON')
 
     return merged
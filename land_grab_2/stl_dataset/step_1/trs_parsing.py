@@ -0,0 +1,150 @@
+"""
+Township, range and section parsing of the PLSS descriptions in state data.
+
+Every state writes its descriptions differently, so each format is a TrsSpec: the column holding the
+description, the patterns it is written in, whose named groups are the parsed parts, and how parts
+that are not output columns as they are make up the others. A whole column is parsed at once by
+pyarrow's RE2 kernels, so there is no python work per row.
+"""
+import re
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from land_grab_2.stl_dataset.step_1.constants import (
+    ALIQUOT,
+    MERIDIAN,
+    RANGE,
+    SECTION,
+    TOWNSHIP,
+)
+
+TRS_COLUMNS = [TOWNSHIP, RANGE, SECTION, MERIDIAN, ALIQUOT]
+TRS_DTYPE = "string[pyarrow]"
+# descriptions shown when reporting the rows that did not parse
+UNPARSED_EXAMPLES = 5
+
+
+@dataclass(frozen=True)
+class TrsSpec:
+    # column holding the description
+    column: str
+    # patterns the description may be written in, tried in order. they are run by RE2, so they take
+    # inline flags only and no lookarounds or backreferences
+    patterns: Tuple[re.Pattern, ...]
+    # output columns made up of other parts, as functions of the frame of parsed parts
+    derived: Dict[str, Callable[[pd.DataFrame], pd.Series]] = field(default_factory=dict)
+
+    @property
+    def columns(self) -> List[str]:
+        groups = {name for pattern in self.patterns for name in pattern.groupindex}
+        return [c for c in TRS_COLUMNS if c in groups or c in self.derived]
+
+
+def _split(sep: str, *names: str) -> re.Pattern:
+    """
+    the pattern of str.split(sep) keeping the named parts by position, like split(sep, expand=True)[i].
+    parts named None are skipped and parts past the last named one are ignored.
+    """
+    part = f"[^{re.escape(sep)}]*" if len(sep) == 1 else ".*?"
+    parts = [f"(?P<{name}>{part})" if name else part for name in names]
+    return re.compile(f"(?s)^{re.escape(sep).join(parts)}(?:{re.escape(sep)}.*)?$")
+
+
+def _number_and_direction(number: str, direction: str) -> Callable[[pd.DataFrame], pd.Series]:
+    # zero padded numbers, as in "0810W" for range 81W
+    return lambda parts: parts[number].str.lstrip("0") + parts[direction]
+
+
+TRS_SPECS = {
+    # township, range and section split by ' - '
+    "AZ": TrsSpec("trs", (_split(" - ", TOWNSHIP, RANGE, SECTION),)),
+    # township, range and section split by ' '
+    "MT": TrsSpec("STRID", (_split(" ", TOWNSHIP, RANGE, SECTION),)),
+    # section, township and range split by '-'
+    "NE": TrsSpec("STR", (_split("-", SECTION, TOWNSHIP, RANGE),)),
+    # township, range and section run together: seven characters have a two character range
+    "OR": TrsSpec(
+        "TRS",
+        (
+            re.compile(rf"(?s)^(?P<{TOWNSHIP}>.{{3}})(?P<{RANGE}>.{{2}})(?P<{SECTION}>.{{2}})$"),
+            re.compile(rf"(?s)^(?P<{TOWNSHIP}>.{{0,3}})(?P<{RANGE}>.{{0,3}})(?P<{SECTION}>.*)$"),
+        ),
+    ),
+    # words split by ' ': the township and range after the first letter of the first and third words,
+    # the section the seventh word and the aliquot the tenth
+    "WI": TrsSpec(
+        "PARCEL_DES",
+        (re.compile(rf"(?s)^[^ ]?(?P<{TOWNSHIP}>[^ ]*) [^ ]* [^ ]?(?P<{RANGE}>[^ ]*) [^ ]* [^ ]* [^ ]* (?P<{SECTION}>[^ ]*) [^ ]* [^ ]* (?P<{ALIQUOT}>[^ ]*)(?: .*)?$"),),
+    ),
+    # meridian, township and range at fixed positions, ex: "SD051130N0810W0" is meridian 5, township 113N
+    # and range 81W
+    "SD": TrsSpec(
+        "PLSSID",
+        (re.compile(rf"(?s)^.{{3}}(?P<{MERIDIAN}>.)(?P<township_number>.{{3}}).(?P<township_direction>.)(?P<range_number>.{{3}}).(?P<range_direction>.)"),),
+        {
+            TOWNSHIP: _number_and_direction("township_number", "township_direction"),
+            RANGE: _number_and_direction("range_number", "range_direction"),
+        },
+    ),
+}
+
+
+def _arrow_text(descriptions: pd.Series) -> pa.Array:
+    try:
+        return pa.array(descriptions, type=pa.string(), from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # numbers or other values among the strings
+        return pa.array(descriptions.astype("string"), type=pa.string(), from_pandas=True)
+
+
+def parse_trs(descriptions: pd.Series, spec: TrsSpec) -> Tuple[pd.DataFrame, pd.Series]:
+    """
+    parse a column of descriptions into the spec's typed township, range, section, meridian and aliquot
+    columns. returns them with the mask of the rows that matched none of the spec's patterns, whose
+    parts are missing.
+    """
+    text = _arrow_text(descriptions)
+    parts = {}
+    parsed = pa.array(np.zeros(len(text), dtype=bool))
+    for pattern in spec.patterns:
+        extracted = pc.extract_regex(text, pattern.pattern)
+        matched = pc.and_not(pc.is_valid(extracted), parsed)
+        for name, values in zip(pattern.groupindex, extracted.flatten()):
+            previous = parts.get(name, pa.nulls(len(text), pa.string()))
+            parts[name] = pc.if_else(matched, values, previous)
+        parsed = pc.or_(parsed, matched)
+
+    parts = pd.DataFrame(
+        {name: pd.Series(pd.arrays.ArrowStringArray(values), index=descriptions.index)
+         for name, values in parts.items()},
+        index=descriptions.index,
+    )
+    for column, derive in spec.derived.items():
+        parts[column] = derive(parts).astype(TRS_DTYPE)
+
+    unparsed = pd.Series(pc.invert(parsed).to_numpy(zero_copy_only=False), index=descriptions.index)
+    return parts[spec.columns], unparsed
+
+
+def assign_trs(gdf, spec_name: str, source: str = None):
+    """
+    set the township, range, section, meridian and aliquot columns of gdf that spec_name describes,
+    reporting the rows whose description did not parse
+    """
+    spec = TRS_SPECS[spec_name]
+    trs, unparsed = parse_trs(gdf[spec.column], spec)
+    for column in trs.columns:
+        gdf[column] = trs[column]
+
+    if unparsed.any():
+        examples = gdf.loc[unparsed, spec.column].drop_duplicates().head(UNPARSED_EXAMPLES).tolist()
+        print(
+            f"{source or spec_name}: {unparsed.sum()} of {len(gdf)} {spec.column} values did not parse "
+            f"as {spec_name} township / range / section, e.g. {examples}"
+        )
+    return gdf
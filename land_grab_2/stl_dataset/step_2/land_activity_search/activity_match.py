@@ -1,28 +1,66 @@
 import logging
 import os
 import sys
+import time
 import traceback
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from functools import partial
 from pathlib import Path
 
-import geopandas
 import numpy as np
 import pandas as pd
+import shapely
 
 from land_grab_2.stl_dataset.step_1.constants import (
     ACTIVITY,
+    OBJECT_ID,
     RIGHTS_TYPE,
     STATE,
     WGS_84,
 )
+from land_grab_2.stl_dataset.step_2.land_activity_search.checkpoints import (
+    MatchCheckpoints,
+    activity_config_digest,
+    frame_digest,
+)
+from land_grab_2.stl_dataset.step_2.land_activity_search.deep_dive import (
+    MATCHED_PARCEL_COL,
+    reset_deep_dive,
+    write_deep_dive_part,
+)
+from land_grab_2.stl_dataset.step_2.land_activity_search.entities import (
+    LAYER_ROW_INDEX,
+    LOAD_SOURCE_ATTR,
+    StateActivityDataLocation,
+    local_layer_fingerprint,
+)
 from land_grab_2.stl_dataset.step_2.land_activity_search.state_data_sources import (
     STATE_ACTIVITIES,
     REWRITE_RULES,
 )
-from land_grab_2.utilities.overlap import tree_based_proximity, geometric_deduplication
-from land_grab_2.utilities.utils import GristCache, in_parallel, combine_delim_list
+from land_grab_2.stl_dataset.step_2.land_activity_search.scheduler import (
+    plan_activity_tasks,
+    run_tasks,
+)
+from land_grab_2.stl_dataset.step_2.land_activity_search.telemetry import (
+    StageTelemetry,
+    finish_activity_metrics,
+    start_activity_metrics,
+)
+from land_grab_2.utilities.overlap import (
+    TILE_ROW_COL,
+    TILED_MATCH_MIN_FEATURES,
+    tree_based_proximity,
+    tile_proximity,
+    merge_tile_matches,
+    geometric_deduplication,
+    MatchSet,
+    SharedParcels,
+    TiledLayer,
+)
+from land_grab_2.utilities.utils import GristCache, read_geodata, write_geoparquet
 
 logging.basicConfig(level=logging.ERROR)
 log = logging.getLogger(__name__)
@@ -61,8 +99,24 @@ DONT_USE_COLS = [
     "ALL_LESSEE",
 ]
 
+OUT_NAME = "stl_dataset_extra_activities"
+
 GRIST_DATA_UPDATE = defaultdict(set)
-ACTIVITY_DATA_UPDATE = []
+
+# per-row columns added to each activity layer by annotate_activity_layer
+ACTIVITY_NAME_COL = "__activity_name"
+IS_SUBSURFACE_COL = "__is_subsurface"
+IS_INACTIVE_COL = "__is_inactive"
+ANNOTATION_COLS = [ACTIVITY_NAME_COL, IS_SUBSURFACE_COL, IS_INACTIVE_COL]
+
+# parcels match activity features whose envelope is within this distance of their boundary
+MATCH_DIST_THRESHOLD = 2.0
+
+ACTIVITY_NAME_REWRITES = {
+    "OtherMin": "Other Minerals",
+    "OilGas": "Oil & Gas",
+    "OilAndGas": "Oil & Gas",
+}
 
 AZ_KEY = {
     "0": "Unleased Parcels",
@@ -306,23 +360,26 @@ def translate_state_activity_code(activity_name):
 
 
 def get_activity_name(state, activity, activity_row):
+    """
+    activity_row is a mapping of column name to value for a single activity feature
+    """
     activity_name = None
     appendage_col_value = None
 
     if activity.use_name_as_activity and activity.activity_name_appendage_col:
         col_val = activity_row[activity.activity_name_appendage_col]
-        if col_val.values[0]:
+        if col_val:
             activity_name = activity.name
-            appendage_col_value = col_val.values[0]
+            appendage_col_value = col_val
 
     if activity_name is None:
         possible_activity_cols = get_activity_column(activity, state)
         if possible_activity_cols is not None:
             for activity_col in possible_activity_cols:
                 if activity_col and activity_col in activity_row.keys():
-                    activity_name_row = activity_row[activity_col].tolist()
-                    if any(activity_name_row):
-                        activity_name = str(activity_name_row[0])
+                    activity_name_value = activity_row[activity_col]
+                    if activity_name_value:
+                        activity_name = str(activity_name_value)
                         if "None" in activity_name:
                             activity_name = None
                             continue
@@ -343,11 +400,120 @@ def get_activity_name(state, activity, activity_row):
     return activity_name if activity_name else activity.name
 
 
+def get_activity_name_columns(state, activity):
+    """
+    the columns of an activity layer that get_activity_name reads
+    """
+    cols = []
+    if activity.use_name_as_activity and activity.activity_name_appendage_col:
+        cols.append(activity.activity_name_appendage_col)
+
+    cols += [c for c in (get_activity_column(activity, state) or []) if c]
+    return list(dict.fromkeys(cols))
+
+
+def get_status_column(activity_data):
+    return next((c for c in activity_data.columns if "stat" in c), None)
+
+
+def get_activity_rewrite_rules(state, activity):
+    state_rules = REWRITE_RULES.get(state.lower(), {})
+    return (
+        state_rules.get(activity.name.lower()) or state_rules.get(activity.name) or {}
+    )
+
+
+def get_activity_layer_columns(state, activity, fields):
+    """
+    the attribute columns of a layer matching reads: its rewrite rule columns, the columns
+    get_activity_name reads, keep_cols and the status column. fields keeps the layer's order.
+    """
+    rewrite_rules = get_activity_rewrite_rules(state, activity)
+    wanted = (
+        set(rewrite_rules)
+        | set(get_activity_name_columns(state, activity))
+        | set(activity.keep_cols)
+    )
+    status_col = next((c for c in fields if "stat" in c), None)
+    if status_col:
+        wanted.add(status_col)
+
+    return [c for c in fields if c in wanted]
+
+
+def get_parcel_extent(parcel_indexes, buffer=0.0):
+    """
+    bounds of the parcels of parcel_indexes, grown by buffer on every side
+    """
+    bounds = shapely.total_bounds(
+        np.concatenate([parcel_index.geometries for parcel_index in parcel_indexes])
+    )
+    return (
+        bounds[0] - buffer,
+        bounds[1] - buffer,
+        bounds[2] + buffer,
+        bounds[3] + buffer,
+    )
+
+
+def annotate_activity_layer(state, activity, activity_data):
+    """
+    resolve the activity name, subsurface classification and inactive status of every
+    feature of a layer once, as columns, so that matching only has to read them
+    """
+    status_col = get_status_column(activity_data)
+
+    name_cols = [
+        c
+        for c in get_activity_name_columns(state, activity)
+        if c in activity_data.columns
+    ]
+    if name_cols:
+        # names only depend on these columns, so resolve each distinct combination once.
+        # grouping also on the value types keeps e.g. None apart from NaN and 5 apart from 5.0
+        group_keys = [activity_data[c] for c in name_cols] + [
+            activity_data[c].map(type)
+            for c in name_cols
+            if activity_data[c].dtype == object
+        ]
+        codes = (
+            activity_data.groupby(group_keys, dropna=False, sort=False)
+            .ngroup()
+            .to_numpy()
+        )
+        _, first_rows = np.unique(codes, return_index=True)
+        names = [
+            get_activity_name(state, activity, row)
+            for row in activity_data[name_cols]
+            .iloc[first_rows]
+            .to_dict(orient="records")
+        ]
+        activity_names = np.asarray(names, dtype=object)[codes]
+    else:
+        activity_names = np.full(
+            len(activity_data), get_activity_name(state, activity, {}), dtype=object
+        )
+
+    activity_names = pd.Series(activity_names, index=activity_data.index).replace(
+        ACTIVITY_NAME_REWRITES
+    )
+
+    activity_data = activity_data.copy()
+    activity_data[ACTIVITY_NAME_COL] = activity_names
+    activity_data[IS_SUBSURFACE_COL] = activity_names.map(is_subsurface_activity)
+    activity_data[IS_INACTIVE_COL] = (
+        activity_data[status_col] != "Active"
+        if status_col and ("MT" in state or "ID" in state)
+        else False
+    )
+    return activity_data
+
+
 def is_subsurface_activity(activity_name):
     return MISC_KEY.get(activity_name, "surface") == "subsurface"
 
 
-def is_incompatible_activity(grist_row, activity, activity_name, state):
+def is_incompatible_activity(grist_row, activity, is_subsurface, state):
     if grist_row[STATE] == "WA" and grist_row[RIGHTS_TYPE] == "timber":
         return True
 
@@ -357,7 +523,7 @@ def is_incompatible_activity(grist_row, activity, activity_name, state):
 
         if activity.is_misc:
             if (
-                is_subsurface_activity(activity_name)
+                is_subsurface
                 and grist_row[RIGHTS_TYPE] in restricted_rights_types_for_surface
             ):
                 return True
@@ -383,73 +549,249 @@ def is_incompatible_activity(grist_row, activity, activity_name, state):
         return True
 
 
-def exclude_inactive(state, activity_row):
-    if "MT" in state or "ID" in state:
-        status_col = next((c for c in activity_row.keys() if "stat" in c), None)
-        if status_col and activity_row[status_col] != "Active":
-            return True
+def is_compatible_rights_type(state, rights_type, activity):
+    """
+    the part of is_incompatible_activity that only depends on the parcel's rights type,
+    used to decide up front which parcel partitions an activity layer is matched against
+    """
+    if state == "WA" and rights_type == "timber":
+        return False
 
-    return False
+    if activity.is_misc and rights_type == "subsurface":
+        return False
 
+    if activity.is_restricted_activity and rights_type == "subsurface":
+        return False
 
-def capture_matches(matches, state, activity):
-    rewrite_list = {
-        "OtherMin": "Other Minerals",
-        "OilGas": "Oil & Gas",
-        "OilAndGas": "Oil & Gas",
-    }
+    if activity.is_restricted_subsurface_activity and rights_type == "surface":
+        return False
+
+    return True
+
+
+PARCEL_PARTITION_COLS = [STATE, RIGHTS_TYPE]
+
+
+def get_state_positions(shared_parcels, state):
+    """
+    sorted row positions of a state's parcels within the full parcel dataset
+    """
+    positions = [
+        positions
+        for key, positions in shared_parcels.partitions(PARCEL_PARTITION_COLS).items()
+        if key[0] == state
+    ]
+    return np.sort(np.concatenate(positions)) if positions else np.array([], dtype=int)
+
+
+def compatible_parcel_indexes(shared_parcels, state, activity):
+    """
+    one ParcelIndex per (state, rights type) partition the activity layer may match against
+    """
+    return [
+        shared_parcels.parcel_index(PARCEL_PARTITION_COLS, key)
+        for key in shared_parcels.partitions(PARCEL_PARTITION_COLS).keys()
+        if key[0] == state and is_compatible_rights_type(state, key[1], activity)
+    ]
+
+
+def capture_matches(matches, state, activity, grist_data, activity_data, metrics=None):
+    """
+    activity_data must already carry the columns added by annotate_activity_layer. returns the activity
+    names to add per parcel position and the matched features, one row per accepted match, tagged with
+    the parcel's object_id when grist_data has one.
+    when given, metrics is filled with how many matches were accepted and why the others were not.
+    """
     total = 0
 
     does_contain = 0
+    incompatible = 0
     grist_data_update = defaultdict(set)
-    activity_data_update = []
-    for match_score, grist_idx, grist_row, activity_row, contains, _ in matches:
-        activity_name = get_activity_name(state, activity, pd.DataFrame([activity_row]))
-
-        if activity_name is None or "None" in activity_name:
-            # N.B. for debugging purposes only, otherwise essentially a no-op.
-            activity_name = get_activity_name(
-                state, activity, pd.DataFrame([activity_row])
-            )
-
-        if activity_name in rewrite_list:
-            activity_name = rewrite_list[activity_name]
-
+    matched_activity_idx = []
+    matched_grist_idx = []
+    grist_states = grist_data[STATE].to_numpy()
+    grist_rights_types = grist_data[RIGHTS_TYPE].to_numpy()
+    activity_names = activity_data[ACTIVITY_NAME_COL].to_numpy()
+    is_subsurface = activity_data[IS_SUBSURFACE_COL].to_numpy()
+    is_inactive = activity_data[IS_INACTIVE_COL].to_numpy()
+    for grist_idx, activity_idx, contains in zip(
+        matches.parcel_idx.tolist(),
+        matches.other_idx.tolist(),
+        matches.contains.tolist(),
+    ):
         total += 1
+        grist_row = {
+            STATE: grist_states[grist_idx],
+            RIGHTS_TYPE: grist_rights_types[grist_idx],
+        }
         if contains and not is_incompatible_activity(
-            grist_row, activity, activity_name, state
+            grist_row, activity, is_subsurface[activity_idx], state
         ):
             does_contain += 1
-            if exclude_inactive(state, activity_row):
+            if is_inactive[activity_idx]:
                 continue
 
-            grist_data_update[grist_idx].add(activity_name)
-            activity_data_update.append(activity_row)
+            grist_data_update[grist_idx].add(activity_names[activity_idx])
+            matched_activity_idx.append(activity_idx)
+            matched_grist_idx.append(grist_idx)
+        elif contains:
+            incompatible += 1
+
+    matched_activities = (
+        activity_data.iloc[matched_activity_idx]
+        .drop(columns=ANNOTATION_COLS)
+        .reset_index(drop=True)
+    )
+    if OBJECT_ID in grist_data.columns:
+        matched_activities.insert(
+            0, MATCHED_PARCEL_COL, grist_data[OBJECT_ID].to_numpy()[matched_grist_idx]
+        )
+
+    if metrics is not None:
+        metrics["matched_pairs"] = total
+        metrics["accepted_matches"] = len(matched_activity_idx)
+        metrics["rejected_incompatible"] = incompatible
+        metrics["rejected_inactive"] = does_contain - len(matched_activity_idx)
 
-    return grist_data_update, activity_data_update
+    return grist_data_update, matched_activities
 
 
-def find_overlaps(state, activity, activity_data, grist_data):
+def find_overlaps(state, activity, activity_data, shared_parcels, metrics=None):
     try:
-        matches = tree_based_proximity(
-            grist_data.to_dict(orient="records"), activity_data, grist_data.crs
+        start = time.perf_counter()
+        parcel_indexes = compatible_parcel_indexes(shared_parcels, state, activity)
+        if parcel_indexes:
+            crs = parcel_indexes[0].crs
+            activity_data = (
+                activity_data.set_crs(crs, allow_override=True)
+                if not activity_data.crs
+                else activity_data.to_crs(crs)
+            )
+
+        activity_data = annotate_activity_layer(state, activity, activity_data)
+        # features of a bbox read are batched by their rows in the whole layer, as in a full read
+        other_rows = (
+            activity_data.index.to_numpy()
+            if activity_data.index.name == LAYER_ROW_INDEX
+            else None
         )
-        grist_update_thus_far, activity_update_thus_far = capture_matches(
-            matches, state, activity
+        matches = MatchSet.concat(
+            tree_based_proximity(
+                parcel_index,
+                activity_data,
+                parcel_index.crs,
+                MATCH_DIST_THRESHOLD,
+                other_rows=other_rows,
+            )
+            for parcel_index in parcel_indexes
         )
-        return grist_update_thus_far, activity_update_thus_far
+        grist_update_thus_far, matched_activities = capture_matches(
+            matches, state, activity, shared_parcels.attributes(), activity_data, metrics
+        )
+        if metrics is not None:
+            metrics["candidate_pairs"] = matches.candidate_pairs
+            metrics["match_seconds"] = time.perf_counter() - start
+        return grist_update_thus_far, matched_activities
     except Exception as err:
         print(traceback.format_exc())
         print(f"failing on mysterious except in find_overlaps()")
 
 
+def find_overlaps_tiled(state, activity, tiled_layer, shared_parcels, metrics=None):
+    """
+    find_overlaps over a TiledLayer, reading one tile at a time. each tile is matched against the
+    parcels near it and only the features of its best matches are kept, so memory is bounded by the
+    size of a tile and the number of matches rather than the size of the layer.
+    """
+    try:
+        start = time.perf_counter()
+        parcel_indexes = compatible_parcel_indexes(shared_parcels, state, activity)
+        tile_matches = [[] for _ in parcel_indexes]
+        matched_features = []
+        for tile in tiled_layer:
+            tile = annotate_activity_layer(state, activity, tile)
+            rows = tile[TILE_ROW_COL].to_numpy()
+            geometries = tile.geometry.to_numpy()
+            matched_rows = []
+            for parcel_index, matches in zip(parcel_indexes, tile_matches):
+                tile_match = tile_proximity(
+                    parcel_index, geometries, rows, MATCH_DIST_THRESHOLD
+                )
+                matches.append(tile_match)
+                matched_rows.append(tile_match.other_idx)
+
+            # rows are ascending within a tile, so they locate the matched features
+            matched_rows = np.unique(np.concatenate(matched_rows))
+            matched_features.append(
+                tile.iloc[np.searchsorted(rows, matched_rows)].set_index(TILE_ROW_COL)
+            )
+
+        matches = MatchSet.concat(merge_tile_matches(m) for m in tile_matches)
+        activity_data = pd.concat(matched_features).sort_index()
+        # other_idx are layer rows; capture_matches reads features by position
+        matches.other_idx = np.searchsorted(
+            activity_data.index.to_numpy(), matches.other_idx
+        )
+        result = capture_matches(
+            matches,
+            state,
+            activity,
+            shared_parcels.attributes(),
+            activity_data,
+            metrics,
+        )
+        if metrics is not None:
+            metrics["candidate_pairs"] = matches.candidate_pairs
+            metrics["match_seconds"] = time.perf_counter() - start
+        return result
+    except Exception as err:
+        print(traceback.format_exc())
+        print(f"failing on mysterious except in find_overlaps_tiled()")
+
+
 def process_state_activity(
     stl_comparison_base_dir,
-    grist_data,
+    shared_parcels,
     activity_state,
     activity_info,
     cache_dir,
     activity,
+    deep_dive_dir=None,
+):
+    """
+    match one activity layer against a state's parcels. returns the activity names to add per parcel
+    position, or None, together with the telemetry record of the work done. the matched features are
+    written to the deep-dive dataset in deep_dive_dir, when given, rather than returned.
+    """
+    metrics = start_activity_metrics(activity_state, activity)
+    result = _process_state_activity(
+        stl_comparison_base_dir,
+        shared_parcels,
+        activity_state,
+        activity_info,
+        cache_dir,
+        activity,
+        metrics,
+    )
+    if result is None:
+        return None, finish_activity_metrics(metrics)
+
+    if metrics["source"] is None:
+        metrics["source"] = "checkpoint"
+    grist_update, matched_activities = result
+    if deep_dive_dir is not None:
+        write_deep_dive_part(deep_dive_dir, activity_state, activity, matched_activities)
+    return grist_update, finish_activity_metrics(metrics)
+
+
+def _process_state_activity(
+    stl_comparison_base_dir,
+    shared_parcels,
+    activity_state,
+    activity_info,
+    cache_dir,
+    activity,
+    metrics,
 ):
     GristCache(
         "", cache_dir
@@ -461,113 +803,286 @@ def process_state_activity(
         activity.use_cache = activity_info.use_cache
 
     try:
-        activity_data = activity.query_data(stl_comparison_base_dir)
+        parcel_indexes = compatible_parcel_indexes(
+            shared_parcels, activity_state, activity
+        )
+        if not parcel_indexes:
+            log.info(f"NO COMPATIBLE PARCELS FOR {activity_state} {activity.name}")
+            metrics["status"] = "no_parcels"
+            return
+
+        # matches only change when the layer, its configuration or the state's parcels do
+        checkpoints = MatchCheckpoints(cache_dir)
+        state_positions = get_state_positions(shared_parcels, activity_state)
+        state_digest = shared_parcels.digest(state_positions, key=activity_state)
+        config_digest = activity_config_digest(
+            activity, get_activity_rewrite_rules(activity_state, activity)
+        )
+
+        # only read the columns matching uses and the features near this state's parcels
+        read_kwargs = {}
+        checkpoint_key = None
+        if activity.loc_type == StateActivityDataLocation.LOCAL:
+            read_kwargs = dict(
+                columns=get_activity_layer_columns(
+                    activity_state,
+                    activity,
+                    activity.local_fields(stl_comparison_base_dir),
+                ),
+                bbox=get_parcel_extent(parcel_indexes, MATCH_DIST_THRESHOLD),
+            )
+            checkpoint_key = MatchCheckpoints.key(
+                local_layer_fingerprint(activity.local_path(stl_comparison_base_dir)),
+                state_digest,
+                config_digest,
+            )
+            if activity.use_cache:
+                result = checkpoints.read(
+                    activity_state, activity.name, checkpoint_key, state_positions
+                )
+                if result is not None:
+                    return checkpoint_hit(metrics, result)
+
+        load_start = time.perf_counter()
+        tiled = (
+            activity.loc_type == StateActivityDataLocation.LOCAL
+            and activity.local_feature_count(stl_comparison_base_dir)
+            >= TILED_MATCH_MIN_FEATURES
+        )
+        activity_data = None
+        if tiled:
+            activity_data = activity.load_local_tiled(
+                stl_comparison_base_dir, shared_parcels.crs, **read_kwargs
+            )
+        if activity_data is None:
+            activity_data = activity.query_data(
+                stl_comparison_base_dir, shared_parcels.crs, **read_kwargs
+            )
+        metrics["load_seconds"] = time.perf_counter() - load_start
         if activity_data is None or len(activity_data) == 0:
             log.error(f"NO ACTIVITY DATA FOR {activity_state} {activity.name}")
+            metrics["status"] = "no_data"
+            return
+
+        metrics["source"] = activity_data.attrs.get(
+            LOAD_SOURCE_ATTR, activity.loc_type.value
+        )
+        metrics["feature_count"] = len(activity_data)
+
+        if checkpoint_key is None:
+            # remote layers are only known once fetched (from their own cache, usually)
+            checkpoint_key = MatchCheckpoints.key(
+                frame_digest(activity_data), state_digest, config_digest
+            )
+            if activity.use_cache:
+                result = checkpoints.read(
+                    activity_state, activity.name, checkpoint_key, state_positions
+                )
+                if result is not None:
+                    return checkpoint_hit(metrics, result)
+
+        matcher = (
+            find_overlaps_tiled if isinstance(activity_data, TiledLayer) else find_overlaps
+        )
+        result = matcher(
+            activity_state, activity, activity_data, shared_parcels, metrics
+        )
+        if result is None:
+            metrics["status"] = "error"
             return
 
-        return find_overlaps(activity_state, activity, activity_data, grist_data)
+        checkpoints.write(
+            activity_state, activity.name, checkpoint_key, state_positions, result
+        )
+        return result
     except Exception as err:
         print(traceback.format_exc())
         print(f"random err: {err}")
+        metrics["status"] = "error"
 
 
-def match_all_activities(stl_comparison_base_dir, states_data=None, grist_data=None):
+def checkpoint_hit(metrics, result):
+    metrics["status"] = "checkpoint"
+    metrics["accepted_matches"] = len(result[1])
+    return result
+
+
+def process_activity_task(
+    stl_comparison_base_dir, shared_parcels, cache_dir, deep_dive_dir, task
+):
+    return process_state_activity(
+        stl_comparison_base_dir,
+        shared_parcels,
+        task.state,
+        task.activity_info,
+        cache_dir,
+        task.activity,
+        deep_dive_dir,
+    )
+
+
+def match_all_activities(
+    stl_comparison_base_dir,
+    states_data=None,
+    shared_parcels=None,
+    telemetry=None,
+    deep_dive_dir=None,
+):
     log.info(f"processing states {states_data.keys()}")
-    global GRIST_DATA_UPDATE, ACTIVITY_DATA_UPDATE, MEMORY
-
-    # process_stated_cached = MEMORY.cache(process_state_activity)
-
-    for activity_state, activity_info in states_data.items():
-        print(f"state: {activity_state} activity: {activity_info.name}")
-        if not activity_info:
-            log.error(f"NO ACTIVITY CONFIG FOR {activity_state}")
-            continue
-        st = datetime.now()
-        grist_results = in_parallel(
-            activity_info.activities,
-            partial(
-                process_state_activity,
-                stl_comparison_base_dir,
-                grist_data,
-                activity_state,
-                activity_info,
-                CACHE_DIR,
-            ),
-            show_progress=True,
-            # scheduler='synchronous',  # TODO debug only
-            batched=False,
+    global GRIST_DATA_UPDATE, MEMORY
+
+    # one queue over the layers of every state, largest first, so a state's one huge layer
+    # overlaps with the rest of the run instead of holding it up
+    tasks = plan_activity_tasks(stl_comparison_base_dir, states_data)
+    st = datetime.now()
+    results = run_tasks(
+        tasks,
+        partial(
+            process_activity_task,
+            stl_comparison_base_dir,
+            shared_parcels,
+            CACHE_DIR,
+            deep_dive_dir,
+        ),
+    )
+    for done, (task, (r, metrics)) in enumerate(results, start=1):
+        print(
+            f"[{done}/{len(tasks)}] state: {task.state} activity: {task.activity.name} "
+            f"took: {metrics['wall_seconds']:.1f}s"
         )
-        print(f"activity_state {activity_state} took: {datetime.now() - st}")
+        if telemetry is not None:
+            metrics["estimated_features"] = task.features
+            telemetry.record(metrics)
+        if r is not None and len(r) > 0:
+            for k, v in r.items():
+                if any(i is None for i in v):
+                    print(f"Activity is None for state: {task.state}")
+                    sys.exit(1)
+                GRIST_DATA_UPDATE[k].update(v)
+    print(f"matching all activities took: {datetime.now() - st}")
+
+
+def merge_activity_updates(gdf, grist_data_update):
+    """
+    add the matched activity names of every parcel (by row position) to its ACTIVITY column, as the
+    sorted, de-duplicated, comma-delimited union with the names already there
+    """
+    if ACTIVITY not in gdf.columns:
+        gdf[ACTIVITY] = pd.Series(np.nan, index=gdf.index, dtype=object)
+    elif gdf[ACTIVITY].dtype != object:
+        # e.g. a column read back with no values at all
+        gdf[ACTIVITY] = gdf[ACTIVITY].astype(object)
+    if not grist_data_update:
+        return gdf
+
+    positions = np.fromiter(grist_data_update.keys(), dtype=int, count=len(grist_data_update))
+    new_names = pd.Series(
+        [",".join(x for x in names if x is not None) for names in grist_data_update.values()],
+        index=positions,
+        dtype=object,
+    )
+
+    existing = pd.Series(gdf[ACTIVITY].to_numpy()[positions], index=positions, dtype=object)
+    existing = existing.where(existing.map(bool) & existing.notna(), "").astype(str)
+
+    # same rules as combine_delim_list: a value of just "nan" counts as empty
+    names = pd.concat([new_names, existing])
+    names = names[names != "nan"].str.split(",").explode().str.strip()
+    names = names[names != ""]
+    names = names.rename_axis("position").reset_index(name="name")
+    merged = (
+        names.drop_duplicates()
+        .sort_values(["position", "name"])
+        .groupby("position")["name"]
+        .agg(",".join)
+        .reindex(positions, fill_value="")
+    )
 
-        for r in grist_results:
-            if r is not None and len(r) > 0:
-                r, act = r
-                ACTIVITY_DATA_UPDATE += act
-                for k, v in r.items():
-                    if any(i is None for i in v):
-                        print(f"Activity is None for state: {activity_state}")
-                        sys.exit(1)
-                    GRIST_DATA_UPDATE[k].update(v)
+    gdf.iloc[positions, gdf.columns.get_loc(ACTIVITY)] = merged.to_numpy()
+    return gdf
 
 
-def main(stl_comparison_base_dir, stl_path: Path, the_out_dir: Path):
+def write_outputs(gdf, the_out_dir: Path, geojson: bool = False):
+    """
+    write every output of the stage from the same frame at once: GeoParquet and csv, and GeoJSON if
+    exporting it
+    """
+    out_name = OUT_NAME
+    writers = {
+        "csv": lambda: gdf.to_csv(str(the_out_dir / f"{out_name}.csv"), index=False),
+        "geoparquet": lambda: write_geoparquet(gdf, the_out_dir / f"{out_name}.parquet"),
+    }
+    if geojson:
+        writers["geojson"] = lambda: gdf.to_file(
+            str(the_out_dir / f"{out_name}.geojson"), driver="GeoJSON"
+        )
+        # Additionally, create a version of the dataset in WGS84 for visualization.
+        writers["wgs84 geojson"] = lambda: gdf.to_crs(WGS_84).to_file(
+            str(the_out_dir / f"{out_name}_wgs84.geojson"), driver="GeoJSON"
+        )
+
+    with ThreadPoolExecutor(max_workers=len(writers)) as executor:
+        futures = {executor.submit(write): label for label, write in writers.items()}
+        for future in as_completed(futures):
+            future.result()
+            log.info(f"wrote {futures[future]} output to {the_out_dir}")
+
+
+def main(
+    stl_comparison_base_dir,
+    stl_path: Path,
+    the_out_dir: Path,
+    geojson: bool = False,
+    deep_dive: bool = False,
+):
     if not the_out_dir.exists():
         the_out_dir.mkdir(parents=True, exist_ok=True)
 
     log.info(f"reading {stl_path}")
-    gdf = geopandas.read_file(str(stl_path))
+    gdf = read_geodata(stl_path)
 
     cols = gdf.columns.tolist()
     if ACTIVITY not in cols:
         rights_type_idx = cols.index(RIGHTS_TYPE)
         cols.insert(rights_type_idx + 1, ACTIVITY)
 
-    match_all_activities(stl_comparison_base_dir, STATE_ACTIVITIES, gdf)
-    for row_idx, activity_list in GRIST_DATA_UPDATE.items():
-        new_vals = ",".join([x for x in activity_list if x is not None])
-        existing = gdf.loc[row_idx, ACTIVITY] or ""
-        gdf.loc[row_idx, ACTIVITY] = combine_delim_list(existing, new_vals, sep=",")
+    # publish the parcels once to a memory-mapped file that every worker attaches to. workers
+    # only index their own state's parcels of rights types compatible with the layer.
+    telemetry = StageTelemetry(the_out_dir / f"{OUT_NAME}_telemetry.jsonl")
+    # each layer's matched features are written to the deep dive by the worker matching it
+    deep_dive_dir = reset_deep_dive(the_out_dir) if deep_dive else None
+    parcel_cols = PARCEL_PARTITION_COLS + ([OBJECT_ID] if OBJECT_ID in gdf.columns else [])
+    shared_parcels = SharedParcels.publish(gdf, CACHE_DIR, parcel_cols)
+    try:
+        match_all_activities(
+            stl_comparison_base_dir,
+            STATE_ACTIVITIES,
+            shared_parcels,
+            telemetry,
+            deep_dive_dir,
+        )
+    finally:
+        shared_parcels.unlink()
+        # workers only scan the cache when their own writes push it over its budget
+        GristCache.evict()
+    telemetry.write_report(the_out_dir / f"{OUT_NAME}_telemetry_report.json")
+
+    gdf = merge_activity_updates(gdf, GRIST_DATA_UPDATE)
 
     # reorder cols
     gdf = gdf[cols]
 
     log.info(f"final grist_data row_count: {gdf.shape[0]}")
-    gdf.to_csv(str(the_out_dir / "stl_dataset_extra_activities.csv"), index=False)
-    gdf.to_file(
-        str(the_out_dir / "stl_dataset_extra_activities.geojson"), driver="GeoJSON"
-    )
-
-    # Additionally, create a version of the dataset in WGS84 for visualization.
-    gdf_wgs84 = gdf.to_crs(WGS_84)
-    gdf_wgs84.to_file(
-        str(the_out_dir / "stl_dataset_extra_activities_wgs84.geojson"),
-        driver="GeoJSON",
-    )
+    write_outputs(gdf, the_out_dir, geojson=geojson)
 
     log.info(f"original grist_data row_count: {gdf.shape[0]}")
+    if deep_dive_dir is not None:
+        log.info(f"wrote activity match deep dive to {deep_dive_dir}")
 
-    # if ACTIVITY_DATA_UPDATE:
-    #     activity_df = pd.DataFrame(ACTIVITY_DATA_UPDATE)
-    #     date_cols = [col for col in activity_df.columns if 'datetime' in str(activity_df.dtypes[col])]
-    #     for col in date_cols:
-    #         activity_df[col] = activity_df[col].map(str)
-    #     did_it_work = str(activity_df.dtypes[col])
-    #     assert 1
-    #
-    #     activity_gdf = geopandas.GeoDataFrame(activity_df, geometry=activity_df.geometry)
-    #     activity_gdf = geometric_deduplication(activity_gdf, gdf.crs)
-    #
-    #     activity_gdf.to_csv(str(the_out_dir / 'activity_match_deep_dive.csv'), index=False)
-    #     activity_gdf.to_file(str(the_out_dir / 'activity_match_deep_dive.geojson'), driver='GeoJSON')
-    #     log.info(f'activity_df row_count: {activity_df.shape[0]}')
-    # else:
-    #     print('No activity matches whatsoever. recommend investigation/debugging.')
-
-
-def run():
+
+def run(geojson: bool = False, deep_dive: bool = False):
     print("running stl_activity_match")
-    required_envs = ["DATA", "PYTHONHASHSEED"]
+    required_envs = ["DATA"]
     missing_envs = [env for env in required_envs if os.environ.get(env) is None]
     if any(missing_envs):
         raise Exception(
@@ -591,7 +1106,13 @@ def run():
 
     out_dir = base_data_dir / "output"
 
-    main(stl_comparison_base_dir, stl, out_dir)
+    main(
+        stl_comparison_base_dir,
+        stl,
+        out_dir,
+        geojson=geojson,
+        deep_dive=deep_dive,
+    )
 
     sys.exit(0)
 
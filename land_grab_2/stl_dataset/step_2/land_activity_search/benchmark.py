@@ -0,0 +1,198 @@
+"""
+benchmarks for the stage 2 matching hot path on synthetic PLSS-like data. every function is timed at
+several sizes and the results written as json, so runs on different commits can be compared.
+"""
+import json
+import logging
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+
+import geopandas
+import numpy as np
+import shapely
+
+from land_grab_2.stl_dataset.step_1.constants import ALBERS_EQUAL_AREA, RIGHTS_TYPE, STATE
+from land_grab_2.stl_dataset.step_2.land_activity_search import activity_match
+from land_grab_2.stl_dataset.step_2.land_activity_search.entities import StateActivityDataSource, StateForActivity
+from land_grab_2.stl_dataset.step_2.land_activity_search.telemetry import peak_rss_bytes
+from land_grab_2.utilities.overlap import ParcelIndex, SharedParcels, _ATTACHED_PARCELS, \
+    _tree_based_proximity_batch, tree_based_proximity
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000, 1_000_000]
+BENCHMARK_STATE = 'MT'
+
+# a PLSS section is one square mile, split into 16 quarter-quarter sections
+SECTION_METERS = 1609.344
+QUARTER_QUARTER_METERS = SECTION_METERS / 4
+
+
+def synthetic_parcels(n, seed=0) -> geopandas.GeoDataFrame:
+    """
+    n quarter-quarter section parcels on a square grid, alternating surface and subsurface rights
+    """
+    rng = np.random.default_rng(seed)
+    side = int(np.ceil(np.sqrt(n)))
+    cols, rows = np.divmod(np.arange(n), side)
+    x, y = cols * QUARTER_QUARTER_METERS, rows * QUARTER_QUARTER_METERS
+    return geopandas.GeoDataFrame({
+        'object_id': np.arange(1, n + 1),
+        STATE: BENCHMARK_STATE,
+        RIGHTS_TYPE: np.where(rng.random(n) < 0.5, 'surface', 'subsurface'),
+    }, geometry=shapely.box(x, y, x + QUARTER_QUARTER_METERS, y + QUARTER_QUARTER_METERS), crs=ALBERS_EQUAL_AREA)
+
+
+def synthetic_activities(parcels, n, seed=1) -> geopandas.GeoDataFrame:
+    """
+    n activity features over the parcels: a third trace a parcel exactly, a third are shifted or grown
+    versions of a parcel and a third are small leases at random spots
+    """
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = parcels.total_bounds
+    kind = rng.integers(0, 3, n)
+    bounds = shapely.bounds(parcels.geometry.to_numpy()[rng.integers(0, len(parcels), n)])
+
+    jitter = rng.uniform(-0.2, 0.2, (n, 4)) * QUARTER_QUARTER_METERS
+    bounds[kind == 1] += jitter[kind == 1]
+
+    x, y = rng.uniform(minx, maxx, n), rng.uniform(miny, maxy, n)
+    size = rng.uniform(10, QUARTER_QUARTER_METERS / 2, n)
+    random_bounds = np.column_stack([x, y, x + size, y + size])
+    bounds[kind == 2] = random_bounds[kind == 2]
+
+    return geopandas.GeoDataFrame({
+        'Type': rng.choice(['Grazing', 'Oil and Gas', 'Agriculture', 'Commercial'], n),
+        'status': rng.choice(['Active', 'Closed'], n, p=[0.8, 0.2]),
+    }, geometry=shapely.box(*bounds.T), crs=ALBERS_EQUAL_AREA)
+
+
+def measure(a_callable, repeats=3):
+    """
+    best wall time of repeats calls, plus the peak python-tracked allocation of one of them.
+    tracemalloc sees numpy buffers but not GEOS' own allocations, which max_rss_bytes bounds instead.
+    """
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = a_callable()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    a_callable()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, {
+        'seconds': min(timings),
+        'seconds_all': timings,
+        'repeats': repeats,
+        'peak_tracemalloc_bytes': peak,
+        'max_rss_bytes': peak_rss_bytes(),
+    }
+
+
+def benchmark_size(n, work_dir: Path, repeats=3):
+    parcels = synthetic_parcels(n)
+    activities = synthetic_activities(parcels, n)
+    activity = StateActivityDataSource(name='Benchmark', location=str(work_dir / f'activities-{n}.shp'),
+                                       use_cache=False)
+    results = []
+
+    def record(function, stats):
+        log.info(f'{function} n={n}: {stats["seconds"]:.3f}s')
+        results.append({'function': function, 'n_parcels': n, 'n_features': n, **stats})
+
+    parcel_index = ParcelIndex.from_geodataframe(parcels)
+    other_geometries = activities.geometry.to_numpy()
+    _, stats = measure(lambda: _tree_based_proximity_batch(parcel_index, other_geometries, 2.0,
+                                                           (0, min(10_000, n))), repeats)
+    record('_tree_based_proximity_batch', stats)
+
+    matches, stats = measure(lambda: tree_based_proximity(parcel_index, activities, parcels.crs), repeats)
+    record('tree_based_proximity', stats)
+
+    annotated = activity_match.annotate_activity_layer(BENCHMARK_STATE, activity, activities)
+    _, stats = measure(lambda: activity_match.capture_matches(matches, BENCHMARK_STATE, activity, parcels,
+                                                              annotated), repeats)
+    record('capture_matches', stats)
+
+    activities.to_file(activity.location, engine='pyogrio')
+    shared_parcels = SharedParcels.publish(parcels, work_dir, activity_match.PARCEL_PARTITION_COLS)
+    try:
+        state = StateForActivity(name='benchmark', activities=[activity])
+
+        def process_cold():
+            # drop the per-process parcel indexes so every call pays for attaching, like a state's first layer
+            _ATTACHED_PARCELS.pop(shared_parcels.path, None)
+            return activity_match.process_state_activity(work_dir, shared_parcels, BENCHMARK_STATE, state,
+                                                         work_dir / 'cache', activity)
+
+        _, stats = measure(process_cold, repeats)
+        record('process_state_activity', stats)
+    finally:
+        shared_parcels.unlink()
+
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=Path(__file__).parent, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def run(sizes=None, out_path=None, repeats=3):
+    sizes = sizes or DEFAULT_SIZES
+    commit = git_commit()
+    report = {
+        'commit': commit,
+        'created': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'results': [],
+    }
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        for n in sizes:
+            report['results'] += benchmark_size(n, Path(work_dir), repeats)
+
+    if out_path is None:
+        out_dir = Path(os.environ.get('DATA', '.')) / 'stl_dataset/step_2/benchmarks'
+        out_path = out_dir / f'stage-2-{(commit or "unknown")[:12]}-{datetime.now():%Y%m%d-%H%M%S}.json'
+    out_path = Path(out_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    out_path.write_text(json.dumps(report, indent=2))
+    print(f'wrote benchmark results to {out_path}')
+    return out_path
+
+
+def compare(baseline_path, candidate_path):
+    """
+    print the time and memory ratio of candidate to baseline for every (function, size) both measured
+    """
+    baseline, candidate = (json.loads(Path(p).read_text()) for p in (baseline_path, candidate_path))
+    by_key = {(r['function'], r['n_features']): r for r in baseline['results']}
+    print(f'{"function":<30}{"n":>10}{"base s":>10}{"cand s":>10}{"time x":>8}{"mem x":>8}')
+    for r in candidate['results']:
+        base = by_key.get((r['function'], r['n_features']))
+        if base is None:
+            continue
+        time_ratio = r['seconds'] / base['seconds'] if base['seconds'] else float('nan')
+        mem_ratio = (r['peak_tracemalloc_bytes'] / base['peak_tracemalloc_bytes']
+                     if base['peak_tracemalloc_bytes'] else float('nan'))
+        print(f'{r["function"]:<30}{r["n_features"]:>10}{base["seconds"]:>10.3f}{r["seconds"]:>10.3f}'
+              f'{time_ratio:>8.2f}{mem_ratio:>8.2f}')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,102 @@
+import dataclasses
+import hashlib
+import logging
+import os
+import pickle
+from pathlib import Path
+from typing import Optional
+
+import geopandas
+import numpy as np
+import pandas as pd
+import shapely
+
+from land_grab_2.stl_dataset.step_2.land_activity_search.entities import stable_hash
+
+log = logging.getLogger(__name__)
+
+# bump when matching changes in a way that invalidates stored results
+MATCH_CHECKPOINT_VERSION = 2
+MATCH_CHECKPOINT_DIR = 'match_checkpoints'
+
+# fields of StateActivityDataSource that only affect how a layer is fetched, not what it matches
+NON_MATCHING_FIELDS = {'scheduler', 'use_cache'}
+
+
+def activity_config_digest(activity, rewrite_rules) -> str:
+    """
+    hash of everything about an activity's configuration that affects its matches
+    """
+    config = {k: v for k, v in dataclasses.asdict(activity).items() if k not in NON_MATCHING_FIELDS}
+    return stable_hash(repr((MATCH_CHECKPOINT_VERSION, sorted(config.items()), rewrite_rules)))
+
+
+def frame_digest(gdf: geopandas.GeoDataFrame) -> str:
+    """
+    content hash of a layer that has no files to fingerprint, e.g. one fetched from a remote server
+    """
+    digest = hashlib.sha256(repr(gdf.columns.tolist()).encode())
+    attributes = gdf.drop(columns=gdf.geometry.name)
+    if len(attributes.columns):
+        digest.update(pd.util.hash_pandas_object(attributes.astype(str), index=False).to_numpy().tobytes())
+    wkb = pd.Series(shapely.to_wkb(gdf.geometry.to_numpy()), dtype=object)
+    digest.update(pd.util.hash_pandas_object(wkb, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+class MatchCheckpoints:
+    """
+    match results of one (state, activity) pair, stored under a key derived from the activity layer's
+    content and configuration and from that state's parcels. parcels are stored by their position within
+    the state's slice, so results stay valid when other states' parcels change.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory) / MATCH_CHECKPOINT_DIR
+
+    def _entry_dir(self, state, activity_name) -> Path:
+        return self.directory / state / stable_hash(activity_name)[:16]
+
+    @staticmethod
+    def key(layer_digest, state_digest, config_digest) -> str:
+        return stable_hash(f'{layer_digest}:{state_digest}:{config_digest}')
+
+    def read(self, state, activity_name, key, state_positions) -> Optional[tuple]:
+        checkpoint = self._entry_dir(state, activity_name) / f'{key}.pkl'
+        if not checkpoint.exists():
+            return
+
+        log.info(f'reading match checkpoint: {str(checkpoint)}')
+        try:
+            with checkpoint.open('rb') as fp:
+                grist_update, matched_activities = pickle.load(fp)
+        except Exception as err:
+            log.error(f'CheckpointReadError: {str(checkpoint)} err: {err}')
+            return
+
+        return {int(state_positions[k]): set(v) for k, v in grist_update.items()}, matched_activities
+
+    def write(self, state, activity_name, key, state_positions, result):
+        grist_update, matched_activities = result
+        # parcel positions in the full dataset -> positions within the state's slice
+        relative = np.searchsorted(state_positions, list(grist_update.keys()))
+        payload = ({int(r): sorted(v, key=str) for r, v in zip(relative, grist_update.values())}, matched_activities)
+
+        entry_dir = self._entry_dir(state, activity_name)
+        entry_dir.mkdir(parents=True, exist_ok=True)
+        checkpoint = entry_dir / f'{key}.pkl'
+        tmp_checkpoint = checkpoint.with_suffix(f'.{os.getpid()}.tmp')
+        log.info(f'writing match checkpoint: {str(checkpoint)}')
+        try:
+            with tmp_checkpoint.open('wb') as fp:
+                pickle.dump(payload, fp)
+            os.replace(tmp_checkpoint, checkpoint)
+        except Exception as err:
+            tmp_checkpoint.unlink(missing_ok=True)
+            log.error(f'CheckpointWriteError: {str(checkpoint)} err: {err}')
+            return
+
+        # an activity has a single live result per state; drop results for older inputs
+        for stale in entry_dir.glob('*.pkl'):
+            if stale != checkpoint:
+                stale.unlink(missing_ok=True)
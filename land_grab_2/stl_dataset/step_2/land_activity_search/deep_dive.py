@@ -0,0 +1,57 @@
+import logging
+import os
+import shutil
+from pathlib import Path
+from urllib.parse import quote
+
+import geopandas
+
+from land_grab_2.stl_dataset.step_2.land_activity_search.entities import stable_hash
+
+log = logging.getLogger(__name__)
+
+DEEP_DIVE_DIR = 'activity_match_deep_dive'
+# object_id of the parcel a matched activity feature was matched to
+MATCHED_PARCEL_COL = 'parcel_object_id'
+# hive partition keys of the dataset; feature columns of the same name are renamed with this prefix
+PARTITION_COLS = ['state', 'layer']
+RENAMED_COL_PREFIX = 'activity_'
+
+
+def reset_deep_dive(out_dir) -> Path:
+    """
+    an empty deep-dive dataset directory under out_dir, so parts of earlier runs do not linger
+    """
+    directory = Path(out_dir) / DEEP_DIVE_DIR
+    shutil.rmtree(directory, ignore_errors=True)
+    directory.mkdir(parents=True)
+    return directory
+
+
+def deep_dive_part_path(directory, state, activity) -> Path:
+    # layer names may hold any character; pyarrow decodes uri-encoded hive partition values
+    return (Path(directory) / f'state={quote(state, safe="")}' / f'layer={quote(activity.name, safe="")}'
+            / f'part-{stable_hash(activity.location)[:16]}.parquet')
+
+
+def write_deep_dive_part(directory, state, activity, matched_activities: geopandas.GeoDataFrame):
+    """
+    write the matched features of one activity layer in one state as a GeoParquet file of the
+    partitioned deep-dive dataset. every layer keeps its own columns, so read the dataset one
+    layer=... partition at a time.
+    """
+    if matched_activities is None or len(matched_activities) == 0:
+        return
+
+    matched_activities = matched_activities.rename(
+        columns={c: f'{RENAMED_COL_PREFIX}{c}' for c in PARTITION_COLS if c in matched_activities.columns}
+    )
+    part = deep_dive_part_path(directory, state, activity)
+    part.parent.mkdir(parents=True, exist_ok=True)
+    tmp_part = part.with_suffix(f'.{os.getpid()}.tmp')
+    try:
+        matched_activities.to_parquet(str(tmp_part), compression='zstd')
+        os.replace(tmp_part, part)
+    except Exception as err:
+        tmp_part.unlink(missing_ok=True)
+        log.error(f'DeepDiveWriteError: {str(part)} err: {err}')
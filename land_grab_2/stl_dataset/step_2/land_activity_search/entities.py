@@ -1,19 +1,41 @@
 import enum
+import functools
+import hashlib
 import logging
-import time
+import os
+import shutil
 from dataclasses import dataclass, field
 from pathlib import Path
 from typing import List, Optional, Union
 
 import geopandas
-import pandas as pd
-from ratelimiter import RateLimiter
+import numpy as np
+import pyarrow as pa
+import pyogrio
+import shapely
+from pyproj import CRS, Transformer
 
-from land_grab_2.utilities.utils import GristCache, in_parallel, fetch_remote, fetch_all_parcel_ids
+from land_grab_2.utilities.esri_json import esri_json_to_geodataframe
+from land_grab_2.utilities.overlap import DEFAULT_TILE_SIZE, TILE_ROW_COL, TiledLayer
+from land_grab_2.utilities.utils import GristCache, fetch_remote_features, fetch_all_parcel_ids
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
+# bump when the layout of cached local layers changes so stale entries are ignored
+LOCAL_LAYER_CACHE_VERSION = 2
+LOCAL_LAYER_CACHE_DIR = 'local_layers'
+# reads of the current version of a layer kept in its cache directory (different columns, bboxes, crs)
+LOCAL_LAYER_READS_KEPT = 4
+# features per batch when streaming a local layer into tiles
+LOCAL_LAYER_BATCH_SIZE = 50_000
+
+# index of local layers read with their shapefile feature ids, the features' row positions in the whole layer
+LAYER_ROW_INDEX = 'fid'
+
+# GeoDataFrame.attrs key recording whether a layer was read from its source or from a cache
+LOAD_SOURCE_ATTR = 'load_source'
+
 
 class StateActivityDataLocation(enum.Enum):
     LOCAL = 'local'
@@ -37,26 +59,97 @@ class StateActivityDataSource:
     def loc_type(self) -> StateActivityDataLocation:
         return StateActivityDataLocation.REMOTE if 'http' in self.location else StateActivityDataLocation.LOCAL
 
-    def load_local(self, stl_comparison_base_dir):
+    def local_path(self, stl_comparison_base_dir) -> Optional[Path]:
         loc_path = Path(self.location)
         if loc_path.name.endswith('.shp'):
-            if loc_path.name.startswith('/'):
-                shapefile = self.location
-                gdf = geopandas.read_file(str(shapefile), engine="pyogrio")
-            else:
-                shapefile = stl_comparison_base_dir / self.location
-                gdf = geopandas.read_file(str(shapefile), engine="pyogrio")
-        else:
-            shapefile = next(
-                (f for f in (stl_comparison_base_dir / self.location).iterdir() if f.name.endswith('.shp')), None)
-            gdf = geopandas.read_file(str(shapefile), engine="pyogrio")
+            if loc_path.is_absolute():
+                return loc_path
+            return stl_comparison_base_dir / self.location
+
+        return next((f for f in (stl_comparison_base_dir / self.location).iterdir() if f.name.endswith('.shp')), None)
+
+    def local_fields(self, stl_comparison_base_dir) -> List[str]:
+        shapefile = self.local_path(stl_comparison_base_dir)
+        return pyogrio.read_info(str(shapefile))['fields'].tolist() if shapefile is not None else []
+
+    def local_feature_count(self, stl_comparison_base_dir) -> int:
+        shapefile = self.local_path(stl_comparison_base_dir)
+        return int(pyogrio.read_info(str(shapefile))['features']) if shapefile is not None else 0
 
+    def load_local(self, stl_comparison_base_dir, crs=None, columns=None, bbox=None):
+        """
+        read the layer's shapefile, reprojected to crs when given. columns restricts the attribute columns
+        read and bbox (in crs) the features read, both pushed down to pyogrio. the result is cached as
+        GeoParquet keyed on the shapefile's sidecar files and the read parameters, so re-runs skip parsing
+        and reprojecting.
+        """
+        shapefile = self.local_path(stl_comparison_base_dir)
+        if shapefile is None:
+            return
+
+        cached_file = None
+        if GristCache.CACHE_DIR:
+            cached_file = local_layer_cache_entry(shapefile, crs, columns, bbox).with_suffix('.parquet')
+            if self.use_cache and cached_file.exists():
+                gdf = read_cached_layer(cached_file, crs)
+                if gdf is not None:
+                    touch_cache_entry(cached_file)
+                    gdf.attrs[LOAD_SOURCE_ATTR] = 'cache'
+                    return gdf
+
+        read_kwargs = {}
+        if columns is not None:
+            read_kwargs['columns'] = list(columns)
+        if bbox is not None:
+            read_kwargs['bbox'] = layer_bbox(shapefile, bbox, crs)
+
+        # keep the feature ids, so a bbox read still knows where its features sit in the layer
+        gdf = geopandas.read_file(str(shapefile), engine="pyogrio", fid_as_index=True, **read_kwargs)
+        gdf.index = gdf.index.rename(LAYER_ROW_INDEX)
+        if not gdf.index.is_monotonic_increasing:
+            gdf = gdf.sort_index()
+        if crs is not None:
+            gdf = gdf.set_crs(crs, allow_override=True) if not gdf.crs else gdf.to_crs(crs)
+
+        if cached_file is not None and write_cached_layer(gdf, cached_file):
+            evict_stale_layer_entries(cached_file)
+
+        gdf.attrs[LOAD_SOURCE_ATTR] = 'local'
         return gdf
 
+    def load_local_tiled(self, stl_comparison_base_dir, crs=None, columns=None, bbox=None,
+                         tile_size=DEFAULT_TILE_SIZE) -> Optional[TiledLayer]:
+        """
+        like load_local, but streams the shapefile batch by batch into a TiledLayer kept in the cache
+        instead of reading it into one frame. returns None without a cache directory to keep it in.
+        """
+        shapefile = self.local_path(stl_comparison_base_dir)
+        if shapefile is None or not GristCache.CACHE_DIR:
+            return
+
+        entry = local_layer_cache_entry(shapefile, crs, columns, bbox)
+        tiles_dir = entry.with_name(f'{entry.name}-{tile_size}.tiles')
+        if self.use_cache and tiles_dir.is_dir():
+            log.info(f'reading tiles from cache: {str(tiles_dir)}')
+            touch_cache_entry(tiles_dir)
+            layer = TiledLayer(tiles_dir, crs=crs)
+            layer.attrs[LOAD_SOURCE_ATTR] = 'cache'
+            return layer
+
+        log.info(f'writing tiles to cache: {str(tiles_dir)}')
+        layer_bounds = layer_bbox(shapefile, bbox, crs) if bbox is not None else None
+        layer = TiledLayer.write(read_local_batches(shapefile, crs, columns, layer_bounds), tiles_dir, crs=crs,
+                                 tile_size=tile_size)
+        evict_stale_layer_entries(tiles_dir)
+
+        layer.attrs[LOAD_SOURCE_ATTR] = 'local'
+        return layer
+
     def load_remote(self, scheduler=None):
         cache = GristCache(self.location)
-        activity_data_geopandas = cache.cache_read('activity_data_geopandas', '.feather')
+        activity_data_geopandas = cache.cache_read('activity_data_geopandas')
         if self.use_cache and activity_data_geopandas is not None:
+            activity_data_geopandas.attrs[LOAD_SOURCE_ATTR] = 'cache'
             return activity_data_geopandas
 
         cached_ids_resp = cache.cache_read('ids_resp')
@@ -66,57 +159,40 @@ class StateActivityDataSource:
 
         if ids_resp:
             log.info(f'fetching remote activity data for {self.name} from: {self.location}')
-            ids = ids_resp.get('objectIds', [])
-            cached_activity_data = None
-            if self.use_cache:
-                cached_activity_data = cache.cache_read('activity_data')
-            activity_data_raw = cached_activity_data or in_parallel(ids,
-                                                                    self.fetch_remote,
-                                                                    batched=False,
-                                                                    scheduler=self.scheduler or 'threads')
-            if not cached_activity_data:
-                cache.cache_write(activity_data_raw, 'activity_data_raw')
+            ids = ids_resp.get('objectIds') or []
+            activity_data_raw = self.fetch_remote_features(ids)
 
             log.info(f'hydrating geodataframes activity data for {self.name} from: {self.location}')
-            activity_data = in_parallel(activity_data_raw,
-                                        safe_geopandas_load,
-                                        batched=False,
-                                        scheduler='threads')
-
-            if activity_data:
-                try:
-                    log.info(f'concat-ing geodataframes activity data for {self.name} from: {self.location}')
-                    gdfs = pd.concat(activity_data, ignore_index=True)
-
-                    crs = activity_data[0].crs
-                    # if 'spatialReference' in activity_data_raw and 'wkid' in activity_data_raw['spatialReference']:
-                    #     crs = activity_data_raw['spatialReference']['wkid']
-
-                    activity_data = geopandas.GeoDataFrame(gdfs, crs=crs).to_crs(crs)
-                    cache.cache_write(activity_data, 'activity_data_geopandas', '.feather')
+            try:
+                activity_data = esri_json_to_geodataframe(activity_data_raw)
+            except Exception as err:
+                log.error(f'Failed with {err} initing geodf for {self.name} from: {self.location}')
+                print(f'Failed with {err} initing geodf for {self.name} from: {self.location}')
+                return
 
-                    return activity_data
-                except Exception as err:
-                    log.error(f'Failed with {err} initing geodf for {self.name} from: {self.location}')
-                    print(f'Failed with {err} initing geodf for {self.name} from: {self.location}')
-                    return
+            if activity_data is not None:
+                cache.cache_write(activity_data, 'activity_data_geopandas')
+                activity_data.attrs[LOAD_SOURCE_ATTR] = 'remote'
+                return activity_data
 
     def query_data(self,
-                   stl_comparison_base_dir) -> Optional[Union[geopandas.GeoDataFrame, List[geopandas.GeoDataFrame]]]:
+                   stl_comparison_base_dir,
+                   crs=None,
+                   columns=None,
+                   bbox=None) -> Optional[Union[geopandas.GeoDataFrame, List[geopandas.GeoDataFrame]]]:
         if not self.location:
             return
 
         if self.loc_type == StateActivityDataLocation.LOCAL:
-            activity_data = self.load_local(stl_comparison_base_dir)
+            activity_data = self.load_local(stl_comparison_base_dir, crs, columns, bbox)
             return activity_data
 
         if self.loc_type == StateActivityDataLocation.REMOTE:
             activity_data = self.load_remote()
             return activity_data
 
-    @RateLimiter(max_calls=5000, period=60)
-    def fetch_remote(self, parcel_id: Optional[str] = None):
-        return fetch_remote(self.location, parcel_id)
+    def fetch_remote_features(self, object_ids):
+        return fetch_remote_features(self.location, object_ids)
 
     def fetch_all_parcel_ids(self):
         return fetch_all_parcel_ids(self.location)
@@ -130,11 +206,150 @@ class StateForActivity:
     use_cache: bool = True
 
 
-def safe_geopandas_load(p):
+def stable_hash(value: str) -> str:
+    return hashlib.sha256(value.encode()).hexdigest()
+
+
+def crs_key(crs) -> str:
+    return CRS.from_user_input(crs).to_wkt() if crs is not None else 'native'
+
+
+def local_layer_read_key(shapefile, crs=None, columns=None, bbox=None) -> str:
+    """
+    key for the way a local layer is read: which file, reprojected to which crs, with which columns and bbox
+    """
+    columns = list(columns) if columns is not None else None
+    bbox = [float(b) for b in bbox] if bbox is not None else None
+    return stable_hash(repr((str(shapefile), crs_key(crs), columns, bbox)))
+
+
+def local_layer_fingerprint(shapefile) -> str:
+    """
+    key for the version of a local layer: size, mtime and content of every sidecar file of the
+    shapefile (.shp, .shx, .dbf, .prj, .cpg, ...). the content is hashed once per process for a given
+    size and mtime of the files.
+    """
+    shapefile = Path(shapefile)
+    sidecars = sorted(f for f in shapefile.parent.iterdir() if f.name.startswith(f'{shapefile.stem}.'))
+    stats = tuple((str(sidecar), stat.st_size, stat.st_mtime_ns) for sidecar in sidecars
+                  for stat in [sidecar.stat()])
+    return _hash_sidecars(stats)
+
+
+@functools.lru_cache(maxsize=None)
+def _hash_sidecars(stats) -> str:
+    digest = hashlib.sha256(f'v{LOCAL_LAYER_CACHE_VERSION}'.encode())
+    for path, size, mtime_ns in stats:
+        digest.update(f'{Path(path).name}:{size}:{mtime_ns}:'.encode())
+        with open(path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(1 << 20), b''):
+                digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def local_layer_cache_entry(shapefile, crs=None, columns=None, bbox=None) -> Path:
+    """
+    path, without suffix, of the cached read of a local layer: one directory per shapefile holding an
+    entry per read (crs, columns and bbox) and version of its files
+    """
+    layer_dir = Path(GristCache.CACHE_DIR) / LOCAL_LAYER_CACHE_DIR / stable_hash(str(shapefile))[:16]
+    read_key = local_layer_read_key(shapefile, crs, columns, bbox)
+    return layer_dir / f'{read_key[:16]}-{local_layer_fingerprint(shapefile)[:16]}'
+
+
+def touch_cache_entry(entry: Path):
+    # mark a cached read as used, for evict_stale_layer_entries
+    try:
+        os.utime(entry)
+    except OSError:
+        pass
+
+
+def evict_stale_layer_entries(entry: Path, keep=LOCAL_LAYER_READS_KEPT):
+    """
+    drop the siblings of a newly written cache entry that are stale: reads of older versions of the
+    layer's files, and all but the keep most recently used reads of the current version, whose bboxes
+    and columns follow the parcels and configuration of past runs
+    """
+    version = entry.name.split('.')[0].split('-')[1]
+    siblings = [s for s in entry.parent.iterdir()
+                if s != entry and s.suffix in ('.parquet', '.tiles') and s.name.count('-') >= 1]
+    current = []
+    for sibling in siblings:
+        if sibling.name.split('.')[0].split('-')[1] == version:
+            current.append(sibling)
+        else:
+            _remove_cache_entry(sibling)
+
+    current.sort(key=lambda s: s.stat().st_mtime_ns, reverse=True)
+    for sibling in current[max(keep - 1, 0):]:
+        _remove_cache_entry(sibling)
+
+
+def _remove_cache_entry(entry: Path):
+    log.info(f'evicting stale cache entry: {str(entry)}')
+    if entry.is_dir():
+        shutil.rmtree(entry, ignore_errors=True)
+    else:
+        entry.unlink(missing_ok=True)
+
+
+def layer_bbox(shapefile, bbox, crs=None):
+    """
+    bbox given in crs, transformed to the crs of the shapefile so it can be pushed down to the read
+    """
+    layer_crs = pyogrio.read_info(str(shapefile))['crs']
+    if crs is None or layer_crs is None:
+        return tuple(bbox)
+
+    transformer = Transformer.from_crs(CRS.from_user_input(crs), CRS.from_user_input(layer_crs), always_xy=True)
+    return transformer.transform_bounds(*bbox, densify_pts=21)
+
+
+def read_local_batches(shapefile, crs=None, columns=None, bbox=None, batch_size=LOCAL_LAYER_BATCH_SIZE):
+    """
+    stream a shapefile as (attributes, geometries) batches, geometries reprojected to crs. bbox is in the
+    shapefile's crs. the attributes carry the feature ids, the features' row positions in the whole
+    layer, as TILE_ROW_COL.
+    """
+    with pyogrio.open_arrow(str(shapefile), columns=columns, bbox=bbox, batch_size=batch_size,
+                            return_fids=True, use_pyarrow=True) as (meta, reader):
+        geometry_name = meta['geometry_name'] or 'wkb_geometry'
+        fid_name = meta['fid_column'] or 'OGC_FID'
+        for batch in reader:
+            table = pa.Table.from_batches([batch])
+            fid_position = table.column_names.index(fid_name)
+            table = table.set_column(fid_position, TILE_ROW_COL, table.column(fid_name).cast(pa.int64()))
+            geometries = geopandas.GeoSeries(
+                shapely.from_wkb(table.column(geometry_name).to_numpy(zero_copy_only=False)), crs=meta['crs']
+            )
+            if crs is not None:
+                geometries = geometries.set_crs(crs, allow_override=True) if not geometries.crs else geometries.to_crs(crs)
+            yield table.drop_columns([geometry_name]), np.asarray(geometries.values, dtype=object)
+
+
+def read_cached_layer(cached_file: Path, crs=None) -> Optional[geopandas.GeoDataFrame]:
+    log.info(f'reading from cache: {str(cached_file)}')
+    try:
+        gdf = geopandas.read_parquet(str(cached_file))
+        # restore the exact crs object so later to_crs calls to it are no-ops
+        return gdf.set_crs(crs, allow_override=True) if crs is not None else gdf
+    except Exception as err:
+        log.error(f'CacheReadError during parquet READ path: {str(cached_file)} err: {err}')
+
+
+def write_cached_layer(gdf: geopandas.GeoDataFrame, cached_file: Path) -> bool:
+    log.info(f'writing to cache: {str(cached_file)}')
+    cached_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = cached_file.with_suffix(f'.{os.getpid()}.tmp')
     try:
-        time.sleep(0.25)
-        g = geopandas.read_file(p)
-        if g is not None:
-            return g
+        # the bbox covering column lets readers filter row groups spatially without decoding geometry
+        gdf.to_parquet(str(tmp_file), write_covering_bbox='bbox' not in gdf.columns)
+        os.replace(tmp_file, cached_file)
     except Exception as err:
-        log.error(f'THIS IS WHERE THE ERROR IS {err}')
+        tmp_file.unlink(missing_ok=True)
+        log.error(f'CacheWriteError during parquet WRITE path: {str(cached_file)} err: {err}')
+        return False
+
+    return True
@@ -0,0 +1,133 @@
+import logging
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple
+
+from land_grab_2.stl_dataset.step_2.land_activity_search.entities import StateActivityDataLocation, \
+    StateActivityDataSource, StateForActivity
+from land_grab_2.utilities.overlap import TILED_MATCH_MIN_FEATURES
+from land_grab_2.utilities.utils import GristCache
+
+log = logging.getLogger(__name__)
+
+# rough resident bytes per activity feature while a layer is loaded, annotated and matched
+BYTES_PER_FEATURE = 8 * 1024
+# resident bytes of an idle worker process with geopandas, shapely and pyogrio imported
+WORKER_BASE_BYTES = 256 * 1024 ** 2
+# feature count assumed for remote layers with nothing cached yet
+UNKNOWN_REMOTE_FEATURES = 100_000
+# share of the available memory the scheduler budgets for when none is configured
+DEFAULT_MEMORY_FRACTION = 0.75
+FALLBACK_MEMORY_BYTES = 8 * 1024 ** 3
+
+
+@dataclass
+class ActivityTask:
+    state: str
+    activity_info: StateForActivity
+    activity: StateActivityDataSource
+    features: int = 0
+
+    @property
+    def memory_bytes(self) -> int:
+        features = self.features
+        if self.activity.loc_type == StateActivityDataLocation.LOCAL:
+            # large local layers are matched tile by tile
+            features = min(features, TILED_MATCH_MIN_FEATURES)
+        return features * BYTES_PER_FEATURE
+
+
+def estimate_features(stl_comparison_base_dir, activity) -> int:
+    """
+    feature count of an activity layer without reading it: the shapefile header for local layers and
+    the cache metadata of the last fetch for remote ones
+    """
+    try:
+        if activity.loc_type == StateActivityDataLocation.LOCAL:
+            return activity.local_feature_count(stl_comparison_base_dir)
+
+        metadata = GristCache(activity.location).cache_metadata('activity_data_geopandas')
+        if metadata and metadata.get('rows') is not None:
+            return int(metadata['rows'])
+    except Exception as err:
+        log.error(f'CostEstimateError: {activity.name} at {activity.location} err: {err}')
+
+    return UNKNOWN_REMOTE_FEATURES
+
+
+def available_memory_bytes() -> int:
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return FALLBACK_MEMORY_BYTES
+
+
+def memory_budget_bytes() -> int:
+    """
+    bytes the matching tasks may use at once, from STAGE_2_MEMORY_BUDGET_BYTES or else a share of the
+    memory available when the run starts
+    """
+    configured = os.environ.get('STAGE_2_MEMORY_BUDGET_BYTES')
+    if configured:
+        return int(configured)
+    return int(available_memory_bytes() * DEFAULT_MEMORY_FRACTION)
+
+
+def plan_activity_tasks(stl_comparison_base_dir, states_data) -> List[ActivityTask]:
+    """
+    every (state, activity layer) pair of states_data, largest layer first
+    """
+    tasks = []
+    for state, activity_info in states_data.items():
+        if not activity_info:
+            log.error(f'NO ACTIVITY CONFIG FOR {state}')
+            continue
+        for activity in activity_info.activities:
+            features = estimate_features(stl_comparison_base_dir, activity)
+            tasks.append(ActivityTask(state, activity_info, activity, features))
+
+    return sorted(tasks, key=lambda t: t.features, reverse=True)
+
+
+def run_tasks(tasks: Iterable[ActivityTask],
+              a_callable: Callable[[ActivityTask], Any],
+              memory_budget: Optional[int] = None,
+              max_workers: Optional[int] = None) -> Iterator[Tuple[ActivityTask, Any]]:
+    """
+    run a_callable over tasks in worker processes, yielding (task, result) as tasks finish. whenever a
+    worker is free the first waiting task whose estimated memory fits the budget next to the running ones
+    starts; a task larger than the whole budget runs once nothing else is. DEBUG_PARALLEL runs everything
+    in this process.
+    """
+    tasks = list(tasks)
+    if os.environ.get('DEBUG_PARALLEL'):
+        for task in tasks:
+            yield task, a_callable(task)
+        return
+
+    memory_budget = memory_budget_bytes() if memory_budget is None else memory_budget
+    max_workers = max_workers or os.cpu_count() or 1
+    max_workers = max(1, min(max_workers, len(tasks), memory_budget // WORKER_BASE_BYTES or 1))
+    task_budget = max(memory_budget - max_workers * WORKER_BASE_BYTES, 0)
+    log.info(f'running {len(tasks)} activity tasks on {max_workers} workers within {memory_budget} bytes')
+
+    pending = tasks
+    running = {}
+    # spawn like dask's process scheduler, so workers never inherit locks or threads mid-use
+    with ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        while pending or running:
+            in_use = sum(task.memory_bytes for task in running.values())
+            waiting = []
+            for task in pending:
+                if len(running) < max_workers and (not running or in_use + task.memory_bytes <= task_budget):
+                    running[executor.submit(a_callable, task)] = task
+                    in_use += task.memory_bytes
+                else:
+                    waiting.append(task)
+            pending = waiting
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield running.pop(future), future.result()
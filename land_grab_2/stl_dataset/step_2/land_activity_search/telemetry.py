@@ -0,0 +1,125 @@
+import json
+import logging
+import os
+import resource
+import sys
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+# how many of the slowest activities the run report lists
+REPORT_TOP_N = 20
+
+
+def peak_rss_bytes() -> int:
+    """
+    peak resident set size of this process so far. ru_maxrss is KiB on linux and bytes on macos.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def start_activity_metrics(state, activity) -> dict:
+    """
+    a telemetry record for matching one activity layer against a state's parcels. the matching code
+    fills in the counts and timings it knows about as it goes.
+    """
+    return {
+        'state': state,
+        'activity': activity.name,
+        'location_type': activity.loc_type.value,
+        # where the features came from: local, remote, cache or checkpoint (nothing loaded at all)
+        'source': None,
+        'status': 'ok',
+        'load_seconds': 0.0,
+        'feature_count': 0,
+        'candidate_pairs': 0,
+        'matched_pairs': 0,
+        'accepted_matches': 0,
+        'rejected_incompatible': 0,
+        'rejected_inactive': 0,
+        'match_seconds': 0.0,
+        'started': datetime.now(timezone.utc).isoformat(),
+        '_start': time.perf_counter(),
+        '_start_peak_rss_bytes': peak_rss_bytes(),
+    }
+
+
+def finish_activity_metrics(metrics) -> dict:
+    """
+    peak_rss_growth_bytes is how far this activity raised the worker's peak resident set size, 0 when it
+    stayed under the peak of the layers the worker matched before it. worker_peak_rss_bytes is the peak
+    over the worker's lifetime so far.
+    """
+    metrics['wall_seconds'] = time.perf_counter() - metrics.pop('_start')
+    peak = peak_rss_bytes()
+    metrics['peak_rss_growth_bytes'] = peak - metrics.pop('_start_peak_rss_bytes')
+    metrics['worker_peak_rss_bytes'] = peak
+    metrics['pid'] = os.getpid()
+    return metrics
+
+
+class StageTelemetry:
+    """
+    per-activity records of a stage 2 run, appended to a JSON lines file as they come in and
+    summarized into a run report at the end
+    """
+
+    def __init__(self, jsonl_path: Path):
+        self.jsonl_path = Path(jsonl_path)
+        self.jsonl_path.parent.mkdir(parents=True, exist_ok=True)
+        self.jsonl_path.write_text('')
+        self.records = []
+        self.started = time.perf_counter()
+
+    def record(self, metrics):
+        if not metrics:
+            return
+        self.records.append(metrics)
+        with self.jsonl_path.open('a') as fp:
+            fp.write(json.dumps(metrics, default=str) + '\n')
+
+    def report(self) -> dict:
+        records = self.records
+        by_state = defaultdict(lambda: {'activities': 0, 'wall_seconds': 0.0, 'accepted_matches': 0})
+        for r in records:
+            state = by_state[r['state']]
+            state['activities'] += 1
+            state['wall_seconds'] += r.get('wall_seconds', 0.0)
+            state['accepted_matches'] += r.get('accepted_matches', 0)
+
+        total_wall = sum(r.get('wall_seconds', 0.0) for r in records)
+        slowest = sorted(records, key=lambda r: r.get('wall_seconds', 0.0), reverse=True)[:REPORT_TOP_N]
+        return {
+            'run_seconds': time.perf_counter() - self.started,
+            'activities': len(records),
+            'activity_seconds': total_wall,
+            'load_seconds': sum(r.get('load_seconds', 0.0) for r in records),
+            'match_seconds': sum(r.get('match_seconds', 0.0) for r in records),
+            'feature_count': sum(r.get('feature_count', 0) for r in records),
+            'accepted_matches': sum(r.get('accepted_matches', 0) for r in records),
+            'peak_rss_bytes': max([r.get('worker_peak_rss_bytes', 0) for r in records] + [peak_rss_bytes()]),
+            'by_source': dict(Counter(r.get('source') for r in records)),
+            'by_status': dict(Counter(r.get('status') for r in records)),
+            'by_state': dict(by_state),
+            'slowest': [
+                {
+                    k: r.get(k)
+                    for k in ('state', 'activity', 'source', 'wall_seconds', 'load_seconds', 'match_seconds',
+                              'feature_count', 'candidate_pairs', 'accepted_matches', 'peak_rss_growth_bytes')
+                }
+                | {'share_of_activity_seconds': r.get('wall_seconds', 0.0) / total_wall if total_wall else 0.0}
+                for r in slowest
+            ],
+        }
+
+    def write_report(self, report_path: Path) -> dict:
+        report = self.report()
+        Path(report_path).write_text(json.dumps(report, indent=2, default=str))
+        log.info(f'wrote stage 2 telemetry report to {report_path}')
+        for r in report['slowest'][:5]:
+            print(f"slowest: {r['state']} {r['activity']} took {r['wall_seconds']:.1f}s "
+                  f"(load {r['load_seconds']:.1f}s, match {r['match_seconds']:.1f}s, {r['feature_count']} features)")
+        return report
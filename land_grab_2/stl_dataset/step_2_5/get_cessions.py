@@ -9,6 +9,7 @@ import geopandas as gpd
 import numpy as np
 
 from land_grab_2.stl_dataset.step_1.constants import WGS_84
+from land_grab_2.utilities.utils import read_geodata, write_geoparquet
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
@@ -212,7 +213,7 @@ def aggregate_cessions_by_parcel(
     return gpd.GeoDataFrame(out_gdf, geometry=out_gdf["geometry"], crs=crs)
 
 
-def run():
+def run(geojson: bool = False):
     print("Running Step 2.5: Join cession and county information to parcels.")
     required_envs = ["DATA"]
     missing_envs = [env for env in required_envs if os.environ.get(env) is None]
@@ -226,7 +227,7 @@ def run():
     out_dir = Path(f"{data_tld}/stl_dataset/step_2_5/output").resolve()
 
     # Load parcels, counties, and cessions data.
-    parcels_gdf = gpd.read_file(
+    parcels_gdf = read_geodata(
         Path(
             f"{data_tld}/stl_dataset/step_2/output/stl_dataset_extra_activities.geojson"
         ).resolve()
@@ -255,17 +256,24 @@ def run():
 
     # Export the GeoDataFrame.
     log.info(
-        "Writing output files to data/stl_dataset/step_2_5/output/stl_dataset_extra_activities_plus_cessions{_wgs84}.{csv,geojson}"
+        "Writing output files to data/stl_dataset/step_2_5/output/stl_dataset_extra_activities_plus_cessions{_wgs84}.{csv,parquet,geojson}"
     )
-    parcels_cessions_gdf.to_file(
-        out_dir / "stl_dataset_extra_activities_plus_cessions.geojson", driver="GeoJSON"
+    write_geoparquet(
+        parcels_cessions_gdf,
+        out_dir / "stl_dataset_extra_activities_plus_cessions.parquet",
     )
 
-    # Export a WGS84 version of the GeoDataFrame.
-    parcels_cessions_gdf.to_crs(WGS_84).to_file(
-        out_dir / "stl_dataset_extra_activities_plus_cessions_wgs84.geojson",
-        driver="GeoJSON",
-    )
+    if geojson:
+        parcels_cessions_gdf.to_file(
+            out_dir / "stl_dataset_extra_activities_plus_cessions.geojson",
+            driver="GeoJSON",
+        )
+
+        # Export a WGS84 version of the GeoDataFrame.
+        parcels_cessions_gdf.to_crs(WGS_84).to_file(
+            out_dir / "stl_dataset_extra_activities_plus_cessions_wgs84.geojson",
+            driver="GeoJSON",
+        )
 
     # Export a CSV version of the GeoDataFrame.
     parcels_cessions_gdf.drop(columns=["geometry"], inplace=True)
@@ -7,6 +7,7 @@ import numpy as np
 import pandas as pd
 
 from land_grab_2.stl_dataset.step_1.constants import GIS_ACRES, WGS_84
+from land_grab_2.utilities.utils import read_geodata, write_geoparquet
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
@@ -161,7 +162,7 @@ def run():
     out_dir = Path(f"{data_tld}/stl_dataset/step_3/output").resolve()
 
     # Load parcels and cession prices.
-    stl_gdf = gpd.read_file(
+    stl_gdf = read_geodata(
         prev_out_dir / "stl_dataset_extra_activities_plus_cessions.geojson"
     )
     cessions_price_df = pd.read_csv(in_dir / "Cession_Data.csv")
@@ -182,12 +183,23 @@ def run():
     )
 
     # Export a WGS84 version of the GeoDataFrame.
-    stl_with_cession_price_gdf.to_crs(WGS_84).to_file(
+    stl_with_cession_price_wgs84_gdf = stl_with_cession_price_gdf.to_crs(WGS_84)
+    stl_with_cession_price_wgs84_gdf.to_file(
         out_dir
         / "stl_dataset_extra_activities_plus_cessions_plus_prices_wgs84.geojson",
         driver="GeoJSON",
     )
 
+    # Keep GeoParquet copies for stage 4 and other readers of this stage's output.
+    write_geoparquet(
+        stl_with_cession_price_gdf,
+        out_dir / "stl_dataset_extra_activities_plus_cessions_plus_prices.parquet",
+    )
+    write_geoparquet(
+        stl_with_cession_price_wgs84_gdf,
+        out_dir / "stl_dataset_extra_activities_plus_cessions_plus_prices_wgs84.parquet",
+    )
+
     # Export a CSV version of the GeoDataFrame.
     stl_with_cession_price_gdf.drop(columns=["geometry"], inplace=True)
     stl_with_cession_price_gdf.to_csv(
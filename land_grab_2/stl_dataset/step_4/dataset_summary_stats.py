@@ -10,7 +10,7 @@ import pandas as pd
 
 from land_grab_2.stl_dataset.step_1.constants import GIS_ACRES, STATE, TRIBE_SUMMARY, \
     RIGHTS_TYPE
-from land_grab_2.utilities.utils import prettyify_list_of_strings
+from land_grab_2.utilities.utils import prettyify_list_of_strings, read_geodata
 
 os.environ['RESTAPI_USE_ARCPY'] = 'FALSE'
 
@@ -195,7 +195,7 @@ def calculate_summary_statistics_helper(summary_statistics_data_directory):
     data_tld = Path(os.environ.get('DATA')).resolve()
     input_file = data_tld / 'stl_dataset/step_3/output/stl_dataset_extra_activities_plus_cessions_plus_prices_wgs84.geojson'
     output_dir = data_tld / 'stl_dataset/step_4/output'
-    gdf = gpd.read_file(input_file)
+    gdf = read_geodata(input_file)
 
     gdf_tribes = gdf.copy(deep=True)
 
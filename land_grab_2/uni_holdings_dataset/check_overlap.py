@@ -12,7 +12,7 @@ import pandas as pd
 
 from land_grab_2.init_database.db.gristdb import GristDB
 from land_grab_2.utilities.overlap import eval_overlap_keep_left, dictlist_to_geodataframe, STATE_LONG_NAME, \
-    tree_based_proximity
+    tree_based_proximity, ParcelIndex, MatchSet
 from land_grab_2.utilities.utils import in_parallel, batch_iterable, get_uuid, send_email
 
 logging.basicConfig(level=logging.INFO)
@@ -133,8 +133,9 @@ def process_parcels_batch_prod(grist_data_path, county, state_code, parcels_batc
         print(err)
 
 
-def write_county_batch_exp(grist_data_path: str, state_code: str, county: str, batch_results: Optional[list]):
-    if batch_results is None or isinstance(batch_results, list) and len(batch_results) == 0:
+def write_county_batch_exp(grist_data_path: str, state_code: str, county: str, batch_results: Optional[MatchSet],
+                           county_parcels_gdf=None):
+    if batch_results is None or len(batch_results) == 0:
         return
     output_dir = Path(grist_data_path).parent.parent / 'output'
     state_dir = output_dir / state_code
@@ -144,10 +145,11 @@ def write_county_batch_exp(grist_data_path: str, state_code: str, county: str, b
     if not county_dir.exists():
         county_dir.mkdir(parents=True, exist_ok=True)
 
+    contained = batch_results[batch_results.contains]
+    regrid_rows = county_parcels_gdf.iloc[contained.other_idx].to_dict(orient='records')
     results = [
         {'rownum': grist_rownum, **{k: v for k, v in regrid_row.items() if k != 'id'}}
-        for match_score, grist_rownum, grist_row, regrid_row, contains in batch_results
-        if contains
+        for grist_rownum, regrid_row in zip(contained.parcel_idx.tolist(), regrid_rows)
     ]
 
     if results:
@@ -168,15 +170,14 @@ def process_parcels_batch(grist_data_path, county, state_code, parcels_batch):
 
         # overlapping_county_parcels = find_overlaps(grist_data, county_parcels_gdf, crs_list)
         overlapping_county_parcels = tree_based_proximity(
-            grist_data.to_dict(orient='records'), county_parcels_gdf, grist_data.crs
+            ParcelIndex.from_geodataframe(grist_data), county_parcels_gdf, grist_data.crs
         )
-        overlapping_county_parcels = list(overlapping_county_parcels)
-
-        if overlapping_county_parcels:
+        if len(overlapping_county_parcels) > 0:
             # print(f' found {len(overlapping_county_parcels)} parcels with overlap for {county} in {state_code}')
-            write_county_batch_exp(grist_data_path, state_code, county, overlapping_county_parcels)
+            write_county_batch_exp(grist_data_path, state_code, county, overlapping_county_parcels,
+                                   county_parcels_gdf)
 
-        return overlapping_county_parcels
+        return list(zip(overlapping_county_parcels.parcel_idx.tolist(), overlapping_county_parcels.other_idx.tolist()))
     except Exception as err:
         print(traceback.format_exc())
         print(err)
@@ -0,0 +1,185 @@
+import json
+import logging
+from typing import Iterable, List, Optional, Union
+
+import geopandas
+import numpy as np
+import pandas as pd
+import shapely
+from pyproj import CRS
+
+log = logging.getLogger(__name__)
+
+ESRI_DATE_FIELD = 'esriFieldTypeDate'
+
+
+def esri_json_to_geodataframe(responses: Iterable[Union[str, bytes, dict]]) -> Optional[geopandas.GeoDataFrame]:
+    """
+    decode ArcGIS query responses (Esri JSON, f=json/pjson) into a single GeoDataFrame. geometries of all
+    responses are built with vectorized shapely constructors instead of opening every response with GDAL.
+    returns None when no response holds any feature.
+    """
+    features = []
+    fields = []
+    crs = None
+    for response in responses:
+        data = json.loads(response) if isinstance(response, (str, bytes)) else response
+        if not data or 'features' not in data:
+            log.error(f'skipping Esri JSON response without features: {str(data)[:200]}')
+            continue
+
+        features += data['features']
+        fields += [f for f in data.get('fields', []) if f['name'] not in {field['name'] for field in fields}]
+        if crs is None and data.get('spatialReference'):
+            crs = esri_spatial_reference_to_crs(data['spatialReference'])
+
+    if not features:
+        return
+
+    columns = [f['name'] for f in fields] or list(dict.fromkeys(k for f in features for k in f.get('attributes', {})))
+    attributes = pd.DataFrame.from_records([f.get('attributes') or {} for f in features], columns=columns)
+    for field in fields:
+        if field.get('type') == ESRI_DATE_FIELD:
+            attributes[field['name']] = pd.to_datetime(attributes[field['name']], unit='ms', utc=True, errors='coerce')
+
+    geometries = esri_geometries_to_shapely([f.get('geometry') for f in features])
+    return geopandas.GeoDataFrame(attributes, geometry=geometries, crs=crs)
+
+
+def esri_spatial_reference_to_crs(spatial_reference: dict) -> Optional[CRS]:
+    for wkid in (spatial_reference.get('latestWkid'), spatial_reference.get('wkid')):
+        if wkid is None:
+            continue
+        for authority in ('EPSG', 'ESRI'):
+            try:
+                return CRS.from_authority(authority, str(wkid))
+            except Exception:
+                continue
+
+    if spatial_reference.get('wkt'):
+        return CRS.from_wkt(spatial_reference['wkt'])
+
+
+def esri_geometries_to_shapely(geometries: List[Optional[dict]]) -> np.ndarray:
+    """
+    Esri JSON geometries (points, multipoints, polylines, polygons) to a shapely array.
+    polygons with several outer rings become MultiPolygons, polylines with several paths MultiLineStrings.
+    """
+    out = np.full(len(geometries), None, dtype=object)
+
+    kinds = {'x': [], 'points': [], 'paths': [], 'rings': []}
+    for idx, geometry in enumerate(geometries):
+        if not geometry:
+            continue
+        kind = next((k for k in kinds if k in geometry), None)
+        if kind is not None:
+            kinds[kind].append(idx)
+
+    if kinds['x']:
+        idx = np.asarray(kinds['x'])
+        xy = np.array([[geometries[i]['x'], geometries[i].get('y')] for i in idx], dtype=float)
+        # Esri writes empty points as NaN coordinates
+        valid = ~np.isnan(xy).any(axis=1)
+        out[idx[valid]] = shapely.points(xy[valid])
+
+    if kinds['points']:
+        idx = np.asarray(kinds['points'])
+        out[idx] = [shapely.multipoints(_coordinates(geometries[i]['points'])) for i in idx]
+
+    if kinds['paths']:
+        idx = np.asarray(kinds['paths'])
+        out[idx] = _build_parts(shapely.linestrings, shapely.multilinestrings, [geometries[i]['paths'] for i in idx])
+
+    if kinds['rings']:
+        idx = np.asarray(kinds['rings'])
+        out[idx] = _polygons_from_rings([geometries[i]['rings'] for i in idx])
+
+    return out
+
+
+def _coordinates(part) -> np.ndarray:
+    # only x and y are kept; z and m values, when present, follow them
+    coordinates = np.asarray(part, dtype=float)
+    return coordinates[:, :2] if len(coordinates) else np.empty((0, 2))
+
+
+def _flatten_parts(parts_per_geometry):
+    """
+    coordinates of every part of every geometry, the part each coordinate belongs to and the geometry
+    each part belongs to
+    """
+    parts = [part for geometry_parts in parts_per_geometry for part in geometry_parts]
+    coordinates = _coordinates([xy for part in parts for xy in part])
+    part_idx = np.repeat(np.arange(len(parts)), [len(p) for p in parts])
+    geometry_idx = np.repeat(np.arange(len(parts_per_geometry)), [len(g) for g in parts_per_geometry])
+    return coordinates, part_idx, geometry_idx
+
+
+def _build_parts(part_constructor, multi_constructor, parts_per_geometry) -> np.ndarray:
+    coordinates, part_idx, geometry_idx = _flatten_parts(parts_per_geometry)
+    parts = part_constructor(coordinates, indices=part_idx)
+
+    out = np.full(len(parts_per_geometry), None, dtype=object)
+    part_counts = np.bincount(geometry_idx, minlength=len(parts_per_geometry))
+    starts = np.concatenate([[0], np.cumsum(part_counts)[:-1]])
+
+    single = part_counts == 1
+    out[single] = parts[starts[single]]
+    for i in np.flatnonzero(part_counts > 1):
+        out[i] = multi_constructor(parts[starts[i]:starts[i] + part_counts[i]])
+    return out
+
+
+def _polygons_from_rings(rings_per_geometry) -> np.ndarray:
+    """
+    Esri polygons list outer rings clockwise and holes counterclockwise, in no particular order.
+    polygons with one outer ring are built in one vectorized call; the rest assign each hole to
+    the outer ring containing it.
+    """
+    coordinates, ring_idx, geometry_idx = _flatten_parts(rings_per_geometry)
+    rings = shapely.linearrings(coordinates, indices=ring_idx)
+    is_hole = shapely.is_ccw(rings)
+
+    # within each geometry, outer rings first
+    order = np.lexsort((is_hole, geometry_idx))
+    rings, is_hole = rings[order], is_hole[order]
+
+    out = np.full(len(rings_per_geometry), None, dtype=object)
+    ring_counts = np.bincount(geometry_idx, minlength=len(rings_per_geometry))
+    shell_counts = np.bincount(geometry_idx, weights=(~is_hole).astype(float), minlength=len(rings_per_geometry))
+    starts = np.concatenate([[0], np.cumsum(ring_counts)[:-1]])
+
+    # a single outer ring, with holes that lie inside of it
+    simple = shell_counts == 1
+    hole_candidates = np.flatnonzero(simple[geometry_idx] & is_hole)
+    if len(hole_candidates):
+        shells = shapely.polygons(rings[starts[geometry_idx[hole_candidates]]])
+        outside = ~shapely.contains(shells, shapely.polygons(rings[hole_candidates]))
+        simple[geometry_idx[hole_candidates[outside]]] = False
+    if simple.any():
+        simple_rings = simple[geometry_idx]
+        _, polygon_idx = np.unique(geometry_idx[simple_rings], return_inverse=True)
+        out[simple] = shapely.polygons(rings[simple_rings], indices=polygon_idx)
+
+    for i in np.flatnonzero(~simple & (ring_counts > 0)):
+        out[i] = _organize_rings(rings[starts[i]:starts[i] + ring_counts[i]], is_hole[starts[i]:starts[i] + ring_counts[i]])
+
+    return out
+
+
+def _organize_rings(rings, is_hole):
+    shells = list(rings[~is_hole])
+    holes = [[] for _ in shells]
+    shell_polygons = shapely.polygons(rings[~is_hole])
+    for hole in rings[is_hole]:
+        containing = np.flatnonzero(shapely.contains(shell_polygons, shapely.Polygon(hole)))
+        if len(containing):
+            holes[containing[0]].append(hole)
+        else:
+            # a counterclockwise ring outside of every outer ring is an outer ring with bad orientation
+            shells.append(hole)
+            holes.append([])
+
+    polygons = shapely.polygons(shells, holes=None) if not any(holes) else np.array(
+        [shapely.Polygon(shell, h) for shell, h in zip(shells, holes)], dtype=object)
+    return polygons[0] if len(polygons) == 1 else shapely.multipolygons(polygons)
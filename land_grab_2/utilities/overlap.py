@@ -1,21 +1,40 @@
+import hashlib
 import itertools
 import json
 import logging
+import os
+import shutil
 import traceback
-from collections import Counter
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from functools import partial
-from typing import Optional, Any, Dict, Iterable
+from pathlib import Path
+from typing import Optional, Any, Iterable, Iterator, Tuple
 
 import geopandas
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import shapely
 from shapely import Polygon, MultiPolygon, make_valid, STRtree
 
-from land_grab_2.stl_dataset.step_1.constants import GIS_ACRES, FINAL_DATASET_COLUMNS, RIGHTS_TYPE, ACTIVITY, ACRES, \
+from land_grab_2.stl_dataset.step_1.constants import GIS_ACRES, FINAL_DATASET_COLUMNS, RIGHTS_TYPE, ACTIVITY, \
     GEOMETRY, OBJECT_ID, DATA_SOURCE
-from land_grab_2.utilities.utils import in_parallel, combine_delim_list, batch_iterable
+from land_grab_2.utilities.utils import in_parallel, combine_delim_list, get_uuid
 
 log = logging.getLogger(__name__)
+
+# activity layers with at least this many features are matched tile by tile from disk
+TILED_MATCH_MIN_FEATURES = int(os.environ.get('STAGE_2_TILED_MIN_FEATURES', 500_000))
+# leading partition values (states) whose decoded parcel indexes a worker keeps at once
+PARCEL_INDEX_CACHE_STATES = int(os.environ.get('STAGE_2_PARCEL_INDEX_STATES', 2))
+# side of a grid cell of a TiledLayer, in units of the parcels' crs (meters for Albers)
+DEFAULT_TILE_SIZE = 50_000
+TILE_ROW_COL = '__row'
+TILE_GEOMETRY_COL = '__wkb'
 STATE_LONG_NAME = {
     'AZ': 'arizona',
     'CO': 'colorado',
@@ -268,88 +287,409 @@ def fix_geometries(gdf):
     return gdf
 
 
-def is_possibly_same_feature(feature_1, feature_2, crs=None, tolerance: float = 0.15) -> bool:
-    return (
-        feature_1.contains(feature_2) or
-        feature_2.contains(feature_1) or
-        feature_1.overlaps(feature_2) or
-        feature_2.overlaps(feature_1) or
-        feature_1.within(feature_2) or
-        feature_2.within(feature_1) or
-        feature_1.covers(feature_2) or
-        feature_2.covers(feature_1) or
-        # feature_1.intersects(feature_2) or
-        # feature_2.intersects(feature_1) or
-        # feature_1.crosses(feature_2) or
-        # feature_2.crosses(feature_1) or
-
-        # feature_1.touches(feature_2) or
-        # feature_2.touches(feature_1) or
-
-        feature_1.boundary.contains(feature_2.envelope) or
-        feature_2.envelope.contains(feature_1.boundary) or
-        feature_1.boundary.overlaps(feature_2.envelope) or
-        feature_2.envelope.overlaps(feature_1.boundary) or
-        feature_1.boundary.within(feature_2.envelope) or
-        feature_2.envelope.within(feature_1.boundary) or
-        feature_1.boundary.covers(feature_2.envelope) or
-        feature_2.envelope.covers(feature_1.boundary) or
-        # feature_1.boundary.intersects(feature_2.envelope) or
-        # feature_2.envelope.intersects(feature_1.boundary) or
-        # feature_1.boundary.crosses(feature_2.envelope) or
-        # feature_2.envelope.crosses(feature_1.boundary) or
-
-        # feature_1.boundary.touches(feature_2.envelope) or
-        # feature_2.envelope.touches(feature_1.boundary) or
-
-        # is_same_geo_feature(feature_1, feature_2, crs=crs, tolerance=tolerance) or
-        False
+def possibly_same_features(geometries, other_geometries, boundaries=None, other_envelopes=None):
+    """
+    vectorized check over two aligned geometry arrays for whether each pair could be the same feature,
+    i.e. either geometry contains, covers or overlaps the other, or the same holds between the first
+    geometry's boundary and the second geometry's envelope.
+
+    the first array should be the (prepared) parcel side: every predicate is phrased with it as the
+    left-hand argument (`a.contains(b)` is evaluated as `b.within(a)` and so on) so GEOS can use the
+    prepared geometries, and each predicate only runs on the pairs that have not matched yet.
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    other_geometries = np.asarray(other_geometries, dtype=object)
+    boundaries = shapely.boundary(geometries) if boundaries is None else np.asarray(boundaries, dtype=object)
+    other_envelopes = (
+        shapely.envelope(other_geometries) if other_envelopes is None else np.asarray(other_envelopes, dtype=object)
     )
 
-
-def _tree_based_proximity_batch(grist_bounds=None, grist_data=None, crs=None, match_dist_threshold=None, batch=None):
-    other_envelopes = [None if g['geometry'] is None else g['geometry'].envelope for g in batch]
-    indices = STRtree(other_envelopes).nearest(grist_bounds)
-
-    pairs = sorted([
-        (
-            g['geometry'].boundary.distance(batch[i]['geometry'].envelope),
-            grist_idx,
-            g,
-            batch[i],
-            is_possibly_same_feature(g['geometry'], batch[i]['geometry'], crs=crs),
-            i
-        )
-        for grist_idx, (g, i) in enumerate(zip(grist_data, indices))
-        if g['geometry'].boundary.distance(batch[i]['geometry'].envelope) <= match_dist_threshold
-    ], key=lambda p: p[0])
-
-    return pairs
-    # return itertools.takewhile(lambda x: x[0] <= match_dist_threshold, pairs)
-
-
-def tree_based_proximity(grist_data: Iterable[Dict[str, Any]], other_data, crs, match_dist_threshold: float = 2.0,
-                         too_many_records=10_000):
-    grist_bounds = [g['geometry'].boundary for g in grist_data if g['geometry'] is not None]
-
+    checks = [
+        (shapely.contains, geometries, other_geometries),
+        (shapely.within, geometries, other_geometries),
+        (shapely.overlaps, geometries, other_geometries),
+        (shapely.covers, geometries, other_geometries),
+        (shapely.covered_by, geometries, other_geometries),
+        (shapely.contains, boundaries, other_envelopes),
+        (shapely.within, boundaries, other_envelopes),
+        (shapely.overlaps, boundaries, other_envelopes),
+        (shapely.covers, boundaries, other_envelopes),
+        (shapely.covered_by, boundaries, other_envelopes),
+    ]
+
+    is_possible = np.zeros(len(geometries), dtype=bool)
+    for predicate, left, right in checks:
+        remaining = np.flatnonzero(~is_possible)
+        if len(remaining) == 0:
+            break
+        is_possible[remaining] = predicate(left[remaining], right[remaining])
+
+    return is_possible
+
+
+def candidate_pair_scores(boundaries, other_envelopes):
+    """
+    match score for aligned parcel boundaries and feature envelopes, lower is closer
+    """
+    return shapely.distance(boundaries, other_envelopes)
+
+
+@dataclass
+class MatchSet:
+    """
+    Columnar matches between the parcels of a ParcelIndex and the features of another frame.
+    Only row positions are kept; attributes are read back from the original frames by position.
+    """
+    parcel_idx: np.ndarray
+    other_idx: np.ndarray
+    score: np.ndarray
+    contains: np.ndarray
+    # pairs the spatial index proposed before keeping each parcel's nearest feature
+    candidate_pairs: int = 0
+
+    @classmethod
+    def empty(cls, candidate_pairs=0):
+        return cls(np.empty(0, dtype=np.int64),
+                   np.empty(0, dtype=np.int64),
+                   np.empty(0, dtype=np.float64),
+                   np.empty(0, dtype=bool),
+                   candidate_pairs)
+
+    @classmethod
+    def concat(cls, match_sets):
+        match_sets = [m for m in match_sets if m is not None]
+        candidate_pairs = sum(m.candidate_pairs for m in match_sets)
+        match_sets = [m for m in match_sets if len(m) > 0]
+        if not match_sets:
+            return cls.empty(candidate_pairs)
+
+        return cls(np.concatenate([m.parcel_idx for m in match_sets]),
+                   np.concatenate([m.other_idx for m in match_sets]),
+                   np.concatenate([m.score for m in match_sets]),
+                   np.concatenate([m.contains for m in match_sets]),
+                   candidate_pairs)
+
+    def __len__(self):
+        return len(self.parcel_idx)
+
+    def __getitem__(self, item):
+        return MatchSet(self.parcel_idx[item], self.other_idx[item], self.score[item], self.contains[item],
+                        self.candidate_pairs)
+
+
+class ParcelIndex:
+    """
+    Spatial index over the STL parcels. Boundaries, envelopes and the STRtree are built
+    once and then queried by every activity layer.
+    """
+
+    def __init__(self, geometries, crs=None, positions=None):
+        self.crs = crs
+        self.geometries = np.asarray(geometries, dtype=object)
+        # row positions of the indexed parcels within the full parcel dataset
+        self.positions = np.arange(len(self.geometries)) if positions is None else np.asarray(positions)
+        self.boundaries = shapely.boundary(self.geometries)
+        self.envelopes = shapely.envelope(self.geometries)
+        self.tree = STRtree(self.boundaries)
+        shapely.prepare(self.geometries)
+        shapely.prepare(self.boundaries)
+
+    @classmethod
+    def from_geodataframe(cls, gdf, positions=None):
+        return cls(gdf.geometry.to_numpy(), crs=gdf.crs, positions=positions)
+
+    def __len__(self):
+        return len(self.geometries)
+
+    def query(self, other_envelopes, match_dist_threshold):
+        """
+        return aligned (parcel_idx, other_idx) arrays for every parcel boundary within
+        match_dist_threshold of one of other_envelopes
+        """
+        other_idx, parcel_idx = self.tree.query(other_envelopes, predicate='dwithin', distance=match_dist_threshold)
+        return parcel_idx, other_idx
+
+
+# per-process state of attached SharedParcels, keyed by file path
+_ATTACHED_PARCELS = {}
+
+
+class SharedParcels:
+    """
+    Parcel geometries (as WKB) and a few attribute columns, published once to a memory-mapped
+    Arrow IPC file. Process-based workers receive this small handle instead of a pickled copy of
+    the parcel GeoDataFrame; they map the file and only decode and index the partitions they query.
+    """
+
+    def __init__(self, path, crs=None, columns=None):
+        self.path = str(path)
+        self.crs = crs
+        self.columns = columns or []
+
+    @classmethod
+    def publish(cls, gdf, directory, columns):
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / f'shared-parcels-{get_uuid()}.arrow'
+
+        table = pa.table({
+            **{c: pa.array(gdf[c].astype(str).where(gdf[c].notna(), None), type=pa.string()) for c in columns},
+            GEOMETRY: pa.array(shapely.to_wkb(gdf.geometry.to_numpy()), type=pa.binary()),
+        })
+
+        tmp_path = path.with_suffix('.tmp')
+        with pa.OSFile(str(tmp_path), 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, path)
+
+        return cls(path, crs=gdf.crs, columns=columns)
+
+    def unlink(self):
+        _ATTACHED_PARCELS.pop(self.path, None)
+        Path(self.path).unlink(missing_ok=True)
+
+    def _attached(self):
+        if self.path not in _ATTACHED_PARCELS:
+            table = pa.ipc.open_file(pa.memory_map(self.path, 'r')).read_all()
+            _ATTACHED_PARCELS[self.path] = {'table': table, 'attributes': None, 'partitions': {},
+                                            'indexes': OrderedDict(), 'digests': {}}
+        return _ATTACHED_PARCELS[self.path]
+
+    def attributes(self) -> pd.DataFrame:
+        attached = self._attached()
+        if attached['attributes'] is None:
+            attached['attributes'] = attached['table'].select(self.columns).to_pandas()
+        return attached['attributes']
+
+    def partitions(self, by):
+        """
+        row positions of every distinct combination of the `by` columns
+        """
+        attached = self._attached()
+        by = tuple(by)
+        if by not in attached['partitions']:
+            groups = self.attributes().groupby(list(by), dropna=False, sort=False).indices
+            attached['partitions'][by] = {k if isinstance(k, tuple) else (k,): v for k, v in groups.items()}
+        return attached['partitions'][by]
+
+    def parcel_index(self, by, key) -> ParcelIndex:
+        """
+        the ParcelIndex of one partition. indexes are kept for the partitions of the last
+        PARCEL_INDEX_CACHE_STATES leading values (states) queried, so a worker that goes through every
+        state holds the decoded parcels of a few states rather than all of them.
+        """
+        attached = self._attached()
+        indexes = attached['indexes']
+        group = (tuple(by), key[0])
+        if group in indexes:
+            indexes.move_to_end(group)
+        else:
+            indexes[group] = {}
+            while len(indexes) > max(PARCEL_INDEX_CACHE_STATES, 1):
+                indexes.popitem(last=False)
+
+        if key not in indexes[group]:
+            positions = self.partitions(by)[key]
+            wkb = attached['table'].column(GEOMETRY).take(positions).to_numpy(zero_copy_only=False)
+            indexes[group][key] = ParcelIndex(shapely.from_wkb(wkb), crs=self.crs, positions=positions)
+        return indexes[group][key]
+
+    def digest(self, positions, key=None) -> str:
+        """
+        content hash of the attribute columns and geometry of the parcels at positions, in order. with a
+        key (ex: the state the positions are of), the hash is computed once per process and key.
+        """
+        attached = self._attached()
+        if key is not None and key in attached['digests']:
+            return attached['digests'][key]
+
+        table = attached['table'].take(positions)
+        digest = hashlib.sha256()
+        for column in self.columns + [GEOMETRY]:
+            values = pd.Series(table.column(column).to_numpy(zero_copy_only=False), dtype=object)
+            digest.update(pd.util.hash_pandas_object(values, index=False).to_numpy().tobytes())
+        if key is not None:
+            attached['digests'][key] = digest.hexdigest()
+        return digest.hexdigest()
+
+
+class TiledLayer:
+    """
+    The features of a layer spread over the cells of a square grid, one directory of GeoParquet-like
+    files (attributes, WKB geometry and the feature's row position in the layer) per cell. A feature
+    belongs to the cell holding the center of its envelope. Matching reads one cell at a time, so its
+    memory does not grow with the size of the layer.
+    """
+
+    def __init__(self, directory, crs=None):
+        self.directory = Path(directory)
+        self.crs = crs
+        self.attrs = {}
+
+    @classmethod
+    def write(cls, batches: Iterable[Tuple[pa.Table, np.ndarray]], directory, crs=None,
+              tile_size=DEFAULT_TILE_SIZE) -> 'TiledLayer':
+        """
+        write (attributes, geometries) batches, in layer order, to directory. attributes of batches read
+        from part of a layer carry the features' row positions in the whole layer as TILE_ROW_COL; others
+        are numbered in order. the directory is only replaced once every batch is written.
+        """
+        directory = Path(directory)
+        tmp_directory = directory.with_name(f'{directory.name}.{os.getpid()}.tmp')
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        tmp_directory.mkdir(parents=True)
+        try:
+            start = 0
+            for batch_no, (attributes, geometries) in enumerate(batches):
+                bounds = shapely.bounds(geometries)
+                centers = np.nan_to_num(np.column_stack([bounds[:, 0] + bounds[:, 2], bounds[:, 1] + bounds[:, 3]]) / 2)
+                cells = np.floor(centers / tile_size).astype(np.int64)
+                table = attributes
+                if TILE_ROW_COL not in table.column_names:
+                    table = table.append_column(TILE_ROW_COL, pa.array(np.arange(start, start + len(geometries))))
+                table = table.append_column(TILE_GEOMETRY_COL, pa.array(shapely.to_wkb(geometries), type=pa.binary()))
+                start += len(geometries)
+
+                cell_keys, cell_of_row = np.unique(cells, axis=0, return_inverse=True)
+                for cell_no, (x, y) in enumerate(cell_keys):
+                    tile_dir = tmp_directory / f'{x}_{y}'
+                    tile_dir.mkdir(exist_ok=True)
+                    rows = np.flatnonzero(cell_of_row.ravel() == cell_no)
+                    pq.write_table(table.take(rows), str(tile_dir / f'{batch_no:08d}.parquet'), compression='zstd')
+
+            shutil.rmtree(directory, ignore_errors=True)
+            os.replace(tmp_directory, directory)
+        except Exception:
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+            raise
+
+        return cls(directory, crs=crs)
+
+    @property
+    def tiles(self):
+        return sorted(d.name for d in self.directory.iterdir() if d.is_dir())
+
+    def __len__(self):
+        return sum(pq.read_metadata(str(f)).num_rows for f in self.directory.glob('*/*.parquet'))
+
+    def read_tile(self, tile) -> geopandas.GeoDataFrame:
+        """
+        the features of a tile in layer order, with their row positions in the layer as TILE_ROW_COL
+        """
+        table = pa.concat_tables([pq.read_table(str(f)) for f in sorted((self.directory / tile).glob('*.parquet'))])
+        table = table.take(pc.sort_indices(table, [(TILE_ROW_COL, 'ascending')]))
+        df = table.drop_columns([TILE_GEOMETRY_COL]).to_pandas()
+        geometries = shapely.from_wkb(table.column(TILE_GEOMETRY_COL).to_numpy(zero_copy_only=False))
+        return geopandas.GeoDataFrame(df, geometry=geometries, crs=self.crs)
+
+    def __iter__(self) -> Iterator[geopandas.GeoDataFrame]:
+        for tile in self.tiles:
+            yield self.read_tile(tile)
+
+
+def _nearest_positions(parcel_idx, other_idx, distances, groups=None):
+    # positions of the closest feature for each parcel (and group), ties going to the lowest feature index
+    groups = np.zeros(len(parcel_idx), dtype=np.int64) if groups is None else groups
+    order = np.lexsort((other_idx, distances, groups, parcel_idx))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (parcel_idx[order][1:] != parcel_idx[order][:-1]) | (groups[order][1:] != groups[order][:-1])
+    return order[first]
+
+
+def _nearest_per_parcel(parcel_idx, other_idx, distances, groups=None):
+    nearest = _nearest_positions(parcel_idx, other_idx, distances, groups)
+    return parcel_idx[nearest], other_idx[nearest], distances[nearest]
+
+
+def _tree_based_proximity_batch(parcel_index=None, other_geometries=None, match_dist_threshold=None, batch=None):
+    start, stop = batch
+    other_geometries = other_geometries[start:stop]
+    other_envelopes = shapely.envelope(other_geometries)
+
+    parcel_idx, other_idx = parcel_index.query(other_envelopes, match_dist_threshold)
+    candidate_pairs = len(parcel_idx)
+    scores = candidate_pair_scores(parcel_index.boundaries[parcel_idx], other_envelopes[other_idx])
+    parcel_idx, other_idx, scores = _nearest_per_parcel(parcel_idx, other_idx, scores)
+    contains = possibly_same_features(parcel_index.geometries[parcel_idx],
+                                      other_geometries[other_idx],
+                                      parcel_index.boundaries[parcel_idx],
+                                      other_envelopes[other_idx])
+
+    order = np.argsort(scores, kind='stable')
+    return MatchSet(parcel_index.positions[parcel_idx[order]],
+                    other_idx[order] + start,
+                    scores[order],
+                    contains[order],
+                    candidate_pairs)
+
+
+def _row_batches(rows, too_many_records):
+    # (start, stop) positions of the runs of ascending rows falling in the same too_many_records rows
+    if len(rows) == 0:
+        return []
+    stops = np.flatnonzero(np.diff(rows // too_many_records)) + 1
+    return list(zip(np.r_[0, stops].tolist(), np.r_[stops, len(rows)].tolist()))
+
+
+def tree_based_proximity(parcel_index: ParcelIndex, other_data, crs=None, match_dist_threshold: float = 2.0,
+                         too_many_records=10_000, other_rows=None) -> MatchSet:
+    """
+    match each parcel to its nearest feature of other_data, per batch of too_many_records rows of the layer.
+    when other_data holds part of a layer, other_rows are the ascending row positions of its features in
+    the whole layer, so the batches, and the matches, are those of the whole layer. other_idx in the
+    returned MatchSet are row positions in other_data.
+    """
+    crs = crs or parcel_index.crs
     other_data = (
         other_data.set_crs(crs, allow_override=True).to_crs(crs) if not other_data.crs else other_data.to_crs(crs)
     )
-    other_data_dicts = other_data.to_dict(orient='records')
-
-    batches = [other_data_dicts]
-    if len(other_data_dicts) > too_many_records:
-        batches = batch_iterable(other_data_dicts, too_many_records)
-
-    all_sorted_and_filtered_pairs = in_parallel(batches,
-                                                partial(_tree_based_proximity_batch,
-                                                        grist_bounds,
-                                                        grist_data,
-                                                        crs,
-                                                        match_dist_threshold),
-                                                scheduler='threads',
-                                                batched=False)
-
-    sorted_and_filtered_pairs_final = itertools.chain.from_iterable(all_sorted_and_filtered_pairs)
-
-    return sorted_and_filtered_pairs_final
+    other_geometries = other_data.geometry.to_numpy()
+
+    rows = np.arange(len(other_geometries)) if other_rows is None else np.asarray(other_rows)
+    batches = _row_batches(rows, too_many_records)
+
+    # threads share the parcel index as is; GEOS releases the GIL while querying and testing predicates
+    with ThreadPoolExecutor() as executor:
+        all_sorted_and_filtered_matches = list(executor.map(partial(_tree_based_proximity_batch,
+                                                                    parcel_index,
+                                                                    other_geometries,
+                                                                    match_dist_threshold),
+                                                            batches))
+
+    return MatchSet.concat(all_sorted_and_filtered_matches)
+
+
+def tile_proximity(parcel_index: ParcelIndex, other_geometries, other_rows, match_dist_threshold: float = 2.0,
+                   too_many_records=10_000) -> MatchSet:
+    """
+    tree_based_proximity over one tile of a TiledLayer: each parcel's nearest feature of the tile per batch
+    of too_many_records rows of the whole layer. other_idx are row positions in the layer. pass the
+    MatchSets of every tile to merge_tile_matches for the result tree_based_proximity gives on the layer.
+    """
+    other_geometries = np.asarray(other_geometries, dtype=object)
+    other_rows = np.asarray(other_rows)
+    other_envelopes = shapely.envelope(other_geometries)
+
+    parcel_idx, other_idx = parcel_index.query(other_envelopes, match_dist_threshold)
+    candidate_pairs = len(parcel_idx)
+    scores = candidate_pair_scores(parcel_index.boundaries[parcel_idx], other_envelopes[other_idx])
+    parcel_idx, other_idx, scores = _nearest_per_parcel(parcel_idx, other_idx, scores,
+                                                        other_rows[other_idx] // too_many_records)
+    contains = possibly_same_features(parcel_index.geometries[parcel_idx],
+                                      other_geometries[other_idx],
+                                      parcel_index.boundaries[parcel_idx],
+                                      other_envelopes[other_idx])
+
+    return MatchSet(parcel_index.positions[parcel_idx], other_rows[other_idx], scores, contains, candidate_pairs)
+
+
+def merge_tile_matches(match_sets, too_many_records=10_000) -> MatchSet:
+    """
+    keep each parcel's nearest feature per batch over the matches of every tile, in the order
+    tree_based_proximity returns them: by batch, then score
+    """
+    matches = MatchSet.concat(match_sets)
+    matches = matches[_nearest_positions(matches.parcel_idx, matches.other_idx, matches.score,
+                                         matches.other_idx // too_many_records)]
+    return matches[np.lexsort((matches.parcel_idx, matches.score, matches.other_idx // too_many_records))]
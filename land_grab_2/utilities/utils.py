@@ -1,4 +1,6 @@
+import asyncio
 import functools
+import hashlib
 import itertools
 import json
 import logging
@@ -7,6 +9,7 @@ import shutil
 import smtplib
 import time
 import uuid
+from datetime import datetime, timezone
 from email.message import EmailMessage
 from pathlib import Path
 from typing import Optional
@@ -14,6 +17,8 @@ from typing import Optional
 import dask
 import dask.bag
 import geopandas
+import pandas as pd
+import pyarrow as pa
 import requests
 from compose import compose
 from dask.diagnostics import ProgressBar
@@ -181,62 +186,194 @@ def read_json(p: Path):
 
 
 class GristCache:
-    CACHE_DIR = None
+    """
+    cache of data fetched from a source location, one directory per stable digest of the location and
+    request parameters. frames are stored as zstd-compressed (geo)parquet and everything else as
+    zstd-compressed json, each written atomically next to a metadata file. once the cache grows past
+    MAX_BYTES the least recently used entries are evicted, down to EVICT_TO_FRACTION of it.
+    """
 
-    def __init__(self, location, cache_dir=None):
+    CACHE_DIR = None
+    SUBDIR = "grist"
+    COMPRESSION = "zstd"
+    MAX_BYTES = int(os.environ.get("GRIST_CACHE_MAX_BYTES", 20 * 1024**3))
+    # eviction frees space down to this share of MAX_BYTES, so a full cache is not scanned on every write
+    EVICT_TO_FRACTION = 0.9
+    # temp files older than this are left over from crashed writes
+    STALE_TMP_SECONDS = 24 * 60 * 60
+    # this process's running estimate of the cache size: its last scan plus what it wrote since
+    _estimated_bytes = None
+
+    def __init__(self, location, cache_dir=None, params=None):
         self.location = location
+        self.params = params or {}
         if not GristCache.CACHE_DIR:
             GristCache.CACHE_DIR = cache_dir
         self.base_dir = GristCache.CACHE_DIR
 
-    def cache_write(self, obj, name, file_ext=".json"):
-        """
-        this function requires the ENV var: PYTHONHASHSEED to be set to ensure stable hashing between runs
-        """
-        here = self.base_dir / f"{hash(self.location)}"
-        if not here.exists():
-            here.mkdir(exist_ok=True, parents=True)
+    @property
+    def key(self) -> str:
+        source = json.dumps(
+            {"location": self.location, "params": self.params},
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(source.encode()).hexdigest()
 
-        cached_file = here / f"{name}{file_ext}"
+    @property
+    def here(self) -> Path:
+        return Path(self.base_dir) / self.SUBDIR / self.key
 
-        log.info(f"writing to cache: {str(cached_file)}")
-        if "json" in file_ext:
-            with cached_file.open("w") as fp:
-                json.dump(obj, fp)
+    def cache_write(self, obj, name):
+        here = self.here
+        here.mkdir(exist_ok=True, parents=True)
+
+        if isinstance(obj, pd.DataFrame):
+            payload_format = (
+                "geoparquet" if isinstance(obj, geopandas.GeoDataFrame) else "parquet"
+            )
+            cached_file = here / f"{name}.parquet"
 
+            def write_payload(path):
+                obj.to_parquet(str(path), compression=self.COMPRESSION)
+
+        else:
+            payload_format = "json"
+            cached_file = here / f"{name}.json.zst"
+
+            def write_payload(path):
+                with pa.output_stream(str(path), compression=self.COMPRESSION) as out:
+                    out.write(json.dumps(obj).encode())
+
+        log.info(f"writing to cache: {str(cached_file)}")
         try:
-            if "feather" in file_ext:
-                obj.to_feather(str(cached_file))
+            replaced_bytes = cached_file.stat().st_size if cached_file.exists() else 0
+            atomic_write(cached_file, write_payload)
+            metadata = {
+                "file": cached_file.name,
+                "format": payload_format,
+                "source": self.location,
+                "params": self.params,
+                "created": datetime.now(timezone.utc).isoformat(),
+                "rows": len(obj) if isinstance(obj, (pd.DataFrame, list)) else None,
+                "bytes": cached_file.stat().st_size,
+            }
+            # the metadata file marks the entry complete, so it is written last
+            atomic_write(
+                here / f"{name}.meta.json",
+                lambda path: path.write_text(json.dumps(metadata, default=str)),
+            )
         except Exception as err:
             log.error(
-                f"CacheWriteError during feather WRITE path: {str(cached_file)} err: {err}"
+                f"CacheWriteError during {payload_format} WRITE path: {str(cached_file)} err: {err}"
             )
+            return
+
+        GristCache.account(metadata["bytes"] - replaced_bytes)
 
-    def cache_read(self, name, file_ext=".json"):
+    def cache_metadata(self, name):
         """
-        this function requires the ENV var: PYTHONHASHSEED to be set to ensure stable hashing between runs
+        the metadata of a complete entry (format, rows, bytes, ...) without reading its payload
         """
-        here = self.base_dir / f"{hash(self.location)}"
-
-        if not here.exists():
-            here.mkdir(exist_ok=True, parents=True)
+        metadata_file = self.here / f"{name}.meta.json"
+        try:
+            return json.loads(metadata_file.read_text())
+        except (OSError, ValueError):
+            return None
 
-        cached_file = here / f"{name}{file_ext}"
-        if not cached_file.exists():
-            log.info(f"cache-miss for: {str(cached_file)}")
+    def cache_read(self, name):
+        metadata_file = self.here / f"{name}.meta.json"
+        if not metadata_file.exists():
+            log.info(f"cache-miss for: {str(metadata_file)}")
             return None
 
-        log.info(f"reading from cache: {str(cached_file)}")
-        if "json" in file_ext:
-            with cached_file.open("r") as fp:
-                return json.load(fp)
         try:
-            if "feather" in file_ext:
-                return geopandas.read_feather(str(cached_file))
+            metadata = json.loads(metadata_file.read_text())
+            cached_file = self.here / metadata["file"]
+            log.info(f"reading from cache: {str(cached_file)}")
+            if metadata["format"] == "json":
+                with pa.input_stream(
+                    str(cached_file), compression=self.COMPRESSION
+                ) as fp:
+                    obj = json.loads(fp.read())
+            elif metadata["format"] == "geoparquet":
+                obj = geopandas.read_parquet(str(cached_file))
+            else:
+                obj = pd.read_parquet(str(cached_file))
+
+            # the payload's mtime is its last use, for eviction
+            os.utime(cached_file)
+            return obj
         except Exception as err:
-            log.error(
-                f"CacheReadError during feather READ path: {str(cached_file)} err: {err}"
-            )
+            log.error(f"CacheReadError: {str(metadata_file)} err: {err}")
+
+    @classmethod
+    def account(cls, written_bytes):
+        """
+        add a write to the running estimate of the cache size. the cache directory is only scanned, and
+        entries evicted, on a process's first write and once the estimate passes MAX_BYTES; writes of
+        other processes are picked up by the next scan, or the one at the end of the stage.
+        """
+        if cls._estimated_bytes is None or cls._estimated_bytes + written_bytes > cls.MAX_BYTES:
+            cls.evict()
+        else:
+            cls._estimated_bytes += written_bytes
+
+    @classmethod
+    def evict(cls, max_bytes=None):
+        """
+        when the cache is over max_bytes, drop least recently used entries until it is within
+        EVICT_TO_FRACTION of max_bytes
+        """
+        if not cls.CACHE_DIR:
+            return
+        max_bytes = cls.MAX_BYTES if max_bytes is None else max_bytes
+        root = Path(cls.CACHE_DIR) / cls.SUBDIR
+        if not root.exists():
+            cls._estimated_bytes = 0
+            return
+
+        now = time.time()
+        entries = []
+        for path in root.glob("*/*"):
+            try:
+                if path.name.endswith(".tmp"):
+                    if now - path.stat().st_mtime > cls.STALE_TMP_SECONDS:
+                        path.unlink(missing_ok=True)
+                    continue
+
+                if not path.name.endswith(".meta.json"):
+                    continue
+
+                cached_file = path.parent / json.loads(path.read_text())["file"]
+                stat = cached_file.stat()
+                entries.append((stat.st_mtime, stat.st_size, path, cached_file))
+            except Exception:
+                # entries removed or being written by another process
+                continue
+
+        total = sum(size for _, size, _, _ in entries)
+        target = max_bytes * cls.EVICT_TO_FRACTION if total > max_bytes else max_bytes
+        for _, size, metadata_file, cached_file in sorted(entries, key=lambda e: e[0]):
+            if total <= target:
+                break
+            log.info(f"evicting from cache: {str(cached_file)}")
+            metadata_file.unlink(missing_ok=True)
+            cached_file.unlink(missing_ok=True)
+            total -= size
+        cls._estimated_bytes = total
+
+
+def atomic_write(path: Path, write):
+    """
+    call write on a temp file next to path, then move it into place
+    """
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{get_uuid()}.tmp")
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
 
 
 def fetch_remote(
@@ -379,6 +516,73 @@ def fetch_all_parcel_ids(url_base, retries=10):
             return None
 
 
+class RemoteFetchError(Exception):
+    """a chunk of a remote layer could not be fetched, so the layer is incomplete"""
+
+
+def fetch_remote_chunk(url_base, object_ids, retries=10):
+    """
+    fetch the features of object_ids from an ArcGIS layer query endpoint with a single POST.
+    when the server truncates the response (exceededTransferLimit) the chunk is split in half
+    and each half refetched. returns the list of pjson response texts covering object_ids, or
+    raises RemoteFetchError once the retries are used up.
+    """
+    url_query = {
+        "where": "1=1",
+        "objectIds": ",".join(str(i) for i in object_ids),
+        "outFields": "*",
+        "returnGeometry": "true",
+        "returnZ": "false",
+        "returnM": "false",
+        "f": "pjson",
+    }
+
+    try:
+        # POST since a chunk of objectIds easily exceeds the url length servers accept
+        response = requests.post(url=url_base, data=url_query)
+        response.raise_for_status()
+        data = response.json()
+        if "error" in data:
+            raise Exception(data["error"])
+    except Exception as err:
+        if retries > 0:
+            time.sleep(5)
+            return fetch_remote_chunk(url_base, object_ids, retries=retries - 1)
+        raise RemoteFetchError(
+            f"failed fetching {len(object_ids)} features (object ids {min(object_ids)}-{max(object_ids)}) "
+            f"from {url_base}: {err}"
+        ) from err
+
+    if data.get("exceededTransferLimit") and len(object_ids) > 1:
+        half = len(object_ids) // 2
+        return fetch_remote_chunk(url_base, object_ids[:half], retries) + fetch_remote_chunk(
+            url_base, object_ids[half:], retries
+        )
+
+    return [response.text]
+
+
+async def _fetch_remote_chunks(url_base, chunks, max_concurrency):
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def fetch(chunk):
+        async with semaphore:
+            return await asyncio.to_thread(fetch_remote_chunk, url_base, chunk)
+
+    return await asyncio.gather(*(fetch(chunk) for chunk in chunks))
+
+
+def fetch_remote_features(url_base, object_ids, chunk_size=500, max_concurrency=8):
+    """
+    fetch the features of object_ids in chunks of chunk_size, at most max_concurrency requests at a
+    time. returns the pjson response texts in object id order. raises RemoteFetchError when a chunk
+    cannot be fetched, rather than returning part of the layer.
+    """
+    chunks = batch_iterable(sorted(object_ids), chunk_size)
+    responses = asyncio.run(_fetch_remote_chunks(url_base, chunks, max_concurrency))
+    return list(itertools.chain.from_iterable(responses))
+
+
 def _to_kebab_case(string):
     """convert string to kebab case"""
     if "_" in string:
@@ -479,3 +683,35 @@ def combine_delim_list(old_val, update_val, sep="+"):
 
 def index_of(it, f, default=-1):
     return next((i for i, e in enumerate(it) if f(e)), default)
+
+
+def write_geoparquet(gdf, path):
+    """
+    write a stage output as zstd GeoParquet with a bbox covering column, so readers can skip row
+    groups outside an extent. written atomically, so a reader never sees half a file.
+    """
+    path = Path(path)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    try:
+        gdf.to_parquet(
+            str(tmp_path),
+            compression=GristCache.COMPRESSION,
+            write_covering_bbox="bbox" not in gdf.columns,
+        )
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def read_geodata(path, **kwargs) -> geopandas.GeoDataFrame:
+    """
+    read a stage output by its geojson path: from its GeoParquet sibling when there is one at least as
+    new as the geojson, else from the geojson itself
+    """
+    path = Path(path)
+    parquet_path = path.with_suffix(".parquet")
+    if parquet_path.exists() and (
+        not path.exists() or parquet_path.stat().st_mtime >= path.stat().st_mtime
+    ):
+        return geopandas.read_parquet(str(parquet_path), **kwargs)
+    return geopandas.read_file(str(path), **kwargs)
@@ -3,7 +3,7 @@ import typer
 
 from land_grab_2.stl_dataset.step_1 import build_dataset
 from land_grab_2.stl_dataset.step_4 import compute_summary
-from land_grab_2.stl_dataset.step_2.land_activity_search import activity_match
+from land_grab_2.stl_dataset.step_2.land_activity_search import activity_match, benchmark
 from land_grab_2.uni_holdings_dataset import check_overlap, reverse_search
 import land_grab_2.stl_dataset.step_3.cession_purchase_price as cession_purchase_price
 from land_grab_2.stl_dataset.step_2_5 import get_cessions
@@ -12,18 +12,28 @@ app = typer.Typer()
 
 
 @app.command()
-def stl_stage_1():
-    build_dataset.run()
+def stl_stage_1(fused: bool = False, spill: bool = False, geojson: bool = False):
+    build_dataset.run(fused, spill, geojson)
 
 
 @app.command()
-def stl_stage_2():
-    activity_match.run()
+def stl_stage_2(geojson: bool = False, deep_dive: bool = False):
+    activity_match.run(geojson, deep_dive)
 
 
 @app.command()
-def stl_stage_2_5():
-    get_cessions.run()
+def stl_stage_2_benchmark(sizes: str = "1000,10000,100000,1000000", out_path: str = None):
+    benchmark.run([int(n) for n in sizes.split(",")], out_path)
+
+
+@app.command()
+def stl_stage_2_benchmark_compare(baseline_path: str, candidate_path: str):
+    benchmark.compare(baseline_path, candidate_path)
+
+
+@app.command()
+def stl_stage_2_5(geojson: bool = False):
+    get_cessions.run(geojson)
 
 
 @app.command()
@@ -0,0 +1,148 @@
+"""
+A stand-in ArcGIS FeatureServer layer for the tests: an http.server on localhost serving point
+features from memory through the parts of the REST query api the pipeline uses.
+"""
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+OBJECT_ID = "OBJECTID"
+
+
+def _literal(token):
+    token = token.strip()
+    if token.startswith("'"):
+        return token[1:-1].replace("''", "'")
+    return float(token)
+
+
+class StubLayer:
+    """
+    one layer at <url>, answering layer info and /query requests by GET or POST.
+
+    max_record_count is the page size the layer advertises, while responses hold at most page_cap
+    features, so a page_cap below it makes the server truncate pages and flag exceededTransferLimit,
+    in properties for geojson and at the top level for esri json. case_insensitive compares strings in
+    where clauses ignoring case and trailing blanks, like SQL Server. every request is recorded in
+    requests as (method, params).
+    """
+
+    def __init__(self, attributes, max_record_count=100, page_cap=None, pagination=True,
+                 case_insensitive=False):
+        self.attributes = [{OBJECT_ID: i + 1, **a} for i, a in enumerate(attributes)]
+        self.max_record_count = max_record_count
+        self.page_cap = page_cap or max_record_count
+        self.pagination = pagination
+        self.case_insensitive = case_insensitive
+        self.requests = []
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/arcgis/rest/services/stub/FeatureServer/0"
+
+    def queries(self, **match):
+        """the recorded /query parameters holding every key and value of match"""
+        return [p for m, p in self.requests if p.get("_path", "").endswith("/query")
+                and all(p.get(k) == v for k, v in match.items())]
+
+    def __enter__(self):
+        layer = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                self._answer("GET", url.path, parse_qs(url.query))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+                self._answer("POST", urlparse(self.path).path, parse_qs(body))
+
+            def _answer(self, method, path, params):
+                params = {k: v[0] for k, v in params.items()}
+                with layer._lock:
+                    layer.requests.append((method, {**params, "_path": path}))
+                body = json.dumps(layer.respond(path, params)).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _equal(self, value, literal):
+        if isinstance(literal, str):
+            if not isinstance(value, str):
+                return False
+            if self.case_insensitive:
+                return value.rstrip().casefold() == literal.rstrip().casefold()
+            return value == literal
+        return not isinstance(value, str) and value == literal
+
+    def _selects(self, where, attributes):
+        where = (where or "1=1").strip()
+        if where == "1=1":
+            return True
+        match = re.fullmatch(r"(\w+)\s+IN\s+\((.*)\)", where, re.S)
+        if match:
+            literals = [_literal(t) for t in re.findall(r"'(?:[^']|'')*'|[-\d.]+", match.group(2))]
+        else:
+            match = re.fullmatch(r"(\w+)\s*=\s*(.*)", where, re.S)
+            literals = [_literal(match.group(2))]
+        return any(self._equal(attributes.get(match.group(1)), literal) for literal in literals)
+
+    def respond(self, path, params):
+        if not path.endswith("/query"):
+            return {
+                "maxRecordCount": self.max_record_count,
+                "objectIdField": OBJECT_ID,
+                "advancedQueryCapabilities": {"supportsPagination": self.pagination},
+                "editingInfo": {"lastEditDate": 1700000000000},
+                "fields": [{"name": OBJECT_ID, "type": "esriFieldTypeOID"}],
+            }
+
+        selected = [a for a in self.attributes if self._selects(params.get("where"), a)]
+        if params.get("returnCountOnly") == "true":
+            return {"count": len(selected)}
+        if params.get("returnIdsOnly") == "true":
+            return {"objectIdFieldName": OBJECT_ID, "objectIds": [a[OBJECT_ID] for a in selected]}
+        if params.get("returnExtentOnly") == "true":
+            xs = [a[OBJECT_ID] for a in selected] or [0]
+            return {"extent": {"xmin": min(xs), "ymin": 0, "xmax": max(xs), "ymax": 0}}
+
+        if params.get("objectIds"):
+            ids = {int(i) for i in params["objectIds"].split(",")}
+            selected = [a for a in selected if a[OBJECT_ID] in ids]
+            limit = len(selected)
+        else:
+            selected = sorted(selected, key=lambda a: a[params.get("orderByFields") or OBJECT_ID])
+            offset = int(params.get("resultOffset") or 0)
+            limit = min(int(params.get("resultRecordCount") or self.max_record_count), self.max_record_count)
+            selected = selected[offset:]
+
+        page = selected[:min(limit, self.page_cap)]
+        exceeded = len(page) < len(selected)
+        if params.get("f") == "geojson":
+            response = {"type": "FeatureCollection", "features": [
+                {"type": "Feature", "id": a[OBJECT_ID], "properties": a,
+                 "geometry": {"type": "Point", "coordinates": [a[OBJECT_ID], 0.0]}} for a in page]}
+            if exceeded:
+                response["properties"] = {"exceededTransferLimit": True}
+            return response
+        return {"objectIdFieldName": OBJECT_ID, "geometryType": "esriGeometryPoint",
+                "features": [{"attributes": a, "geometry": {"x": a[OBJECT_ID], "y": 0.0}} for a in page],
+                "exceededTransferLimit": exceeded}
@@ -0,0 +1,5 @@
+import os
+from pathlib import Path
+
+# the constants module needs the data directory at import; the repo's own is enough for the tests
+os.environ.setdefault('DATA', str(Path(__file__).resolve().parents[1] / 'data'))
@@ -0,0 +1,65 @@
+import geopandas
+import numpy as np
+import pytest
+import shapely
+
+from land_grab_2.stl_dataset.step_2.land_activity_search.entities import StateActivityDataSource, \
+    read_local_batches
+from land_grab_2.utilities.overlap import TILE_ROW_COL, ParcelIndex, TiledLayer, merge_tile_matches, \
+    tile_proximity, tree_based_proximity
+from land_grab_2.utilities.utils import GristCache
+
+CRS = 'EPSG:5070'
+BATCH = 100
+THRESHOLD = 2.0
+
+
+@pytest.fixture
+def layer(tmp_path, monkeypatch):
+    """
+    a shapefile whose even features lie on a grid of parcels and odd ones far away, so a read of the
+    parcels' extent skips every other row of the layer
+    """
+    monkeypatch.setattr(GristCache, 'CACHE_DIR', None)
+    rng = np.random.default_rng(0)
+    n = 1000
+    x = np.where(np.arange(n) % 2, 1e6, 0) + rng.uniform(0, 100, n)
+    y = rng.uniform(0, 100, n)
+    features = geopandas.GeoDataFrame({'Type': [f't{i % 7}' for i in range(n)]},
+                                      geometry=shapely.box(x, y, x + rng.uniform(1, 20, n), y + 5), crs=CRS)
+    features.to_file(tmp_path / 'layer.shp', engine='pyogrio')
+
+    px, py = np.meshgrid(np.arange(0, 100, 10.0), np.arange(0, 100, 10.0))
+    parcels = ParcelIndex(shapely.box(px.ravel(), py.ravel(), px.ravel() + 8, py.ravel() + 8), crs=CRS)
+    return StateActivityDataSource('layer', str(tmp_path / 'layer.shp')), parcels
+
+
+def _fid_matches(matches, rows):
+    return list(zip(matches.parcel_idx.tolist(), np.asarray(rows)[matches.other_idx].tolist(),
+                    matches.score.tolist(), matches.contains.tolist()))
+
+
+def test_bbox_read_matches_like_the_whole_layer(tmp_path, layer):
+    source, parcels = layer
+    whole = source.load_local(tmp_path, CRS)
+    near = source.load_local(tmp_path, CRS, bbox=(-THRESHOLD, -THRESHOLD, 120 + THRESHOLD, 120 + THRESHOLD))
+    assert len(near) < len(whole)
+    assert near.index.tolist() == list(range(0, len(whole), 2))
+
+    expected = tree_based_proximity(parcels, whole, CRS, THRESHOLD, BATCH)
+    matches = tree_based_proximity(parcels, near, CRS, THRESHOLD, BATCH, other_rows=near.index.to_numpy())
+    assert _fid_matches(matches, near.index) == _fid_matches(expected, whole.index)
+
+
+def test_bbox_read_tiles_keep_the_layer_rows(tmp_path, layer):
+    source, parcels = layer
+    whole = source.load_local(tmp_path, CRS)
+    expected = tree_based_proximity(parcels, whole, CRS, THRESHOLD, BATCH)
+
+    bbox = (-THRESHOLD, -THRESHOLD, 120 + THRESHOLD, 120 + THRESHOLD)
+    tiled = TiledLayer.write(read_local_batches(source.location, CRS, bbox=bbox, batch_size=64),
+                             tmp_path / 'tiles', crs=CRS, tile_size=30)
+    tile_matches = [tile_proximity(parcels, tile.geometry.to_numpy(), tile[TILE_ROW_COL], THRESHOLD, BATCH)
+                    for tile in tiled]
+    matches = merge_tile_matches(tile_matches, BATCH)
+    assert _fid_matches(matches, np.arange(len(whole))) == _fid_matches(expected, whole.index)
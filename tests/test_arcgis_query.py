@@ -0,0 +1,84 @@
+from land_grab_2.stl_dataset.step_1.arcgis_query import PagedQuery, features_by_code, in_clause
+from tests.arcgis_stub import OBJECT_ID, StubLayer
+
+TYPES = ["PH", "ph ", "GR", "OG"]
+
+
+def _attributes(n):
+    return [{"Type": TYPES[i % len(TYPES)], "Code": 900 + i % 3} for i in range(n)]
+
+
+def _ids(features):
+    return sorted(f["properties"][OBJECT_ID] for f in features)
+
+
+def test_offset_paging():
+    with StubLayer(_attributes(250), max_record_count=100) as layer:
+        features = PagedQuery(layer.url).features(max_workers=2)
+
+        assert _ids(features) == list(range(1, 251))
+        offsets = sorted(int(p["resultOffset"]) for p in layer.queries(f="geojson"))
+        assert offsets == [0, 100, 200]
+
+
+def test_object_id_paging_without_pagination_support():
+    with StubLayer(_attributes(250), max_record_count=100, pagination=False) as layer:
+        features = PagedQuery(layer.url, where="Type IN ('GR')").features()
+
+        assert _ids(features) == [i for i in range(1, 251) if TYPES[(i - 1) % len(TYPES)] == "GR"]
+        pages = layer.queries(f="geojson")
+        assert pages and all("objectIds" in p and "resultOffset" not in p for p in pages)
+
+
+def test_truncated_pages_are_completed():
+    # the layer advertises pages of 100 but answers 40 at a time, flagging it in the geojson properties
+    with StubLayer(_attributes(250), max_record_count=100, page_cap=40) as layer:
+        features = PagedQuery(layer.url).features()
+
+        assert _ids(features) == list(range(1, 251))
+        assert len(features) == 250
+
+
+def test_checkpointed_pages_are_reused(tmp_path):
+    with StubLayer(_attributes(250), max_record_count=100) as layer:
+        first = PagedQuery(layer.url, page_dir=tmp_path).features()
+        fetched = len(layer.queries(f="geojson"))
+        second = PagedQuery(layer.url, page_dir=tmp_path).features()
+
+        assert _ids(first) == _ids(second)
+        assert len(layer.queries(f="geojson")) == fetched
+
+
+def test_split_by_code_on_an_exact_store():
+    codes = ["'PH'", "'GR'", 901, "'NONE'"]
+    with StubLayer(_attributes(100)) as layer:
+        features = PagedQuery(layer.url, where=in_clause("Type", codes)).features()
+        split = features_by_code(layer.url, features, "Type", codes)
+
+        assert {f["properties"]["Type"] for f in split["'PH'"]} == {"PH"}
+        assert {f["properties"]["Type"] for f in split["'GR'"]} == {"GR"}
+        assert split[901] == [] and split["'NONE'"] == []
+        # the counts agreed, so no code was queried on its own
+        assert not [p for p in layer.queries(f="geojson") if "=" in p["where"] and " IN " not in p["where"]]
+
+
+def test_split_by_code_follows_the_server_collation():
+    # a SQL Server style store selects 'ph ' for Type='PH' too; the split must file it the same way
+    codes = ["'PH'", "'GR'"]
+    with StubLayer(_attributes(100), case_insensitive=True) as layer:
+        features = PagedQuery(layer.url, where=in_clause("Type", codes)).features()
+        split = features_by_code(layer.url, features, "Type", codes)
+
+        assert {f["properties"]["Type"] for f in split["'PH'"]} == {"PH", "ph "}
+        assert len(split["'PH'"]) == 50
+        assert {f["properties"]["Type"] for f in split["'GR'"]} == {"GR"}
+        assert layer.queries(f="geojson", where="Type='PH'")
+
+
+def test_split_by_numeric_code():
+    with StubLayer(_attributes(90)) as layer:
+        features = PagedQuery(layer.url, where=in_clause("Code", [900, 902])).features()
+        split = features_by_code(layer.url, features, "Code", [900, 902])
+
+        assert len(split[900]) == len(split[902]) == 30
+        assert {f["properties"]["Code"] for f in split[902]} == {902}
@@ -0,0 +1,45 @@
+import json
+
+import pytest
+
+from land_grab_2.utilities.utils import RemoteFetchError, fetch_remote_chunk, fetch_remote_features
+from tests.arcgis_stub import OBJECT_ID, StubLayer
+
+
+def _attributes(n):
+    return [{"Type": f"t{i % 5}"} for i in range(n)]
+
+
+def _object_ids(responses):
+    return [f["attributes"][OBJECT_ID] for text in responses for f in json.loads(text)["features"]]
+
+
+def test_features_are_fetched_in_chunked_posts():
+    with StubLayer(_attributes(1200), max_record_count=2000) as layer:
+        responses = fetch_remote_features(f"{layer.url}/query", list(range(1200, 0, -1)), chunk_size=500)
+
+        assert _object_ids(responses) == list(range(1, 1201))
+        posts = [params for method, params in layer.requests if method == "POST"]
+        assert len(posts) == len(layer.requests) == 3
+        assert sorted(len(p["objectIds"].split(",")) for p in posts) == [200, 500, 500]
+
+
+def test_truncated_chunks_are_split():
+    # the layer answers at most 150 features, flagging exceededTransferLimit at the top level of esri json
+    with StubLayer(_attributes(1000), max_record_count=2000, page_cap=150) as layer:
+        responses = fetch_remote_features(f"{layer.url}/query", list(range(1, 1001)), chunk_size=500)
+
+        assert _object_ids(responses) == list(range(1, 1001))
+        sizes = [len(p["objectIds"].split(",")) for _, p in layer.requests]
+        # 500 -> 250 -> 125 for each of the two chunks
+        assert sorted(set(sizes)) == [125, 250, 500]
+        assert all(not json.loads(text)["exceededTransferLimit"] for text in responses)
+
+
+def test_a_chunk_that_cannot_be_fetched_fails_the_layer():
+    with StubLayer(_attributes(10)) as layer:
+        url = f"{layer.url}/query"
+
+    # the server is gone
+    with pytest.raises(RemoteFetchError, match=r"object ids 3-7\) from .*/FeatureServer/0/query"):
+        fetch_remote_chunk(url, [3, 4, 5, 6, 7], retries=0)
@@ -0,0 +1,43 @@
+import pytest
+
+from land_grab_2.utilities.utils import GristCache
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(GristCache, 'CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(GristCache, '_estimated_bytes', None)
+    scans = []
+    evict = GristCache.evict.__func__
+    monkeypatch.setattr(GristCache, 'evict', classmethod(lambda cls, max_bytes=None: (scans.append(1),
+                                                                                      evict(cls, max_bytes))))
+    return tmp_path, scans
+
+
+def _payload_bytes(tmp_path):
+    return sum(f.stat().st_size for f in (tmp_path / GristCache.SUBDIR).glob('*/*.zst'))
+
+
+def test_writes_within_budget_scan_the_cache_once(cache, monkeypatch):
+    tmp_path, scans = cache
+    monkeypatch.setattr(GristCache, 'MAX_BYTES', 10**9)
+    for i in range(200):
+        GristCache(f'location-{i}').cache_write(list(range(100)), 'ids')
+
+    assert len(scans) == 1
+    assert GristCache._estimated_bytes == _payload_bytes(tmp_path)
+
+
+def test_writes_over_budget_evict_in_steps(cache, monkeypatch):
+    tmp_path, scans = cache
+    GristCache('location-size').cache_write(list(range(100)), 'ids')
+    entry_bytes = _payload_bytes(tmp_path)
+    monkeypatch.setattr(GristCache, 'MAX_BYTES', entry_bytes * 50)
+
+    for i in range(500):
+        GristCache(f'location-{i}').cache_write(list(range(100)), 'ids')
+        assert _payload_bytes(tmp_path) <= GristCache.MAX_BYTES
+
+    # each eviction frees a tenth of the budget, about five entries' worth
+    assert len(scans) < 500 / 4
+    assert GristCache('location-499').cache_read('ids') == list(range(100))
@@ -0,0 +1,66 @@
+import os
+
+import geopandas
+import numpy as np
+import pytest
+import shapely
+
+from land_grab_2.stl_dataset.step_2.land_activity_search import entities
+from land_grab_2.stl_dataset.step_2.land_activity_search.entities import LOCAL_LAYER_CACHE_DIR, \
+    LOCAL_LAYER_READS_KEPT, StateActivityDataSource, local_layer_fingerprint
+from land_grab_2.utilities.utils import GristCache
+
+CRS = 'EPSG:5070'
+
+
+@pytest.fixture
+def layer(tmp_path, monkeypatch):
+    monkeypatch.setattr(GristCache, 'CACHE_DIR', str(tmp_path / 'cache'))
+    x = np.arange(100) * 10.0
+    geopandas.GeoDataFrame({'Type': ['t'] * 100}, geometry=shapely.box(x, 0, x + 5, 5), crs=CRS) \
+        .to_file(tmp_path / 'layer.shp', engine='pyogrio')
+    return StateActivityDataSource('layer', str(tmp_path / 'layer.shp'))
+
+
+def _entries(tmp_path):
+    layer_dirs = list((tmp_path / 'cache' / LOCAL_LAYER_CACHE_DIR).iterdir())
+    assert len(layer_dirs) == 1
+    return sorted(e.name for e in layer_dirs[0].iterdir())
+
+
+def test_fingerprint_is_hashed_once_per_version(tmp_path, layer):
+    entities._hash_sidecars.cache_clear()
+    fingerprint = local_layer_fingerprint(tmp_path / 'layer.shp')
+    for _ in range(3):
+        assert local_layer_fingerprint(tmp_path / 'layer.shp') == fingerprint
+    assert entities._hash_sidecars.cache_info().misses == 1
+
+    dbf = tmp_path / 'layer.dbf'
+    os.utime(dbf, ns=(dbf.stat().st_atime_ns, dbf.stat().st_mtime_ns + 10**9))
+    assert local_layer_fingerprint(tmp_path / 'layer.shp') != fingerprint
+
+
+def test_reads_of_older_files_are_evicted(tmp_path, layer):
+    layer.load_local(tmp_path, CRS)
+    first = _entries(tmp_path)
+
+    dbf = tmp_path / 'layer.dbf'
+    os.utime(dbf, ns=(dbf.stat().st_atime_ns, dbf.stat().st_mtime_ns + 10**9))
+    layer.load_local(tmp_path, CRS)
+    second = _entries(tmp_path)
+
+    assert len(first) == len(second) == 1
+    assert first != second
+
+
+def test_reads_of_past_bboxes_are_evicted(tmp_path, layer):
+    for i in range(LOCAL_LAYER_READS_KEPT + 3):
+        layer.load_local(tmp_path, CRS, bbox=(0, 0, 100 + 10 * i, 10))
+    assert len(_entries(tmp_path)) == LOCAL_LAYER_READS_KEPT
+
+    # a read that was used recently survives
+    recent = layer.load_local(tmp_path, CRS, bbox=(0, 0, 100 + 10 * 4, 10))
+    assert recent.attrs[entities.LOAD_SOURCE_ATTR] == 'cache'
+    layer.load_local(tmp_path, CRS, bbox=(0, 0, 1000, 10))
+    again = layer.load_local(tmp_path, CRS, bbox=(0, 0, 100 + 10 * 4, 10))
+    assert again.attrs[entities.LOAD_SOURCE_ATTR] == 'cache'
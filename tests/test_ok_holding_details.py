@@ -0,0 +1,48 @@
+import os
+
+import geopandas
+import numpy as np
+import pandas as pd
+import shapely
+
+from land_grab_2.stl_dataset.step_1.constants import ACTIVITY, OK_HOLDING_DETAIL_ID
+from land_grab_2.stl_dataset.step_1.dataset_cleaning import _filter_queried_oklahoma_data
+
+
+def _parcels(ids, **columns):
+    return geopandas.GeoDataFrame({OK_HOLDING_DETAIL_ID: ids, **columns},
+                                  geometry=shapely.points(np.arange(len(ids)), 0), crs='EPSG:4326')
+
+
+def _csv(path, ids, **columns):
+    pd.DataFrame({OK_HOLDING_DETAIL_ID: ids, **columns}).to_csv(path, index=False)
+    return str(path)
+
+
+def test_joins_like_a_merge_against_each_csv(tmp_path):
+    agricultural = _csv(tmp_path / 'OK-surface-agricultural-lease.csv', ['H1', 'H2', None],
+                        LeaseNo=['a1', 'a2', 'a3'], **{ACTIVITY: ['x'] * 3})
+    other = _csv(tmp_path / 'leases.csv', ['H2', 'H3'], LeaseNo=['o2', 'o3'], **{ACTIVITY: ['y'] * 2})
+
+    out = _filter_queried_oklahoma_data(
+        _parcels(['{H1}', '{H2}', '{H2}', '{H3}', None], LeaseNo=['p'] * 5, **{ACTIVITY: ['parcel'] * 5}),
+        (agricultural, other),
+    )
+
+    # parcel columns win, a csv's name names the activity, and missing ids join nothing
+    assert out[[OK_HOLDING_DETAIL_ID, 'LeaseNo', ACTIVITY]].values.tolist() == [
+        ['H1', 'p', 'Agricultural Lease'],
+        ['H2', 'p', 'Agricultural Lease'],
+        ['H2', 'p', 'parcel'],
+        ['H3', 'p', 'parcel'],
+    ]
+
+
+def test_a_changed_csv_is_read_again(tmp_path):
+    leases = _csv(tmp_path / 'OK-surface-agricultural-lease.csv', ['H1'], LeaseNo=['a1'])
+    assert _filter_queried_oklahoma_data(_parcels(['H1', 'H2']), (leases,))['LeaseNo'].tolist() == ['a1']
+
+    _csv(leases, ['H1', 'H2'], LeaseNo=['b1', 'b2'])
+    stat = os.stat(leases)
+    os.utime(leases, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert _filter_queried_oklahoma_data(_parcels(['H1', 'H2']), (leases,))['LeaseNo'].tolist() == ['b1', 'b2']
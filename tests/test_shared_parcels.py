@@ -0,0 +1,97 @@
+import multiprocessing
+import os
+import sys
+
+import geopandas
+import numpy as np
+import pytest
+import shapely
+
+from land_grab_2.utilities import overlap
+from land_grab_2.utilities.overlap import SharedParcels
+
+STATES = ['AZ', 'CO', 'ID', 'MT', 'NM', 'OK', 'OR', 'SD']
+PARCELS_PER_STATE = 40_000
+PARTITION_COLS = ['state', 'rights_type']
+
+
+def _publish(directory, per_state=PARCELS_PER_STATE):
+    n = per_state * len(STATES)
+    x = np.arange(n) % 1000 * 10.0
+    y = np.arange(n) // 1000 * 10.0
+    return SharedParcels.publish(
+        geopandas.GeoDataFrame({
+            'state': np.repeat(STATES, per_state),
+            'rights_type': np.where(np.arange(n) % 2, 'surface', 'subsurface'),
+        }, geometry=shapely.box(x, y, x + 8, y + 8), crs='EPSG:5070'),
+        directory, PARTITION_COLS,
+    )
+
+
+def _state_indexes(shared_parcels, state):
+    keys = [k for k in shared_parcels.partitions(PARTITION_COLS) if k[0] == state]
+    return [shared_parcels.parcel_index(PARTITION_COLS, k) for k in keys]
+
+
+def _rss_bytes():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def _rss_per_state(shared_parcels, rounds):
+    rss = []
+    for state in STATES * rounds:
+        _state_indexes(shared_parcels, state)
+        rss.append(_rss_bytes())
+    return rss
+
+
+def test_parcel_indexes_are_kept_for_the_last_states(tmp_path):
+    shared_parcels = _publish(tmp_path, per_state=100)
+    try:
+        for state in STATES:
+            indexes = _state_indexes(shared_parcels, state)
+        cached = overlap._ATTACHED_PARCELS[shared_parcels.path]['indexes']
+        assert [group[1] for group in cached] == STATES[-overlap.PARCEL_INDEX_CACHE_STATES:]
+
+        # a cached state is served from the cache
+        assert _state_indexes(shared_parcels, STATES[-1])[0] is indexes[0]
+        assert sorted(np.concatenate([i.positions for i in indexes])) == list(range(700, 800))
+    finally:
+        shared_parcels.unlink()
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='reads the resident set size from /proc')
+def test_worker_rss_stays_flat_across_states(tmp_path):
+    # a fresh worker, like the stage 2 scheduler's, going through every state twice
+    shared_parcels = _publish(tmp_path)
+    try:
+        with multiprocessing.get_context('spawn').Pool(1) as pool:
+            rss = pool.apply(_rss_per_state, (shared_parcels, 2))
+    finally:
+        shared_parcels.unlink()
+
+    # the indexes of one state, as the second state adds them
+    per_state = rss[1] - rss[0]
+    warm = rss[overlap.PARCEL_INDEX_CACHE_STATES]
+    # holding every state would grow by a state's indexes for each of the remaining ones
+    assert max(rss[overlap.PARCEL_INDEX_CACHE_STATES:]) - warm < per_state
+
+
+def test_state_digest_is_hashed_once_per_state(tmp_path, monkeypatch):
+    shared_parcels = _publish(tmp_path, per_state=100)
+    try:
+        hashed = []
+        hash_pandas_object = overlap.pd.util.hash_pandas_object
+        monkeypatch.setattr(overlap.pd.util, 'hash_pandas_object',
+                            lambda *args, **kwargs: hashed.append(1) or hash_pandas_object(*args, **kwargs))
+        positions = np.sort(np.concatenate(
+            [p for k, p in shared_parcels.partitions(PARTITION_COLS).items() if k[0] == 'OK']))
+
+        digests = [shared_parcels.digest(positions, key='OK') for _ in range(5)]
+        assert len(set(digests)) == 1
+        assert digests[0] == shared_parcels.digest(positions)
+        # once for the keyed digests and once for the unkeyed one, each over the columns and geometry
+        assert len(hashed) == 2 * (len(PARTITION_COLS) + 1)
+    finally:
+        shared_parcels.unlink()
@@ -0,0 +1,27 @@
+from types import SimpleNamespace
+
+from land_grab_2.stl_dataset.step_2.land_activity_search import telemetry
+from land_grab_2.stl_dataset.step_2.land_activity_search.entities import StateActivityDataLocation
+from land_grab_2.stl_dataset.step_2.land_activity_search.telemetry import finish_activity_metrics, \
+    start_activity_metrics
+
+MIB = 2**20
+
+
+def _match(monkeypatch, name, peak_before, peak_after):
+    activity = SimpleNamespace(name=name, loc_type=StateActivityDataLocation.LOCAL)
+    monkeypatch.setattr(telemetry, 'peak_rss_bytes', lambda: peak_before)
+    metrics = start_activity_metrics('OK', activity)
+    monkeypatch.setattr(telemetry, 'peak_rss_bytes', lambda: peak_after)
+    return finish_activity_metrics(metrics)
+
+
+def test_peak_rss_growth_is_per_activity(monkeypatch):
+    # a pooled worker matches a large layer, then a small one under the peak the large one left behind
+    large = _match(monkeypatch, 'large', 100 * MIB, 900 * MIB)
+    small = _match(monkeypatch, 'small', 900 * MIB, 900 * MIB)
+
+    assert large['peak_rss_growth_bytes'] == 800 * MIB
+    assert small['peak_rss_growth_bytes'] == 0
+    assert small['worker_peak_rss_bytes'] == 900 * MIB
+    assert not any(k.startswith('_') for k in small)